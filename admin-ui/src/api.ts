@@ -1,3 +1,46 @@
+export type UpstreamKeyState = {
+  key: string;
+  id: string;
+  pool: string;
+  weight: number;
+  available: boolean;
+  cooldown_remaining: number;
+  in_flight: number;
+  requests: number;
+  ewma_latency_ms: number | null;
+  recent_429: number;
+  recent_401: number;
+  recent_402: number;
+  consecutive_failures: number;
+  last_status: number | null;
+  last_error: string;
+  health: 'unknown' | 'healthy' | 'quarantined';
+  quarantine_reason: string;
+  last_check_at: number | null;
+  last_check_status: number | null;
+};
+
+export type ProxyKeyLimits = {
+  rpm: number | null;
+  tpm: number | null;
+  remaining_requests?: number;
+  remaining_tokens?: number;
+};
+
+export type KeyPool = {
+  name: string;
+  keys: (string | number)[];
+  overflow: boolean;
+};
+
+export type KeyPoolStats = {
+  keys: number;
+  available: number;
+  in_flight: number;
+  overflow: boolean;
+  overflowed: number;
+};
+
 export type AdminConfig = {
   settings: {
     upstream_base_url: string;
@@ -7,11 +50,21 @@ export type AdminConfig = {
   api_keys: {
     count: number;
     masked: string[];
+    weights: number[];
+    states: UpstreamKeyState[];
+    probe_interval_seconds: number;
+    last_probe_at: number | null;
+  };
+  key_pools: {
+    pools: KeyPool[];
+    stats: Record<string, KeyPoolStats>;
   };
   proxy_api_keys: {
     count: number;
     values: string[];
     masked: string[];
+    limits: ProxyKeyLimits[];
+    pools: string[];
     enabled: boolean;
   };
   admin: {
@@ -21,9 +74,17 @@ export type AdminConfig = {
   service: {
     port: number;
     env_file: string;
+    config_store: string;
   };
 };
 
+export type ConfigHistoryEntry = {
+  version: number;
+  changed_at: number;
+  note: string;
+  changed_keys: string[];
+};
+
 export type Health = {
   status: string;
   service: string;
@@ -124,6 +185,10 @@ export async function deleteUpstreamKey(index: number) {
   });
 }
 
+export async function probeUpstreamKeys() {
+  return request<{ message: string; config: AdminConfig }>('/admin/api/keys/probe', { method: 'POST' });
+}
+
 export async function addProxyKey(key: string) {
   return request<{ message: string; config: AdminConfig }>('/admin/api/proxy-keys', {
     method: 'POST',
@@ -143,6 +208,50 @@ export async function deleteProxyKey(index: number) {
   });
 }
 
+export async function updateProxyKeyLimits(index: number, rpm: number | null, tpm: number | null) {
+  return request<{ message: string; config: AdminConfig }>(`/admin/api/proxy-keys/${index}/limits`, {
+    method: 'PUT',
+    body: JSON.stringify({ rpm, tpm }),
+  });
+}
+
+export async function updateProxyKeyPool(index: number, pool: string) {
+  return request<{ message: string; config: AdminConfig }>(`/admin/api/proxy-keys/${index}/pool`, {
+    method: 'PUT',
+    body: JSON.stringify({ pool }),
+  });
+}
+
+export async function updateKeyPools(pools: KeyPool[]) {
+  return request<{ message: string; config: AdminConfig }>('/admin/api/key-pools', {
+    method: 'PUT',
+    body: JSON.stringify({ pools }),
+  });
+}
+
+export async function importConfig(content?: string) {
+  return request<{ message: string; config: AdminConfig }>('/admin/api/config/import', {
+    method: 'POST',
+    body: JSON.stringify(content === undefined ? {} : { content }),
+  });
+}
+
+export async function exportConfig() {
+  const response = await fetch('/admin/api/config/export', { headers: { Authorization: `Bearer ${getToken()}` } });
+  if (!response.ok) throw new Error(`HTTP ${response.status}`);
+  return response.text();
+}
+
+export async function getConfigHistory() {
+  return request<{ version: number; history: ConfigHistoryEntry[] }>('/admin/api/config/history');
+}
+
+export async function restoreConfig(version: number) {
+  return request<{ message: string; config: AdminConfig }>(`/admin/api/config/history/${version}/restore`, {
+    method: 'POST',
+  });
+}
+
 export async function changePassword(oldPassword: string, newPassword: string) {
   return request<{ message: string }>('/admin/api/password', {
     method: 'PUT',
@@ -21,17 +21,17 @@ import {
   WandSparkles,
 } from 'lucide-react';
 import * as api from './api';
-import type { AdminConfig, Health } from './api';
+import type { AdminConfig, ConfigHistoryEntry, Health, KeyPool, ProxyKeyLimits, UpstreamKeyState } from './api';
 import './style.css';
 
 type Page = 'dashboard' | 'access' | 'upstream' | 'settings' | 'security';
 
 const emptyConfig: AdminConfig = {
   settings: { upstream_base_url: '', model: 'gpt-5.5', force_model: false },
-  api_keys: { count: 0, masked: [] },
-  proxy_api_keys: { count: 0, values: [], masked: [], enabled: false },
+  api_keys: { count: 0, masked: [], weights: [], states: [], probe_interval_seconds: 0, last_probe_at: null },
+  proxy_api_keys: { count: 0, values: [], masked: [], limits: [], enabled: false },
   admin: { username: 'admin', using_default_password: true },
-  service: { port: 9996, env_file: '' },
+  service: { port: 9996, env_file: '', config_store: '' },
 };
 
 function maskKey(key: string) {
@@ -127,7 +127,7 @@ function Layout({
   async function reload() {
     const result = await api.reloadConfig();
     setConfig(result.config);
-    setToast('配置已从 .env 重载');
+    setToast(result.message);
   }
 
   const nav = [
@@ -247,6 +247,18 @@ function AccessPage({ config, setConfig, setToast }: PageProps) {
     setToast('代理 Key 已删除');
   }
 
+  async function saveLimits(index: number, rpm: number | null, tpm: number | null) {
+    const result = await api.updateProxyKeyLimits(index, rpm, tpm);
+    setConfig(result.config);
+    setToast(result.message);
+  }
+
+  async function savePool(index: number, pool: string) {
+    const result = await api.updateProxyKeyPool(index, pool);
+    setConfig(result.config);
+    setToast(result.message);
+  }
+
   return <div className="grid-two">
     <section className="panel">
       <div className="toolbar"><h2>客户端连接</h2><span className="chip">OpenAI 兼容</span></div>
@@ -263,7 +275,23 @@ function AccessPage({ config, setConfig, setToast }: PageProps) {
           <button className="primary" onClick={() => generate().catch((err: any) => setToast(err.message))}><WandSparkles size={16} />生成</button>
         </div>
       </div>
-      <KeyList keys={showKeys ? config.proxy_api_keys.values : config.proxy_api_keys.masked} onDelete={remove} copyValues={config.proxy_api_keys.values} emptyText="暂无代理 Key。未配置时第三方客户端不能使用独立代理 Key 鉴权。" />
+      <KeyList
+        keys={showKeys ? config.proxy_api_keys.values : config.proxy_api_keys.masked}
+        onDelete={remove}
+        copyValues={config.proxy_api_keys.values}
+        details={config.proxy_api_keys.limits.map((limits, index) => <>
+          <KeyLimitsEditor
+            limits={limits}
+            onSave={(rpm, tpm) => saveLimits(index, rpm, tpm).catch((err: any) => setToast(err.message))}
+          />
+          {config.key_pools.pools.length > 0 && <KeyPoolSelect
+            pool={config.proxy_api_keys.pools[index] || ''}
+            pools={config.key_pools.pools}
+            onChange={pool => savePool(index, pool).catch((err: any) => setToast(err.message))}
+          />}
+        </>)}
+        emptyText="暂无代理 Key。未配置时第三方客户端不能使用独立代理 Key 鉴权。"
+      />
       <div className="inline-form">
         <label>添加自定义代理 Key<input value={newKey} onChange={e => setNewKey(e.target.value)} placeholder="sk-proxy-..." autoComplete="off" /></label>
         <button className="primary" onClick={() => add().catch((err: any) => setToast(err.message))}>添加</button>
@@ -281,6 +309,11 @@ type PageProps = {
 function UpstreamKeysPage({ config, setConfig, setToast }: PageProps) {
   const [newKey, setNewKey] = useState('');
   const [bulkKeys, setBulkKeys] = useState('');
+  const [poolsText, setPoolsText] = useState(formatKeyPools(config.key_pools.pools));
+
+  useEffect(() => {
+    setPoolsText(formatKeyPools(config.key_pools.pools));
+  }, [config.key_pools.pools]);
 
   async function add() {
     const key = newKey.trim();
@@ -309,10 +342,41 @@ function UpstreamKeysPage({ config, setConfig, setToast }: PageProps) {
     setToast('上游 Key 已删除');
   }
 
+  async function probe() {
+    const result = await api.probeUpstreamKeys();
+    setConfig(result.config);
+    setToast(result.message);
+  }
+
+  async function savePools() {
+    let parsed: Record<string, { keys?: (string | number)[]; overflow?: boolean }>;
+    try {
+      parsed = poolsText.trim() ? JSON.parse(poolsText) : {};
+    } catch {
+      setToast('Key 池配置不是合法的 JSON');
+      return;
+    }
+    const pools = Object.entries(parsed).map(([name, pool]) => ({ name, keys: pool.keys || [], overflow: Boolean(pool.overflow) }));
+    const result = await api.updateKeyPools(pools);
+    setConfig(result.config);
+    setToast(result.message);
+  }
+
   return <div className="grid-two">
     <section className="panel">
-      <div className="toolbar"><h2>AnyRouter 上游 Key</h2><span className="chip">{config.api_keys.count} 个</span></div>
-      <KeyList keys={config.api_keys.masked} onDelete={remove} emptyText="暂无服务端上游 Key。配置代理 Key 后必须至少添加一个上游 Key。" />
+      <div className="toolbar">
+        <h2>AnyRouter 上游 Key</h2>
+        <div className="table-actions">
+          <span className="chip">{config.api_keys.count} 个</span>
+          <button className="ghost" onClick={() => probe().catch((err: any) => setToast(err.message))}><RefreshCw size={15} />立即检测</button>
+        </div>
+      </div>
+      <KeyList
+        keys={config.api_keys.masked}
+        onDelete={remove}
+        details={config.api_keys.states.map(state => <KeyHealth state={state} />)}
+        emptyText="暂无服务端上游 Key。配置代理 Key 后必须至少添加一个上游 Key。"
+      />
       <div className="inline-form">
         <label>添加单个 Key<input value={newKey} onChange={e => setNewKey(e.target.value)} placeholder="sk-..." autoComplete="off" /></label>
         <button className="primary" onClick={() => add().catch((err: any) => setToast(err.message))}>添加</button>
@@ -324,10 +388,25 @@ function UpstreamKeysPage({ config, setConfig, setToast }: PageProps) {
       <div className="table-actions">
         <button className="primary" onClick={() => replace().catch((err: any) => setToast(err.message))}><Save size={16} />替换列表</button>
       </div>
+      <h2>租户 Key 池</h2>
+      <label>Key 池配置<textarea value={poolsText} onChange={e => setPoolsText(e.target.value)} placeholder={'{"premium": {"keys": [0, "key-1a2b3c4d"], "overflow": true}}'} /></label>
+      <div className="key-pools">
+        {Object.entries(config.key_pools.stats).map(([name, stats]) => <span className="chip" key={name}>
+          {name === 'shared' ? '共享池' : name}：{stats.available}/{stats.keys} 可用{stats.overflowed > 0 && `，溢出 ${stats.overflowed} 次`}
+        </span>)}
+      </div>
+      <div className="table-actions">
+        <button className="primary" onClick={() => savePools().catch((err: any) => setToast(err.message))}><Save size={16} />保存 Key 池</button>
+      </div>
     </section>
   </div>;
 }
 
+function formatKeyPools(pools: KeyPool[]) {
+  if (!pools.length) return '';
+  return JSON.stringify(Object.fromEntries(pools.map(pool => [pool.name, { keys: pool.keys, overflow: pool.overflow }])), null, 2);
+}
+
 function SettingsPage({ config, setConfig, setToast }: PageProps) {
   const [upstreamBaseUrl, setUpstreamBaseUrl] = useState(config.settings.upstream_base_url);
   const [model, setModel] = useState(config.settings.model);
@@ -345,14 +424,69 @@ function SettingsPage({ config, setConfig, setToast }: PageProps) {
     setToast('运行配置已保存');
   }
 
+  return <>
+    <section className="panel narrow">
+      <h2>运行配置</h2>
+      <div className="form-grid">
+        <label>AnyRouter OpenAI 兼容地址<input value={upstreamBaseUrl} onChange={e => setUpstreamBaseUrl(e.target.value)} placeholder="https://anyrouter.top/v1" /></label>
+        <label>默认模型<input value={model} onChange={e => setModel(e.target.value)} placeholder="gpt-5.5" /></label>
+      </div>
+      <label className="check"><input type="checkbox" checked={forceModel} onChange={e => setForceModel(e.target.checked)} />强制所有请求使用默认模型</label>
+      <button className="primary" onClick={() => save().catch((err: any) => setToast(err.message))}><Save size={16} />保存配置</button>
+    </section>
+    <ConfigStorePanel config={config} setConfig={setConfig} setToast={setToast} />
+  </>;
+}
+
+function ConfigStorePanel({ config, setConfig, setToast }: PageProps) {
+  const [history, setHistory] = useState<ConfigHistoryEntry[]>([]);
+  const storeEnabled = Boolean(config.service.config_store);
+
+  useEffect(() => {
+    if (storeEnabled) api.getConfigHistory().then(result => setHistory(result.history)).catch(() => setHistory([]));
+  }, [config, storeEnabled]);
+
+  async function importEnv() {
+    if (!window.confirm('用 .env 文件中的配置覆盖当前配置？')) return;
+    const result = await api.importConfig();
+    setConfig(result.config);
+    setToast(result.message);
+  }
+
+  async function exportEnv() {
+    const url = URL.createObjectURL(new Blob([await api.exportConfig()], { type: 'text/plain' }));
+    const link = document.createElement('a');
+    link.href = url;
+    link.download = 'codex-proxy.env';
+    link.click();
+    URL.revokeObjectURL(url);
+  }
+
+  async function restore(version: number) {
+    if (!window.confirm(`确认回滚到配置版本 ${version}？`)) return;
+    const result = await api.restoreConfig(version);
+    setConfig(result.config);
+    setToast(result.message);
+  }
+
   return <section className="panel narrow">
-    <h2>运行配置</h2>
-    <div className="form-grid">
-      <label>AnyRouter OpenAI 兼容地址<input value={upstreamBaseUrl} onChange={e => setUpstreamBaseUrl(e.target.value)} placeholder="https://anyrouter.top/v1" /></label>
-      <label>默认模型<input value={model} onChange={e => setModel(e.target.value)} placeholder="gpt-5.5" /></label>
+    <div className="toolbar">
+      <h2>配置库</h2>
+      <div className="table-actions">
+        <button className="ghost" onClick={() => importEnv().catch((err: any) => setToast(err.message))}>从 .env 导入</button>
+        <button className="ghost" onClick={() => exportEnv().catch((err: any) => setToast(err.message))}>导出 .env</button>
+      </div>
     </div>
-    <label className="check"><input type="checkbox" checked={forceModel} onChange={e => setForceModel(e.target.checked)} />强制所有请求使用默认模型</label>
-    <button className="primary" onClick={() => save().catch((err: any) => setToast(err.message))}><Save size={16} />保存配置</button>
+    <InfoRow label="存储位置" value={config.service.config_store || `${config.service.env_file}（未启用配置库）`} />
+    {history.length > 0 && <div className="key-list">
+      {history.map(entry => <div className="key-item" key={entry.version}>
+        <div>
+          <code>v{entry.version} · {entry.note}</code>
+          <span>{new Date(entry.changed_at * 1000).toLocaleString()} · {entry.changed_keys.join(', ') || '-'}</span>
+        </div>
+        <button className="ghost" onClick={() => restore(entry.version).catch((err: any) => setToast(err.message))}>回滚</button>
+      </div>)}
+    </div>}
   </section>;
 }
 
@@ -398,21 +532,67 @@ function CopyButton({ value }: { value: string }) {
   return <button className="icon-button" onClick={() => copy().catch(() => undefined)} title="复制"><Clipboard size={16} />{copied ? '已复制' : '复制'}</button>;
 }
 
+const healthLabels: Record<UpstreamKeyState['health'], string> = {
+  healthy: '正常',
+  quarantined: '已隔离',
+  unknown: '未检测',
+};
+
+function KeyHealth({ state }: { state: UpstreamKeyState }) {
+  const chipClass = state.health === 'healthy' ? 'chip ok' : state.health === 'quarantined' ? 'chip warn' : 'chip';
+  const checkedAt = state.last_check_at ? new Date(state.last_check_at * 1000).toLocaleString() : '未检测';
+  return <div className="key-health">
+    <span className={chipClass}>{healthLabels[state.health]}</span>
+    <span>{state.id}</span>
+    {state.pool && <span className="chip">Key 池 {state.pool}</span>}
+    <span>最近检测：{checkedAt}</span>
+    {state.ewma_latency_ms !== null && <span>延迟 {state.ewma_latency_ms} ms</span>}
+    {state.quarantine_reason && <span className="key-health-reason">{state.quarantine_reason}</span>}
+  </div>;
+}
+
+function KeyLimitsEditor({ limits, onSave }: { limits: ProxyKeyLimits; onSave: (rpm: number | null, tpm: number | null) => void }) {
+  const [rpm, setRpm] = useState(limits.rpm ? String(limits.rpm) : '');
+  const [tpm, setTpm] = useState(limits.tpm ? String(limits.tpm) : '');
+  const toLimit = (value: string) => (Number(value) > 0 ? Math.floor(Number(value)) : null);
+  return <div className="key-limits">
+    <label>RPM<input value={rpm} onChange={e => setRpm(e.target.value)} inputMode="numeric" placeholder="不限" /></label>
+    <label>TPM<input value={tpm} onChange={e => setTpm(e.target.value)} inputMode="numeric" placeholder="不限" /></label>
+    <button className="ghost" onClick={() => onSave(toLimit(rpm), toLimit(tpm))}><Save size={15} />保存限额</button>
+    {limits.remaining_requests !== undefined && <span>剩余请求 {limits.remaining_requests}</span>}
+    {limits.remaining_tokens !== undefined && <span>剩余 token {limits.remaining_tokens}</span>}
+  </div>;
+}
+
+function KeyPoolSelect({ pool, pools, onChange }: { pool: string; pools: KeyPool[]; onChange: (pool: string) => void }) {
+  return <div className="key-limits">
+    <label>Key 池<select value={pool} onChange={e => onChange(e.target.value)}>
+      <option value="">共享池</option>
+      {pools.map(item => <option value={item.name} key={item.name}>{item.name}</option>)}
+    </select></label>
+  </div>;
+}
+
 function KeyList({
   keys,
   onDelete,
   copyValues,
+  details,
   emptyText,
 }: {
   keys: string[];
   onDelete: (index: number) => Promise<void>;
   copyValues?: string[];
+  details?: React.ReactNode[];
   emptyText: string;
 }) {
   if (!keys.length) return <div className="empty">{emptyText}</div>;
   return <div className="key-list">
     {keys.map((key, index) => <div className="key-item" key={`${key}-${index}`}>
-      <code>{key || maskKey(copyValues?.[index] || '')}</code>
+      <div>
+        <code>{key || maskKey(copyValues?.[index] || '')}</code>
+        {details?.[index]}
+      </div>
       <div className="table-actions">
         {copyValues?.[index] && <CopyButton value={copyValues[index]} />}
         <button className="ghost danger" onClick={() => onDelete(index)}><Trash2 size={15} />删除</button>
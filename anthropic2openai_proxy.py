@@ -4,7 +4,13 @@ Anthropic 转 OpenAI 协议转换代理服务器
 该服务器接收 Anthropic 格式的请求，转换为 OpenAI 格式，
 然后转发到 OpenAI 兼容的后端服务。
 
-调用链路：aa.py (Anthropic SDK) --> 本代理 --> https://renderanyrouter2openai.duckcloud.fun/v1
+调用链路：aa.py (Anthropic SDK) --> 本代理 --> OpenAI 兼容后端（可配置多个）
+
+多后端：
+    OPENAI_BACKENDS='[{"name": "a", "base_url": "https://a/v1", "api_key": "sk-a"}, ...]'
+    或 OPENAI_API_BASE / OPENAI_API_KEY 逗号分隔（key 只有一个时所有后端共用）
+    每个后端按首字节延迟（TTFB）的 EWMA 和错误情况打分，请求发往最快的健康后端；
+    上游返回首字节之前失败（连接错误 / 5xx / 429）会自动切换到下一个后端。
 
 使用方法：
     python anthropic2openai_proxy.py
@@ -13,24 +19,295 @@ Anthropic 转 OpenAI 协议转换代理服务器
 """
 
 import json
+import logging
+import os
+import random
 import uuid
 import time
 import asyncio
-from typing import AsyncGenerator, List
+from collections.abc import AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, List
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import StreamingResponse, JSONResponse
 import httpx
 import uvicorn
+from dotenv import load_dotenv
+
+# 加载 .env 文件
+load_dotenv()
 
-app = FastAPI(title="Anthropic to OpenAI Proxy")
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
 
 # 配置参数
-OPENAI_API_BASE = "https://renderanyrouter2openai.duckcloud.fun/v1"  # OpenAI 后端地址
-OPENAI_API_KEY = "sk-111111111111111"  # API 密钥
-PROXY_PORT = 8088  # 代理监听端口
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://renderanyrouter2openai.duckcloud.fun/v1")  # OpenAI 后端地址
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "sk-111111111111111")  # API 密钥
+OPENAI_BACKENDS = os.getenv("OPENAI_BACKENDS", "").strip()  # JSON 数组，优先于上面两项
+PROXY_PORT = int(os.getenv("ANTHROPIC2OPENAI_PORT", "8088"))  # 代理监听端口
+HOST = os.getenv("HOST", "0.0.0.0")
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+# 连接池
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", "100"))
+BACKEND_MAX_KEEPALIVE = int(os.getenv("BACKEND_MAX_KEEPALIVE", "20"))
+# 延迟感知路由：EWMA 平滑系数、连续失败多少次进入冷却、冷却时长（秒）
+BACKEND_EWMA_ALPHA = float(os.getenv("BACKEND_EWMA_ALPHA", "0.3"))
+BACKEND_FAILURE_THRESHOLD = int(os.getenv("BACKEND_FAILURE_THRESHOLD", "3"))
+BACKEND_COOLDOWN_SECONDS = float(os.getenv("BACKEND_COOLDOWN_SECONDS", "30"))
+# 探测比例：这部分请求发往最久没有延迟样本的后端，避免一次偶发慢请求让后端永远不再被选中
+BACKEND_PROBE_RATIO = float(os.getenv("BACKEND_PROBE_RATIO", "0.05"))
+
+
+@dataclass
+class Backend:
+    """OpenAI 兼容后端及其运行统计"""
+    name: str
+    base_url: str
+    api_key: str
+    weight: float = 1.0
+    ttfb_ewma: float | None = None
+    in_flight: int = 0
+    requests: int = 0
+    errors: int = 0
+    failovers: int = 0
+    probes: int = 0
+    sampled_at: float = 0.0
+    consecutive_failures: int = 0
+    cooldown_until: float = 0.0
+    last_error: str = ""
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def score(self) -> float:
+        """越小越优先；尚无延迟样本的后端得分为 0，保证新后端先被探测"""
+        latency = self.ttfb_ewma if self.ttfb_ewma is not None else 0.0
+        return latency * (1 + self.in_flight) / self.weight
+
+    def record_success(self, ttfb: float) -> None:
+        if self.ttfb_ewma is None:
+            self.ttfb_ewma = ttfb
+        else:
+            self.ttfb_ewma = BACKEND_EWMA_ALPHA * ttfb + (1 - BACKEND_EWMA_ALPHA) * self.ttfb_ewma
+        self.sampled_at = time.monotonic()
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record_failure(self, error: str) -> None:
+        self.errors += 1
+        self.consecutive_failures += 1
+        self.last_error = error[:300]
+        if self.consecutive_failures >= BACKEND_FAILURE_THRESHOLD:
+            self.cooldown_until = time.monotonic() + BACKEND_COOLDOWN_SECONDS
+            logger.warning("Backend %s cooling down for %.0fs: %s", self.name, BACKEND_COOLDOWN_SECONDS, self.last_error)
+
+    def snapshot(self, now: float) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "healthy": self.healthy(now),
+            "cooldown_remaining": round(max(self.cooldown_until - now, 0.0), 1),
+            "ttfb_ewma_ms": round(self.ttfb_ewma * 1000, 1) if self.ttfb_ewma is not None else None,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "failovers": self.failovers,
+            "probes": self.probes,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+        }
+
+
+class BackendPool:
+    """按 EWMA 延迟和在途请求数选择后端
+
+    probe_ratio 比例的请求先尝试最久没有新延迟样本的非最优后端，使 EWMA 能随后端恢复而更新。
+    """
+
+    def __init__(self, backends: list[Backend], probe_ratio: float = BACKEND_PROBE_RATIO):
+        if not backends:
+            raise ValueError("No OpenAI backend configured")
+        self.backends = backends
+        self.probe_ratio = probe_ratio
+
+    def candidates(self) -> list[Backend]:
+        """健康后端按得分排序；冷却中的后端排在最后兜底（按冷却结束时间）"""
+        now = time.monotonic()
+        healthy = sorted((b for b in self.backends if b.healthy(now)), key=Backend.score)
+        if len(healthy) > 1 and random.random() < self.probe_ratio:
+            probe = min(healthy[1:], key=lambda b: b.sampled_at)
+            probe.probes += 1
+            healthy.remove(probe)
+            healthy.insert(0, probe)
+        cooling = sorted((b for b in self.backends if not b.healthy(now)), key=lambda b: b.cooldown_until)
+        return healthy + cooling
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        now = time.monotonic()
+        return [backend.snapshot(now) for backend in self.backends]
+
+
+def split_env_list(raw_value: str) -> list[str]:
+    return [item.strip() for item in raw_value.split(",") if item.strip()]
+
+
+def load_backends() -> list[Backend]:
+    """读取 OPENAI_BACKENDS（JSON），未配置时退回 OPENAI_API_BASE / OPENAI_API_KEY"""
+    if OPENAI_BACKENDS:
+        items = json.loads(OPENAI_BACKENDS)
+        if not isinstance(items, list):
+            raise ValueError("OPENAI_BACKENDS must be a JSON array")
+        backends = []
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get("base_url"):
+                raise ValueError(f"OPENAI_BACKENDS[{i}] requires base_url")
+            backends.append(Backend(
+                name=str(item.get("name") or f"backend_{i + 1}"),
+                base_url=str(item["base_url"]).rstrip("/"),
+                api_key=str(item.get("api_key") or OPENAI_API_KEY),
+                weight=max(float(item.get("weight", 1.0)), 0.01),
+            ))
+        return backends
+
+    bases = split_env_list(OPENAI_API_BASE)
+    keys = split_env_list(OPENAI_API_KEY)
+    if len(keys) == 1:
+        keys = keys * len(bases)
+    if len(keys) != len(bases):
+        raise ValueError("OPENAI_API_KEY must have one key or one key per OPENAI_API_BASE entry")
+    return [
+        Backend(name=f"backend_{i + 1}", base_url=base.rstrip("/"), api_key=key)
+        for i, (base, key) in enumerate(zip(bases, keys))
+    ]
+
+
+class BackendUnavailable(Exception):
+    """所有后端都在首字节之前失败"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+backend_pool = BackendPool(load_backends())
+
+# 全局 HTTP 客户端（lifespan 中创建）
+http_client: httpx.AsyncClient | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=BACKEND_MAX_CONNECTIONS,
+            max_keepalive_connections=BACKEND_MAX_KEEPALIVE,
+        ),
+    )
+    logger.info("Backends: %s", ", ".join(f"{b.name}={b.base_url}" for b in backend_pool.backends))
+    yield
+    await http_client.aclose()
+
+
+app = FastAPI(title="Anthropic to OpenAI Proxy", lifespan=lifespan)
 
-# 全局 HTTP 客户端
-http_client = httpx.AsyncClient(timeout=120.0)
+
+@asynccontextmanager
+async def open_backend(openai_request: dict) -> AsyncIterator[tuple[Backend, httpx.Response]]:
+    """按得分依次尝试后端，返回第一个在首字节前未失败的上游响应（响应体尚未读取）
+
+    连接错误、5xx、429 视为后端故障并切换；其它 4xx 属于请求本身的问题，直接返回给调用方。
+    """
+    body = json.dumps(openai_request).encode()
+    last_status = 502
+    last_error = "No backend available"
+    for attempt, backend in enumerate(backend_pool.candidates()):
+        if attempt:
+            backend.failovers += 1
+        request = http_client.build_request(
+            "POST",
+            f"{backend.base_url}/chat/completions",
+            content=body,
+            headers={
+                "Authorization": f"Bearer {backend.api_key}",
+                "Content-Type": "application/json"
+            }
+        )
+        backend.requests += 1
+        backend.in_flight += 1
+        # in_flight must drop on every exit, including cancellation when the client disconnects.
+        try:
+            start = time.monotonic()
+            try:
+                response = await http_client.send(request, stream=True)
+            except httpx.HTTPError as e:
+                backend.record_failure(f"{type(e).__name__}: {e}")
+                last_status, last_error = 502, f"{backend.name}: {type(e).__name__}: {e}"
+                continue
+
+            if response.status_code >= 500 or response.status_code == 429:
+                try:
+                    error_text = (await response.aread()).decode(errors="replace")
+                finally:
+                    await response.aclose()
+                backend.record_failure(f"HTTP {response.status_code}: {error_text}")
+                last_status, last_error = response.status_code, error_text
+                continue
+
+            backend.record_success(time.monotonic() - start)
+            try:
+                yield backend, response
+            finally:
+                await response.aclose()
+            return
+        finally:
+            backend.in_flight -= 1
+
+    raise BackendUnavailable(last_status, last_error)
+
+
+def anthropic_content_to_text(content) -> str:
+    """Anthropic 文本内容（字符串或内容块列表）拼接为纯文本"""
+    if isinstance(content, str):
+        return content
+    text_parts = []
+    for block in content or []:
+        if isinstance(block, dict) and block.get("type") == "text":
+            text_parts.append(block.get("text", ""))
+        elif isinstance(block, str):
+            text_parts.append(block)
+    return "\n".join(text_parts)
+
+
+def convert_image_block(block: dict) -> dict | None:
+    source = block.get("source") or {}
+    if source.get("type") == "base64":
+        url = f"data:{source.get('media_type', 'image/png')};base64,{source.get('data', '')}"
+    elif source.get("type") == "url":
+        url = source.get("url", "")
+    else:
+        return None
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def convert_tool_choice(tool_choice: dict) -> str | dict | None:
+    choice_type = tool_choice.get("type")
+    if choice_type == "auto":
+        return "auto"
+    if choice_type == "any":
+        return "required"
+    if choice_type == "none":
+        return "none"
+    if choice_type == "tool" and tool_choice.get("name"):
+        return {"type": "function", "function": {"name": tool_choice["name"]}}
+    return None
 
 
 def convert_anthropic_to_openai(anthropic_request: dict) -> dict:
@@ -38,11 +315,11 @@ def convert_anthropic_to_openai(anthropic_request: dict) -> dict:
 
     messages = []
 
-    # 处理系统消息（如果存在）
-    if "system" in anthropic_request:
+    # 处理系统消息（如果存在，可能是字符串或内容块列表）
+    if anthropic_request.get("system"):
         messages.append({
             "role": "system",
-            "content": anthropic_request["system"]
+            "content": anthropic_content_to_text(anthropic_request["system"])
         })
 
     # 转换消息列表
@@ -50,20 +327,56 @@ def convert_anthropic_to_openai(anthropic_request: dict) -> dict:
         role = msg.get("role", "user")
         content = msg.get("content", "")
 
-        # 处理内容块（Anthropic 格式可能是列表）
-        if isinstance(content, list):
-            text_parts = []
-            for block in content:
-                if isinstance(block, dict) and block.get("type") == "text":
-                    text_parts.append(block.get("text", ""))
-                elif isinstance(block, str):
-                    text_parts.append(block)
-            content = "\n".join(text_parts)
-
-        messages.append({
-            "role": role,
-            "content": content
-        })
+        if not isinstance(content, list):
+            messages.append({"role": role, "content": content})
+            continue
+
+        # 处理内容块：tool_use -> assistant.tool_calls，tool_result -> role=tool 消息
+        parts = []
+        tool_calls = []
+        for block in content:
+            if isinstance(block, str):
+                parts.append({"type": "text", "text": block})
+                continue
+            if not isinstance(block, dict):
+                continue
+            block_type = block.get("type")
+            if block_type == "text":
+                parts.append({"type": "text", "text": block.get("text", "")})
+            elif block_type == "image":
+                image_part = convert_image_block(block)
+                if image_part:
+                    parts.append(image_part)
+            elif block_type == "tool_use":
+                tool_calls.append({
+                    "id": block.get("id", ""),
+                    "type": "function",
+                    "function": {
+                        "name": block.get("name", ""),
+                        "arguments": json.dumps(block.get("input") or {}, ensure_ascii=False),
+                    },
+                })
+            elif block_type == "tool_result":
+                # 工具结果必须紧跟在对应的 assistant tool_calls 之后
+                result_text = anthropic_content_to_text(block.get("content", ""))
+                if block.get("is_error"):
+                    result_text = f"[error] {result_text}"
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": block.get("tool_use_id", ""),
+                    "content": result_text,
+                })
+
+        if all(part["type"] == "text" for part in parts):
+            message = {"role": role, "content": "\n".join(part["text"] for part in parts)}
+        else:
+            message = {"role": role, "content": parts}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+            if not parts:
+                message["content"] = None
+        if parts or tool_calls:
+            messages.append(message)
 
     # 构建 OpenAI 请求
     openai_request = {
@@ -71,6 +384,9 @@ def convert_anthropic_to_openai(anthropic_request: dict) -> dict:
         "messages": messages,
         "stream": anthropic_request.get("stream", False),
     }
+    if openai_request["stream"]:
+        # 要求后端在最后一个 chunk 中返回真实 usage
+        openai_request["stream_options"] = {"include_usage": True}
 
     # 可选参数转换
     if "max_tokens" in anthropic_request:
@@ -82,138 +398,290 @@ def convert_anthropic_to_openai(anthropic_request: dict) -> dict:
     if "stop_sequences" in anthropic_request:
         openai_request["stop"] = anthropic_request["stop_sequences"]
 
+    # 工具定义
+    if anthropic_request.get("tools"):
+        openai_request["tools"] = [
+            {
+                "type": "function",
+                "function": {
+                    "name": tool.get("name", ""),
+                    "description": tool.get("description", ""),
+                    "parameters": tool.get("input_schema") or {"type": "object", "properties": {}},
+                },
+            }
+            for tool in anthropic_request["tools"]
+        ]
+    tool_choice = anthropic_request.get("tool_choice")
+    if isinstance(tool_choice, dict):
+        converted_choice = convert_tool_choice(tool_choice)
+        if converted_choice is not None:
+            openai_request["tool_choice"] = converted_choice
+        if tool_choice.get("disable_parallel_tool_use"):
+            openai_request["parallel_tool_calls"] = False
+
     return openai_request
 
 
+# OpenAI finish_reason -> Anthropic stop_reason
+FINISH_REASON_MAP = {
+    "stop": "end_turn",
+    "length": "max_tokens",
+    "tool_calls": "tool_use",
+    "function_call": "tool_use",
+    "content_filter": "refusal",
+}
+
+
+def convert_usage(usage: dict | None) -> dict:
+    """OpenAI usage -> Anthropic usage（缓存命中的 token 单独列出）"""
+    usage = usage or {}
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    result = {
+        "input_tokens": max((usage.get("prompt_tokens") or 0) - cached, 0),
+        "output_tokens": usage.get("completion_tokens") or 0,
+    }
+    if cached:
+        result["cache_read_input_tokens"] = cached
+    return result
+
+
+def parse_tool_arguments(arguments: str) -> dict:
+    try:
+        parsed = json.loads(arguments or "{}")
+    except json.JSONDecodeError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
 def convert_openai_to_anthropic(openai_response: dict, model: str) -> dict:
     """将 OpenAI chat completions 响应转换为 Anthropic messages 格式"""
 
-    choice = openai_response.get("choices", [{}])[0]
-    message = choice.get("message", {})
+    choice = (openai_response.get("choices") or [{}])[0]
+    message = choice.get("message") or {}
+
+    content = []
+    if message.get("content"):
+        content.append({"type": "text", "text": message["content"]})
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function") or {}
+        content.append({
+            "type": "tool_use",
+            "id": tool_call.get("id") or f"toolu_{uuid.uuid4().hex[:24]}",
+            "name": function.get("name", ""),
+            "input": parse_tool_arguments(function.get("arguments", "")),
+        })
+    if not content:
+        content.append({"type": "text", "text": ""})
 
+    finish_reason = choice.get("finish_reason")
     return {
         "id": f"msg_{uuid.uuid4().hex[:24]}",
         "type": "message",
         "role": "assistant",
-        "content": [
-            {
-                "type": "text",
-                "text": message.get("content", "")
-            }
-        ],
+        "content": content,
         "model": model,
-        "stop_reason": "end_turn" if choice.get("finish_reason") == "stop" else choice.get("finish_reason"),
+        "stop_reason": FINISH_REASON_MAP.get(finish_reason, finish_reason or "end_turn"),
         "stop_sequence": None,
-        "usage": {
-            "input_tokens": openai_response.get("usage", {}).get("prompt_tokens", 0),
-            "output_tokens": openai_response.get("usage", {}).get("completion_tokens", 0)
-        }
+        "usage": convert_usage(openai_response.get("usage")),
     }
 
 
-async def stream_openai_and_convert(openai_request: dict, model: str) -> AsyncGenerator[bytes, None]:
-    """从 OpenAI 后端流式获取数据并转换为 Anthropic 格式"""
-
-    msg_id = f"msg_{uuid.uuid4().hex[:24]}"
-
-    # 发送 message_start 事件
-    start_event = {
-        "type": "message_start",
-        "message": {
-            "id": msg_id,
-            "type": "message",
-            "role": "assistant",
-            "content": [],
-            "model": model,
-            "stop_reason": None,
-            "stop_sequence": None,
-            "usage": {"input_tokens": 0, "output_tokens": 0}
-        }
-    }
-    yield f"event: message_start\ndata: {json.dumps(start_event)}\n\n".encode()
-
-    # 发送 content_block_start 事件
-    block_start = {
-        "type": "content_block_start",
-        "index": 0,
-        "content_block": {"type": "text", "text": ""}
-    }
-    yield f"event: content_block_start\ndata: {json.dumps(block_start)}\n\n".encode()
-
-    # 向 OpenAI 后端发起请求
-    try:
-        async with http_client.stream(
-            "POST",
-            f"{OPENAI_API_BASE}/chat/completions",
-            json=openai_request,
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json"
+def sse_frame(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+
+# 高频事件的预编码帧模板，只有索引和增量内容需要填充
+TEXT_DELTA_FRAME = (
+    b'event: content_block_delta\ndata: {"type":"content_block_delta","index":%d,'
+    b'"delta":{"type":"text_delta","text":%s}}\n\n'
+)
+INPUT_JSON_DELTA_FRAME = (
+    b'event: content_block_delta\ndata: {"type":"content_block_delta","index":%d,'
+    b'"delta":{"type":"input_json_delta","partial_json":%s}}\n\n'
+)
+TEXT_BLOCK_START_FRAME = (
+    b'event: content_block_start\ndata: {"type":"content_block_start","index":%d,'
+    b'"content_block":{"type":"text","text":""}}\n\n'
+)
+BLOCK_STOP_FRAME = b'event: content_block_stop\ndata: {"type":"content_block_stop","index":%d}\n\n'
+MESSAGE_STOP_FRAME = b'event: message_stop\ndata: {"type":"message_stop"}\n\n'
+
+
+def encode_json_string(value: str) -> bytes:
+    return json.dumps(value, ensure_ascii=False).encode()
+
+
+class OpenAIStreamConverter:
+    """OpenAI chat.completion.chunk 流 -> Anthropic messages SSE 事件流
+
+    message_start 推迟到上游第一个 chunk 到达时发送；文本和每个工具调用各占一个内容块，
+    工具参数以 input_json_delta 增量转发；结束时按 finish_reason 映射 stop_reason，
+    usage 取自 stream_options.include_usage 返回的最后一个 chunk。
+    """
+
+    def __init__(self, model: str):
+        self.msg_id = f"msg_{uuid.uuid4().hex[:24]}"
+        self.model = model
+        self.started = False
+        self.block_count = 0
+        # 当前打开的内容块：("text", None) 或 ("tool", OpenAI tool_call index)
+        self.open_block: tuple[str, int | None] | None = None
+        self.stop_reason = "end_turn"
+        self.usage: dict | None = None
+
+    def _start(self) -> list[bytes]:
+        if self.started:
+            return []
+        self.started = True
+        return [sse_frame("message_start", {
+            "type": "message_start",
+            "message": {
+                "id": self.msg_id,
+                "type": "message",
+                "role": "assistant",
+                "content": [],
+                "model": self.model,
+                "stop_reason": None,
+                "stop_sequence": None,
+                "usage": {"input_tokens": 0, "output_tokens": 0}
             }
-        ) as response:
-            # 检查响应状态
-            if response.status_code != 200:
-                error_text = await response.aread()
-                error_event = {
-                    "type": "error",
-                    "error": {"type": "api_error", "message": error_text.decode()}
-                }
-                yield f"event: error\ndata: {json.dumps(error_event)}\n\n".encode()
-                return
-
-            # 流式处理内容增量
-            async for line in response.aiter_lines():
-                line = line.strip()
-
-                if not line or not line.startswith("data: "):
-                    continue
+        })]
+
+    def _close_block(self) -> list[bytes]:
+        if self.open_block is None:
+            return []
+        self.open_block = None
+        return [BLOCK_STOP_FRAME % (self.block_count - 1)]
+
+    def _open_text_block(self) -> list[bytes]:
+        frames = self._close_block()
+        frames.append(TEXT_BLOCK_START_FRAME % self.block_count)
+        self.block_count += 1
+        self.open_block = ("text", None)
+        return frames
+
+    def _open_tool_block(self, tool_index: int, tool_call: dict) -> list[bytes]:
+        frames = self._close_block()
+        frames.append(sse_frame("content_block_start", {
+            "type": "content_block_start",
+            "index": self.block_count,
+            "content_block": {
+                "type": "tool_use",
+                "id": tool_call.get("id") or f"toolu_{uuid.uuid4().hex[:24]}",
+                "name": (tool_call.get("function") or {}).get("name", ""),
+                "input": {},
+            },
+        }))
+        self.block_count += 1
+        self.open_block = ("tool", tool_index)
+        return frames
+
+    def feed(self, chunk: dict) -> list[bytes]:
+        frames = self._start()
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        choices = chunk.get("choices") or []
+        if not choices:
+            return frames
+        choice = choices[0]
+        delta = choice.get("delta") or {}
+
+        text = delta.get("content")
+        if text:
+            if self.open_block is None or self.open_block[0] != "text":
+                frames.extend(self._open_text_block())
+            frames.append(TEXT_DELTA_FRAME % (self.block_count - 1, encode_json_string(text)))
+
+        for tool_call in delta.get("tool_calls") or []:
+            tool_index = tool_call.get("index", 0)
+            # 新的工具调用（或不同 index）开启新的 tool_use 块
+            if self.open_block != ("tool", tool_index):
+                frames.extend(self._open_tool_block(tool_index, tool_call))
+            arguments = (tool_call.get("function") or {}).get("arguments")
+            if arguments:
+                frames.append(INPUT_JSON_DELTA_FRAME % (self.block_count - 1, encode_json_string(arguments)))
+
+        finish_reason = choice.get("finish_reason")
+        if finish_reason:
+            self.stop_reason = FINISH_REASON_MAP.get(finish_reason, "end_turn")
+        return frames
+
+    def finish(self) -> list[bytes]:
+        frames = self._start()
+        if self.block_count == 0:
+            # 保证至少有一个内容块，兼容只读取第一个文本块的客户端
+            frames.extend(self._open_text_block())
+        frames.extend(self._close_block())
+        usage = convert_usage(self.usage)
+        frames.append(sse_frame("message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": self.stop_reason, "stop_sequence": None},
+            "usage": usage,
+        }))
+        frames.append(MESSAGE_STOP_FRAME)
+        return frames
+
+    def error(self, message: str) -> list[bytes]:
+        frames = self._start()
+        frames.append(sse_frame("error", {"type": "error", "error": {"type": "api_error", "message": message}}))
+        return frames
+
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """StreamingResponse that closes the upstream stack however the response ends
+
+    The generator's own finally never runs if Starlette does not start iterating it
+    (e.g. the client is already gone), and StreamingResponse skips background tasks
+    when sending fails, so the stack is released here as well. AsyncExitStack.aclose
+    is idempotent.
+    """
+
+    def __init__(self, content: AsyncGenerator[bytes, None], stack: AsyncExitStack, **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self.stack = stack
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.stack.aclose()
+
+
+async def stream_openai_and_convert(
+    stack: AsyncExitStack,
+    response: httpx.Response,
+    model: str,
+) -> AsyncGenerator[bytes, None]:
+    """将已建立的 OpenAI 流式响应转换为 Anthropic 格式；stack 持有后端连接，结束时释放"""
+
+    converter = OpenAIStreamConverter(model)
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
 
-                data = line[6:]  # 移除 "data: " 前缀
+            data = line[5:].strip()  # 移除 "data:" 前缀
 
-                if data == "[DONE]":
-                    break
+            if data == "[DONE]":
+                break
 
-                try:
-                    chunk = json.loads(data)
-                    choices = chunk.get("choices", [])
-                    if choices:
-                        delta = choices[0].get("delta", {})
-                        content = delta.get("content", "")
-
-                        # 如果有内容，发送 content_block_delta 事件
-                        if content:
-                            delta_event = {
-                                "type": "content_block_delta",
-                                "index": 0,
-                                "delta": {"type": "text_delta", "text": content}
-                            }
-                            yield f"event: content_block_delta\ndata: {json.dumps(delta_event)}\n\n".encode()
-                except json.JSONDecodeError:
-                    continue
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            for frame in converter.feed(chunk):
+                yield frame
 
     except Exception as e:
-        # 发送错误事件
-        error_event = {
-            "type": "error",
-            "error": {"type": "api_error", "message": str(e)}
-        }
-        yield f"event: error\ndata: {json.dumps(error_event)}\n\n".encode()
+        # 已开始输出后只能以错误事件结束
+        for frame in converter.error(str(e)):
+            yield frame
         return
+    finally:
+        await stack.aclose()
 
-    # 发送 content_block_stop 事件
-    block_stop = {"type": "content_block_stop", "index": 0}
-    yield f"event: content_block_stop\ndata: {json.dumps(block_stop)}\n\n".encode()
-
-    # 发送 message_delta 事件（停止原因）
-    msg_delta = {
-        "type": "message_delta",
-        "delta": {"stop_reason": "end_turn", "stop_sequence": None},
-        "usage": {"output_tokens": 0}
-    }
-    yield f"event: message_delta\ndata: {json.dumps(msg_delta)}\n\n".encode()
-
-    # 发送 message_stop 事件
-    yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n".encode()
+    for frame in converter.finish():
+        yield frame
 
 
 @app.post("/v1/messages")
@@ -230,9 +698,19 @@ async def anthropic_messages(request: Request):
         openai_request = convert_anthropic_to_openai(anthropic_request)
 
         if is_stream:
-            # 流式响应
-            return StreamingResponse(
-                stream_openai_and_convert(openai_request, model),
+            # 流式响应：先等到上游返回状态码，非 200 时仍可返回正常的 HTTP 错误
+            stack = AsyncExitStack()
+            try:
+                backend, response = await stack.enter_async_context(open_backend(openai_request))
+                if response.status_code != 200:
+                    await response.aread()
+                    raise HTTPException(status_code=response.status_code, detail=response.text)
+            except BaseException:
+                await stack.aclose()
+                raise
+            return ReleasingStreamingResponse(
+                stream_openai_and_convert(stack, response, model),
+                stack,
                 media_type="text/event-stream",
                 headers={
                     "Cache-Control": "no-cache",
@@ -241,14 +719,8 @@ async def anthropic_messages(request: Request):
             )
         else:
             # 非流式响应
-            response = await http_client.post(
-                f"{OPENAI_API_BASE}/chat/completions",
-                json=openai_request,
-                headers={
-                    "Authorization": f"Bearer {OPENAI_API_KEY}",
-                    "Content-Type": "application/json"
-                }
-            )
+            async with open_backend(openai_request) as (backend, response):
+                await response.aread()
 
             if response.status_code != 200:
                 raise HTTPException(status_code=response.status_code, detail=response.text)
@@ -258,6 +730,8 @@ async def anthropic_messages(request: Request):
 
             return JSONResponse(content=anthropic_response)
 
+    except BackendUnavailable as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
     except HTTPException:
         raise
     except Exception as e:
@@ -267,7 +741,19 @@ async def anthropic_messages(request: Request):
 @app.get("/health")
 async def health_check():
     """健康检查端点"""
-    return {"status": "healthy", "service": "anthropic2openai-proxy"}
+    now = time.monotonic()
+    healthy = sum(1 for backend in backend_pool.backends if backend.healthy(now))
+    return {
+        "status": "healthy" if healthy else "degraded",
+        "service": "anthropic2openai-proxy",
+        "backends": {"total": len(backend_pool.backends), "healthy": healthy},
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """各后端延迟 / 错误 / 冷却状态"""
+    return {"backends": backend_pool.snapshot()}
 
 
 @app.get("/v1/models")
@@ -286,31 +772,27 @@ async def list_models():
     }
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    """关闭时清理资源"""
-    await http_client.aclose()
-
-
 if __name__ == "__main__":
+    backend_list = ", ".join(backend.base_url for backend in backend_pool.backends)
     print(f"""
 ╔═══════════════════════════════════════════════════════════════════╗
 ║           Anthropic 转 OpenAI 协议转换代理服务器                  ║
 ╠═══════════════════════════════════════════════════════════════════╣
-║  监听地址: http://0.0.0.0:{PROXY_PORT}                                  ║
-║  后端服务: {OPENAI_API_BASE}            ║
+║  监听地址: http://{HOST}:{PROXY_PORT}
+║  后端服务: {backend_list}
 ╠═══════════════════════════════════════════════════════════════════╣
 ║  调用链路:                                                        ║
 ║    aa.py (Anthropic SDK)                                          ║
 ║        ↓                                                          ║
 ║    本代理服务 (协议转换: Anthropic -> OpenAI)                     ║
 ║        ↓                                                          ║
-║    {OPENAI_API_BASE} (OpenAI 后端)         ║
+║    OpenAI 兼容后端 (按 TTFB 选择最快的健康后端)                   ║
 ╠═══════════════════════════════════════════════════════════════════╣
 ║  API 端点:                                                        ║
 ║    POST /v1/messages  - Anthropic 消息接口                        ║
 ║    GET  /health       - 健康检查                                  ║
 ║    GET  /v1/models    - 模型列表                                  ║
+║    GET  /metrics      - 各后端延迟与错误统计                      ║
 ╚═══════════════════════════════════════════════════════════════════╝
 """)
-    uvicorn.run(app, host="0.0.0.0", port=PROXY_PORT)
+    uvicorn.run(app, host=HOST, port=PROXY_PORT)
@@ -30,6 +30,9 @@ from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import StreamingResponse, JSONResponse
 
+from model_catalog import ModelCatalog
+from request_offload import LoopLagMonitor, RequestOffloader, encode_json
+
 # 加载 .env 文件
 load_dotenv()
 
@@ -76,6 +79,9 @@ class RequestLoadBalancer:
 
 # 全局 HTTP 客户端
 http_client: httpx.AsyncClient | None = None
+model_catalog = ModelCatalog.from_env(NODE_PROXY_URL)
+offloader = RequestOffloader.from_env()
+loop_monitor = LoopLagMonitor()
 
 
 def get_client() -> httpx.AsyncClient:
@@ -125,7 +131,12 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     http_client = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
     logger.info("Started: Node.js SDK proxy mode enabled")
     logger.info("Node.js proxy URL: %s", NODE_PROXY_URL)
+    model_catalog.start(http_client)
+    loop_monitor.start()
     yield
+    await loop_monitor.stop()
+    await model_catalog.stop()
+    offloader.shutdown()
     await http_client.aclose()
 
 
@@ -159,8 +170,16 @@ def build_forwarding_headers(api_key: str, original_headers: dict[str, str] = No
     return headers
 
 
+def parse_request_body(raw_body: bytes) -> dict[str, Any]:
+    """解析请求体（大请求体在线程池中执行）"""
+    req = json.loads(raw_body)
+    if not isinstance(req, dict):
+        raise ValueError("request body must be a JSON object")
+    return req
+
+
 async def stream_response(
-    req: dict[str, Any],
+    body: bytes,
     account: Account,
     forwarding_headers: dict[str, str],
 ) -> AsyncGenerator[str, None]:
@@ -172,7 +191,7 @@ async def stream_response(
             "POST",
             f"{NODE_PROXY_URL}/v1/messages",
             headers=forwarding_headers,
-            json=req
+            content=body
         ) as resp:
             if resp.status_code != 200:
                 error_text = await resp.aread()
@@ -209,9 +228,11 @@ async def messages(request: Request):
     if not account:
         raise HTTPException(status_code=401, detail={"type": "error", "error": {"type": "authentication_error", "message": "Invalid API key"}})
 
+    # 大请求体（如多张 base64 图片）的解析和序列化放到线程池，避免阻塞其它流
+    raw_body = await request.body()
     try:
-        req = await request.json()
-    except json.JSONDecodeError:
+        req = await offloader.run(len(raw_body), parse_request_body, raw_body)
+    except ValueError:
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
     # 记录完整的客户端请求信息（用于调试 Claude Code 请求特征）
@@ -229,6 +250,7 @@ async def messages(request: Request):
 
     req = ensure_metadata(req)
     req = ensure_max_tokens(req)
+    body = await offloader.run(len(raw_body), encode_json, req)
 
     # 构建转发头，透传客户端所有特殊头
     forwarding_headers = build_forwarding_headers(account.api_key, original_headers)
@@ -239,7 +261,7 @@ async def messages(request: Request):
 
     if is_stream:
         return StreamingResponse(
-            stream_response(req, account, forwarding_headers),
+            stream_response(body, account, forwarding_headers),
             media_type="text/event-stream",
             headers={"Cache-Control": "no-cache", "Connection": "keep-alive", "X-Accel-Buffering": "no"},
         )
@@ -249,7 +271,7 @@ async def messages(request: Request):
             resp = await client.post(
                 f"{NODE_PROXY_URL}/v1/messages",
                 headers=forwarding_headers,
-                json=req
+                content=body
             )
 
             if resp.status_code != 200:
@@ -266,17 +288,8 @@ async def messages(request: Request):
 
 @app.get("/v1/models")
 async def list_models(request: Request):
-    """列出可用模型"""
-    models = [
-        {"id": "claude-opus-4-5-20251101", "name": "Claude Opus 4.5"},
-        {"id": "claude-sonnet-4-5-20250929", "name": "Claude Sonnet 4.5"},
-        {"id": "claude-sonnet-4-20250514", "name": "Claude Sonnet 4"},
-        {"id": "claude-haiku-4-5-20251001", "name": "Claude Haiku 4.5"},
-        {"id": "claude-3-7-sonnet-20250219", "name": "Claude 3.7 Sonnet"},
-        {"id": "claude-3-5-sonnet-20241022", "name": "Claude 3.5 Sonnet"},
-        {"id": "claude-3-5-haiku-20241022", "name": "Claude 3.5 Haiku"},
-    ]
-    return {"data": models}
+    """列出可用模型（内存模型目录，支持 ETag / If-None-Match）"""
+    return model_catalog.response(request, "anthropic")
 
 
 @app.get("/health")
@@ -294,6 +307,15 @@ async def health():
         "mode": "node-proxy",
         "node_proxy": NODE_PROXY_URL,
         "node_status": node_status,
+        "model_catalog": model_catalog.status(),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "offload": offloader.stats(),
+        "event_loop": loop_monitor.stats(),
     }
 
 
@@ -329,6 +351,7 @@ if __name__ == "__main__":
 ╠══════════════════════════════════════════════════════════╣
 ║  管理接口:                                                ║
 ║    GET /health - 健康检查（含 Node.js 状态）              ║
+║    GET /metrics - 请求卸载与事件循环阻塞指标              ║
 ╚══════════════════════════════════════════════════════════╝
 """)
 
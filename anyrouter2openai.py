@@ -17,21 +17,27 @@ AnyRouter2OpenAI - OpenAI 协议代理服务（Node.js SDK 中转模式）
 4. 支持多 key 负载均衡: 用逗号分隔多个 key，如 "sk-key1,sk-key2"
 """
 
+import asyncio
 import json
 import logging
 import os
 import random
 import time
 import uuid
+from collections import OrderedDict, deque
 from collections.abc import AsyncGenerator
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, nullcontext
 from dataclasses import dataclass
+from functools import partial
 from typing import Any
 
 import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from model_catalog import ModelCatalog
+from request_offload import LoopLagMonitor, RequestOffloader, encode_json
 
 # 加载 .env 文件
 load_dotenv()
@@ -49,6 +55,25 @@ HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
 DEFAULT_MAX_TOKENS = int(os.getenv("DEFAULT_MAX_TOKENS", "8192"))
 FORCE_NON_STREAM = os.getenv("FORCE_NON_STREAM", "false").lower() in ("true", "1", "yes")
 DEFAULT_SYSTEM_PROMPT = os.getenv("DEFAULT_SYSTEM_PROMPT", "You are Claude, a helpful AI assistant.")
+# 上下文长度预检：reject 直接返回 context_length_exceeded，trim 丢弃最早的非 system 消息，off 关闭
+# 客户端可通过请求头 X-Context-Overflow 按请求选择策略
+CONTEXT_OVERFLOW_POLICY = os.getenv("CONTEXT_OVERFLOW_POLICY", "reject").strip().lower()
+# 为 Node.js 注入的 Claude Code 系统提示等预留的 token
+CONTEXT_RESERVED_TOKENS = int(os.getenv("CONTEXT_RESERVED_TOKENS", "4096"))
+IMAGE_TOKEN_ESTIMATE = 1600
+MESSAGE_TOKEN_OVERHEAD = 4
+CONTEXT_OVERFLOW_POLICIES = ("reject", "trim", "off")
+# 自适应流式：按模型统计上游流式失败率，失败率过高时临时改用非流式后端，并定期探测恢复
+STREAM_HEALTH_WINDOW = int(os.getenv("STREAM_HEALTH_WINDOW", "20"))
+STREAM_MIN_SAMPLES = int(os.getenv("STREAM_MIN_SAMPLES", "4"))
+STREAM_FAILURE_THRESHOLD = float(os.getenv("STREAM_FAILURE_THRESHOLD", "0.5"))
+STREAM_PROBE_INTERVAL = float(os.getenv("STREAM_PROBE_INTERVAL", "300"))
+# 跟踪的模型数上限（模型名由客户端传入，超出时淘汰最久未使用的模型）
+STREAM_MODE_MAX_MODELS = int(os.getenv("STREAM_MODE_MAX_MODELS", "256"))
+# n>1 并发扇出：单次请求允许的最大 n、单请求并发上限、全进程扇出并发上限
+MAX_CHOICES = int(os.getenv("MAX_CHOICES", "16"))
+FANOUT_PER_REQUEST_CONCURRENCY = int(os.getenv("FANOUT_PER_REQUEST_CONCURRENCY", "4"))
+FANOUT_GLOBAL_CONCURRENCY = int(os.getenv("FANOUT_GLOBAL_CONCURRENCY", "32"))
 
 
 @dataclass
@@ -80,8 +105,134 @@ class RequestLoadBalancer:
         return account
 
 
+class ModelStreamHealth:
+    """单个模型的上游流式健康状态"""
+
+    def __init__(self, window: int):
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.degraded = False
+        self.probing = False
+        self.probe_at = 0.0
+        self.degraded_since = 0.0
+        self.streamed = 0
+        self.buffered = 0
+        self.failures = 0
+        self.fallbacks = 0
+        self.probes = 0
+
+
+class StreamModeSelector:
+    """按模型自适应选择后端流式 / 非流式模式
+
+    最近 STREAM_HEALTH_WINDOW 次流式请求中失败率达到阈值时，该模型切换到非流式后端；
+    每隔 STREAM_PROBE_INTERVAL 秒放行一个流式请求作为探测，成功则恢复流式。
+    最多跟踪 max_models 个模型，按 LRU 淘汰，避免任意模型名撑大内存。
+    """
+
+    def __init__(
+        self,
+        window: int,
+        min_samples: int,
+        failure_threshold: float,
+        probe_interval: float,
+        max_models: int = 256,
+    ):
+        self.window = max(window, 1)
+        self.min_samples = max(min(min_samples, self.window), 1)
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.max_models = max(max_models, 1)
+        self._models: OrderedDict[str, ModelStreamHealth] = OrderedDict()
+
+    def _health(self, model: str) -> ModelStreamHealth:
+        health = self._models.get(model)
+        if health is None:
+            health = self._models[model] = ModelStreamHealth(self.window)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+        else:
+            self._models.move_to_end(model)
+        return health
+
+    def use_stream(self, model: str) -> bool:
+        health = self._health(model)
+        if not health.degraded:
+            health.streamed += 1
+            return True
+        if not health.probing and time.monotonic() >= health.probe_at:
+            health.probing = True
+            health.probes += 1
+            health.streamed += 1
+            logger.info("[stream-mode] %s probing upstream streaming", model)
+            return True
+        health.buffered += 1
+        return False
+
+    def record(self, model: str, ok: bool | None) -> None:
+        """记录一次流式请求结果；ok=None 表示无法判断（如客户端断开），只释放探测位"""
+        health = self._health(model)
+        if health.probing:
+            health.probing = False
+            if ok is None:
+                return
+            if ok:
+                health.degraded = False
+                health.outcomes.clear()
+                logger.info("[stream-mode] %s streaming recovered", model)
+            else:
+                health.failures += 1
+                health.probe_at = time.monotonic() + self.probe_interval
+            return
+        if ok is None:
+            return
+        if not ok:
+            health.failures += 1
+        health.outcomes.append(ok)
+        if health.degraded or len(health.outcomes) < self.min_samples:
+            return
+        failure_rate = health.outcomes.count(False) / len(health.outcomes)
+        if failure_rate >= self.failure_threshold:
+            health.degraded = True
+            health.degraded_since = time.time()
+            health.probe_at = time.monotonic() + self.probe_interval
+            health.fallbacks += 1
+            health.outcomes.clear()
+            logger.warning("[stream-mode] %s stream failure rate %.0f%%, falling back to buffered backend", model, failure_rate * 100)
+
+    def snapshot(self) -> dict[str, Any]:
+        now = time.monotonic()
+        result: dict[str, Any] = {}
+        for model, health in self._models.items():
+            recent = len(health.outcomes)
+            result[model] = {
+                "mode": "buffered" if health.degraded else "stream",
+                "probing": health.probing,
+                "next_probe_in": round(max(health.probe_at - now, 0), 1) if health.degraded else None,
+                "degraded_since": int(health.degraded_since) if health.degraded else None,
+                "recent_failure_rate": round(health.outcomes.count(False) / recent, 3) if recent else 0.0,
+                "streamed_requests": health.streamed,
+                "buffered_requests": health.buffered,
+                "stream_failures": health.failures,
+                "fallbacks": health.fallbacks,
+                "probes": health.probes,
+            }
+        return result
+
+
 # 全局变量
 http_client: httpx.AsyncClient | None = None
+# 所有 n>1 请求共享的扇出并发闸门，避免单个 n=16 请求占满上游
+fanout_semaphore = asyncio.Semaphore(FANOUT_GLOBAL_CONCURRENCY)
+model_catalog = ModelCatalog.from_env(NODE_PROXY_URL)
+offloader = RequestOffloader.from_env()
+loop_monitor = LoopLagMonitor()
+stream_selector = StreamModeSelector(
+    STREAM_HEALTH_WINDOW,
+    STREAM_MIN_SAMPLES,
+    STREAM_FAILURE_THRESHOLD,
+    STREAM_PROBE_INTERVAL,
+    STREAM_MODE_MAX_MODELS,
+)
 
 
 def get_client() -> httpx.AsyncClient:
@@ -111,7 +262,12 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     http_client = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
     logger.info("Started: Node.js SDK proxy mode enabled")
     logger.info("Node.js proxy URL: %s", NODE_PROXY_URL)
+    model_catalog.start(http_client)
+    loop_monitor.start()
     yield
+    await loop_monitor.stop()
+    await model_catalog.stop()
+    offloader.shutdown()
     await http_client.aclose()
 
 
@@ -154,6 +310,114 @@ def build_forwarding_headers(api_key: str, original_headers: dict[str, str] = No
     return headers
 
 
+def estimate_text_tokens(text: str) -> int:
+    # 英文约 4 字符 / token；中日韩等非 ASCII 字符约 1 字符 / token
+    if text.isascii():
+        return (len(text) + 3) // 4
+    non_ascii = (len(text.encode("utf-8")) - len(text)) // 2
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+def estimate_message_tokens(msg: dict[str, Any]) -> int:
+    """粗略估算单条消息的 token 数
+
+    ASCII 文本 O(1)（只看长度），其余只做一次编码，比为缓存计算哈希更便宜，因此不做缓存。
+    """
+    content = msg.get("content")
+    tokens = MESSAGE_TOKEN_OVERHEAD
+    if isinstance(content, str):
+        tokens += estimate_text_tokens(content)
+    elif isinstance(content, list):
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+            if item.get("type") == "text":
+                tokens += estimate_text_tokens(item.get("text", ""))
+            elif item.get("type") == "image_url":
+                tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+
+def requested_max_tokens(openai_request: dict[str, Any]) -> int:
+    """输出 token 上限：优先 max_completion_tokens，其次 max_tokens"""
+    for field_name in ("max_completion_tokens", "max_tokens"):
+        value = openai_request.get(field_name)
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    return DEFAULT_MAX_TOKENS
+
+
+def resolve_overflow_policy(request: Request) -> str:
+    policy = request.headers.get("x-context-overflow", CONTEXT_OVERFLOW_POLICY).strip().lower()
+    return policy if policy in CONTEXT_OVERFLOW_POLICIES else CONTEXT_OVERFLOW_POLICY
+
+
+class ContextLengthExceeded(Exception):
+    """预检判定请求超出模型上下文窗口"""
+
+    def __init__(self, context_window: int, estimated: int, budget: int):
+        super().__init__(
+            f"This model's maximum context length is {context_window} tokens. "
+            f"However, your messages resulted in about {estimated} tokens "
+            f"(about {budget} available for input after reserving room for the completion)."
+        )
+
+    def to_response(self) -> JSONResponse:
+        # 与 OpenAI 一致的顶层 error 结构，客户端可直接识别 context_length_exceeded
+        return JSONResponse(
+            status_code=400,
+            content={"error": {
+                "message": str(self),
+                "type": "invalid_request_error",
+                "param": "messages",
+                "code": "context_length_exceeded",
+            }},
+        )
+
+
+def preflight_context(openai_request: dict[str, Any], policy: str) -> int:
+    """上下文长度预检；超限时按策略拒绝或裁剪最早的非 system 消息，返回裁剪掉的消息数"""
+    messages = openai_request.get("messages")
+    if policy == "off" or not isinstance(messages, list) or not messages:
+        return 0
+
+    model = str(openai_request.get("model") or "")
+    context_window = model_catalog.context_window(model)
+    budget = context_window - requested_max_tokens(openai_request) - CONTEXT_RESERVED_TOKENS
+    costs = [estimate_message_tokens(msg) if isinstance(msg, dict) else 0 for msg in messages]
+    total = sum(costs)
+    if total <= budget:
+        return 0
+    if policy != "trim":
+        raise ContextLengthExceeded(context_window, total, budget)
+
+    # 从最早的非 system 消息开始丢弃，始终保留最后一条消息
+    keep = [True] * len(messages)
+    removable = [
+        i for i, msg in enumerate(messages[:-1])
+        if not (isinstance(msg, dict) and msg.get("role") in ("system", "developer"))
+    ]
+    for position, i in enumerate(removable):
+        keep[i] = False
+        total -= costs[i]
+        if total > budget:
+            continue
+        # Anthropic 要求对话以 user 消息开始，继续丢掉开头残留的 assistant / tool 消息
+        for j in removable[position + 1:]:
+            if messages[j].get("role") == "user":
+                break
+            keep[j] = False
+            total -= costs[j]
+        break
+    if total > budget:
+        raise ContextLengthExceeded(context_window, total, budget)
+
+    trimmed = keep.count(False)
+    openai_request["messages"] = [msg for msg, kept in zip(messages, keep) if kept]
+    logger.info("[context] %s trimmed %d messages to fit %d tokens (estimated %d)", model, trimmed, budget, total)
+    return trimmed
+
+
 def convert_message_content(content: str | list[dict[str, Any]]) -> list[dict[str, Any]]:
     """转换消息内容为 Anthropic 格式"""
     if isinstance(content, str):
@@ -200,7 +464,7 @@ def convert_openai_to_anthropic(openai_request: dict[str, Any]) -> dict[str, Any
     anthropic_request: dict[str, Any] = {
         "model": openai_request.get("model"),
         "messages": chat_messages,
-        "max_tokens": openai_request.get("max_tokens", DEFAULT_MAX_TOKENS),
+        "max_tokens": requested_max_tokens(openai_request),
         "stream": True,
     }
 
@@ -218,6 +482,17 @@ def convert_openai_to_anthropic(openai_request: dict[str, Any]) -> dict[str, Any
     return anthropic_request
 
 
+def parse_and_convert_request(
+    raw_body: bytes, overflow_policy: str
+) -> tuple[dict[str, Any], dict[str, Any], int]:
+    """解析 OpenAI 请求体、做上下文预检并转换为 Anthropic 请求（可能在线程池中执行）"""
+    openai_request = json.loads(raw_body)
+    if not isinstance(openai_request, dict):
+        raise ValueError("request body must be a JSON object")
+    trimmed = preflight_context(openai_request, overflow_policy)
+    return openai_request, convert_openai_to_anthropic(openai_request), trimmed
+
+
 def convert_anthropic_response_to_openai(
     anthropic_response: dict[str, Any], model: str, request_id: str
 ) -> dict[str, Any]:
@@ -242,7 +517,13 @@ def convert_anthropic_response_to_openai(
     }
 
 
-def create_stream_chunk(request_id: str, model: str, content: str | None = None, finish_reason: str | None = None) -> dict[str, Any]:
+def create_stream_chunk(
+    request_id: str,
+    model: str,
+    content: str | None = None,
+    finish_reason: str | None = None,
+    index: int = 0,
+) -> dict[str, Any]:
     delta: dict[str, Any] = {}
     if content is not None:
         delta["content"] = content
@@ -251,28 +532,92 @@ def create_stream_chunk(request_id: str, model: str, content: str | None = None,
         "object": "chat.completion.chunk",
         "created": int(time.time()),
         "model": model,
-        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}],
     }
 
 
+def create_usage_chunk(request_id: str, model: str, usage: dict[str, int]) -> dict[str, Any]:
+    """stream_options.include_usage 要求的末尾 usage chunk（choices 为空）"""
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    return {
+        "id": request_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def create_error_event(message: str, error_type: str, index: int = 0, code: int | None = None) -> str:
+    """SSE 错误事件；index 标明 n>1 扇出中出错的是哪个 choice"""
+    error: dict[str, Any] = {"message": message, "type": error_type, "index": index}
+    if code is not None:
+        error["code"] = code
+    return f"data: {json.dumps({'error': error})}\n\n"
+
+
+def add_usage(usage: dict[str, int] | None, anthropic_usage: dict[str, Any]) -> None:
+    """把 Anthropic usage 累加到 OpenAI 风格的 usage 计数中"""
+    if usage is None:
+        return
+    usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + int(anthropic_usage.get("input_tokens") or 0)
+    usage["completion_tokens"] = usage.get("completion_tokens", 0) + int(anthropic_usage.get("output_tokens") or 0)
+
+
+def parse_choice_count(openai_request: dict[str, Any]) -> int:
+    """读取并校验 OpenAI 的 n 参数"""
+    n = openai_request.get("n")
+    if n is None:
+        return 1
+    if isinstance(n, bool) or not isinstance(n, int) or n < 1 or n > MAX_CHOICES:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": {
+                "message": f"n must be an integer between 1 and {MAX_CHOICES}",
+                "type": "invalid_request_error",
+                "param": "n",
+            }},
+        )
+    return n
+
+
 async def stream_response(
-    anthropic_request: dict[str, Any],
+    anthropic_body: bytes,
     account: Account,
     headers: dict[str, str],
     request_id: str,
-    model: str
+    model: str,
+    index: int = 0,
+    usage: dict[str, int] | None = None,
+    emit_done: bool = True,
+    outcomes: list[bool | None] | None = None,
 ) -> AsyncGenerator[str, None]:
-    """处理流式响应"""
+    """处理流式响应
+
+    index/usage/emit_done 供 n>1 扇出使用：chunk 带上对应的 choices[].index，
+    usage 累加到共享计数，[DONE] 由扇出层统一发送。
+    结束时把流式是否成功反馈给 stream_selector（4xx 属于请求本身的问题，不计入）；
+    传入 outcomes 时只追加结果，由扇出层对整个请求汇总记录一次。
+    """
     client = get_client()
+    stream_ok: bool | None = None
 
     try:
         async with client.stream(
-            "POST", f"{NODE_PROXY_URL}/v1/messages", headers=headers, json=anthropic_request
+            "POST", f"{NODE_PROXY_URL}/v1/messages", headers=headers, content=anthropic_body
         ) as resp:
             if resp.status_code != 200:
                 error_text = await resp.aread()
+                if resp.status_code >= 500:
+                    stream_ok = False
                 logger.error("[%s] Error %d: %s", account.name, resp.status_code, error_text.decode()[:200])
-                yield f"data: {json.dumps({'error': {'message': error_text.decode(), 'type': 'api_error', 'code': resp.status_code}})}\n\n"
+                yield create_error_event(error_text.decode(), "api_error", index, resp.status_code)
                 return
 
             async for line in resp.aiter_lines():
@@ -286,67 +631,195 @@ async def stream_response(
                     if event_type == "content_block_delta":
                         delta = event.get("delta", {})
                         if delta.get("type") == "text_delta":
-                            chunk = create_stream_chunk(request_id, model, content=delta.get("text", ""))
+                            chunk = create_stream_chunk(request_id, model, content=delta.get("text", ""), index=index)
                             yield f"data: {json.dumps(chunk)}\n\n"
+                    elif event_type == "message_start":
+                        add_usage(usage, event.get("message", {}).get("usage", {}))
+                    elif event_type == "message_delta":
+                        add_usage(usage, {"output_tokens": event.get("usage", {}).get("output_tokens", 0)})
                     elif event_type == "message_stop":
-                        chunk = create_stream_chunk(request_id, model, finish_reason="stop")
+                        if stream_ok is None:
+                            stream_ok = True
+                        chunk = create_stream_chunk(request_id, model, finish_reason="stop", index=index)
                         yield f"data: {json.dumps(chunk)}\n\n"
-                        yield "data: [DONE]\n\n"
+                        if emit_done:
+                            yield "data: [DONE]\n\n"
                     elif event_type == "error":
+                        stream_ok = False
                         error_msg = event.get("error", {}).get("message", "Unknown error")
                         logger.error("[%s] Stream error: %s", account.name, error_msg)
-                        yield f"data: {json.dumps({'error': {'message': error_msg, 'type': 'stream_error'}})}\n\n"
+                        yield create_error_event(error_msg, "stream_error", index)
                 except json.JSONDecodeError:
                     continue
 
+            if stream_ok is None:
+                # 上游流正常关闭却没有 message_stop，视为流式异常
+                stream_ok = False
+
     except httpx.TimeoutException:
+        stream_ok = False
         logger.error("[%s] Timeout", account.name)
-        yield f"data: {json.dumps({'error': {'message': 'Request timeout', 'type': 'timeout_error'}})}\n\n"
+        yield create_error_event("Request timeout", "timeout_error", index)
     except httpx.HTTPError as e:
+        stream_ok = False
         logger.error("[%s] HTTP error: %s", account.name, str(e))
-        yield f"data: {json.dumps({'error': {'message': str(e), 'type': 'http_error'}})}\n\n"
+        yield create_error_event(str(e), "http_error", index)
+    finally:
+        if outcomes is None:
+            stream_selector.record(model, stream_ok)
+        else:
+            outcomes.append(stream_ok)
 
 
 async def stream_from_non_stream(
-    anthropic_request: dict[str, Any],
+    anthropic_body: bytes,
     account: Account,
     headers: dict[str, str],
     request_id: str,
-    model: str
+    model: str,
+    index: int = 0,
+    usage: dict[str, int] | None = None,
+    emit_done: bool = True,
 ) -> AsyncGenerator[str, None]:
     """非流式后端 + 流式前端"""
     client = get_client()
 
     try:
-        resp = await client.post(f"{NODE_PROXY_URL}/v1/messages", headers=headers, json=anthropic_request)
+        resp = await client.post(f"{NODE_PROXY_URL}/v1/messages", headers=headers, content=anthropic_body)
 
         if resp.status_code != 200:
             logger.error("[%s] Error %d: %s", account.name, resp.status_code, resp.text[:200])
-            yield f"data: {json.dumps({'error': {'message': resp.text, 'type': 'api_error', 'code': resp.status_code}})}\n\n"
+            yield create_error_event(resp.text, "api_error", index, resp.status_code)
             return
 
         anthropic_response = resp.json()
+        add_usage(usage, anthropic_response.get("usage", {}))
         content = "".join(
             block.get("text", "") for block in anthropic_response.get("content", [])
             if block.get("type") == "text"
         )
 
         if content:
-            yield f"data: {json.dumps(create_stream_chunk(request_id, model, content=content))}\n\n"
+            yield f"data: {json.dumps(create_stream_chunk(request_id, model, content=content, index=index))}\n\n"
 
-        yield f"data: {json.dumps(create_stream_chunk(request_id, model, finish_reason='stop'))}\n\n"
-        yield "data: [DONE]\n\n"
+        yield f"data: {json.dumps(create_stream_chunk(request_id, model, finish_reason='stop', index=index))}\n\n"
+        if emit_done:
+            yield "data: [DONE]\n\n"
 
     except httpx.TimeoutException:
         logger.error("[%s] Timeout", account.name)
-        yield f"data: {json.dumps({'error': {'message': 'Request timeout', 'type': 'timeout_error'}})}\n\n"
+        yield create_error_event("Request timeout", "timeout_error", index)
     except httpx.HTTPError as e:
         logger.error("[%s] HTTP error: %s", account.name, str(e))
-        yield f"data: {json.dumps({'error': {'message': str(e), 'type': 'http_error'}})}\n\n"
+        yield create_error_event(str(e), "http_error", index)
+
+
+async def stream_fanout_response(
+    anthropic_body: bytes,
+    accounts: list[Account],
+    headers_list: list[dict[str, str]],
+    request_id: str,
+    model: str,
+    use_non_stream_backend: bool,
+    include_usage: bool,
+) -> AsyncGenerator[str, None]:
+    """n 个 choice 并发请求上游，按到达顺序合并为一条 SSE 流"""
+    n = len(accounts)
+    # use_stream 每个请求只调用一次，所以 n 个 choice 的流式结果汇总后也只 record 一次
+    outcomes: list[bool | None] = []
+    if use_non_stream_backend:
+        handler = stream_from_non_stream
+    else:
+        handler = partial(stream_response, outcomes=outcomes)
+    queue: asyncio.Queue[str | None] = asyncio.Queue()
+    usage: dict[str, int] = {"prompt_tokens": 0, "completion_tokens": 0}
+    request_limiter = asyncio.Semaphore(FANOUT_PER_REQUEST_CONCURRENCY)
+
+    async def run_choice(index: int) -> None:
+        try:
+            # n=1 时（仅为 include_usage 走到这里）不占用扇出并发配额
+            async with (request_limiter if n > 1 else nullcontext()), (fanout_semaphore if n > 1 else nullcontext()):
+                async for chunk in handler(
+                    anthropic_body, accounts[index], headers_list[index], request_id, model,
+                    index=index, usage=usage, emit_done=False,
+                ):
+                    queue.put_nowait(chunk)
+        finally:
+            queue.put_nowait(None)
+
+    tasks = [asyncio.create_task(run_choice(index)) for index in range(n)]
+    try:
+        remaining = n
+        while remaining:
+            chunk = await queue.get()
+            if chunk is None:
+                remaining -= 1
+                continue
+            yield chunk
+        if include_usage:
+            yield f"data: {json.dumps(create_usage_chunk(request_id, model, usage))}\n\n"
+        yield "data: [DONE]\n\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+        if not use_non_stream_backend:
+            # 任一 choice 失败即记失败；全部成功才记成功；其余（4xx、客户端断开）不计入
+            if False in outcomes:
+                stream_selector.record(model, False)
+            elif len(outcomes) == n and all(outcomes):
+                stream_selector.record(model, True)
+            else:
+                stream_selector.record(model, None)
+
+
+async def complete_fanout_response(
+    anthropic_body: bytes,
+    accounts: list[Account],
+    headers_list: list[dict[str, str]],
+    request_id: str,
+    model: str,
+) -> dict[str, Any]:
+    """非流式 n>1：并发获取 n 个回答，合并 choices 并累加 usage"""
+    client = get_client()
+    request_limiter = asyncio.Semaphore(FANOUT_PER_REQUEST_CONCURRENCY)
+
+    async def run_choice(index: int) -> dict[str, Any]:
+        async with request_limiter, fanout_semaphore:
+            resp = await client.post(f"{NODE_PROXY_URL}/v1/messages", headers=headers_list[index], content=anthropic_body)
+        if resp.status_code != 200:
+            logger.error("[%s] Error %d", accounts[index].name, resp.status_code)
+            raise HTTPException(status_code=resp.status_code, detail=resp.text)
+        return resp.json()
+
+    results = await asyncio.gather(*(run_choice(index) for index in range(len(accounts))), return_exceptions=True)
+    for result in results:
+        if isinstance(result, httpx.TimeoutException):
+            raise HTTPException(status_code=504, detail="Request timeout")
+        if isinstance(result, httpx.HTTPError):
+            raise HTTPException(status_code=502, detail=str(result))
+        if isinstance(result, BaseException):
+            raise result
+
+    usage: dict[str, int] = {"prompt_tokens": 0, "completion_tokens": 0}
+    choices: list[dict[str, Any]] = []
+    for index, anthropic_response in enumerate(results):
+        add_usage(usage, anthropic_response.get("usage", {}))
+        choice = convert_anthropic_response_to_openai(anthropic_response, model, request_id)["choices"][0]
+        choice["index"] = index
+        choices.append(choice)
+
+    return {
+        "id": request_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": choices,
+        "usage": {**usage, "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"]},
+    }
 
 
 @app.post("/v1/chat/completions", response_model=None)
-async def chat_completions(request: Request):
+async def chat_completions(request: Request, response: Response):
     """OpenAI 兼容的 chat completions 接口"""
     # 提取并验证 API keys
     api_keys = extract_api_keys(request)
@@ -362,8 +835,19 @@ async def chat_completions(request: Request):
     if not account:
         raise HTTPException(status_code=401, detail={"error": {"message": "Invalid API key", "type": "authentication_error"}})
 
-    openai_request = await request.json()
-    anthropic_request = convert_openai_to_anthropic(openai_request)
+    # 大请求体的解析与转换放到线程池，避免阻塞其它流
+    raw_body = await request.body()
+    try:
+        openai_request, anthropic_request, trimmed = await offloader.run(
+            len(raw_body), parse_and_convert_request, raw_body, resolve_overflow_policy(request)
+        )
+    except ContextLengthExceeded as exc:
+        return exc.to_response()
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail={"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}}
+        )
 
     # 记录完整的客户端请求信息（用于调试）
     original_headers = dict(request.headers)
@@ -381,24 +865,48 @@ async def chat_completions(request: Request):
     request_id = generate_request_id()
     model = openai_request.get("model", "unknown")
     is_stream = openai_request.get("stream", True)
+    n = parse_choice_count(openai_request)
+    include_usage = bool((openai_request.get("stream_options") or {}).get("include_usage"))
 
-    use_non_stream_backend = FORCE_NON_STREAM or not is_stream
+    # FORCE_NON_STREAM 仍可作为全局强制开关；否则按模型的上游流式健康状况自适应选择
+    use_non_stream_backend = not is_stream or FORCE_NON_STREAM or not stream_selector.use_stream(model)
     if use_non_stream_backend:
         anthropic_request['stream'] = False
-
-    logger.info("[%s] %s stream=%s backend_stream=%s", account.name, model, is_stream, not use_non_stream_backend)
+    anthropic_body = await offloader.run(len(raw_body), encode_json, anthropic_request)
+
+    logger.info("[%s] %s stream=%s backend_stream=%s n=%d", account.name, model, is_stream, not use_non_stream_backend, n)
+
+    stream_headers = {"Cache-Control": "no-cache", "Connection": "keep-alive"}
+    if trimmed:
+        stream_headers["X-Context-Trimmed-Messages"] = str(trimmed)
+        response.headers["X-Context-Trimmed-Messages"] = str(trimmed)
+
+    if n > 1 or (is_stream and include_usage):
+        # 每个 choice 轮询选择一个客户端 key，把扇出压力分摊到整个 key 池
+        accounts = [account] + [lb.select_account() for _ in range(n - 1)]
+        headers_list = [build_forwarding_headers(acc.api_key, original_headers) for acc in accounts]
+        if is_stream:
+            return StreamingResponse(
+                stream_fanout_response(
+                    anthropic_body, accounts, headers_list, request_id, model,
+                    use_non_stream_backend, include_usage,
+                ),
+                media_type="text/event-stream",
+                headers=stream_headers,
+            )
+        return await complete_fanout_response(anthropic_body, accounts, headers_list, request_id, model)
 
     if is_stream:
         handler = stream_from_non_stream if use_non_stream_backend else stream_response
         return StreamingResponse(
-            handler(anthropic_request, account, forwarding_headers, request_id, model),
+            handler(anthropic_body, account, forwarding_headers, request_id, model),
             media_type="text/event-stream",
-            headers={"Cache-Control": "no-cache", "Connection": "keep-alive"},
+            headers=stream_headers,
         )
     else:
         client = get_client()
         try:
-            resp = await client.post(f"{NODE_PROXY_URL}/v1/messages", headers=forwarding_headers, json=anthropic_request)
+            resp = await client.post(f"{NODE_PROXY_URL}/v1/messages", headers=forwarding_headers, content=anthropic_body)
             if resp.status_code != 200:
                 logger.error("[%s] Error %d", account.name, resp.status_code)
                 raise HTTPException(status_code=resp.status_code, detail=resp.text)
@@ -411,31 +919,13 @@ async def chat_completions(request: Request):
 
 @app.get("/v1/models")
 async def list_models(request: Request):
-    """列出可用模型"""
-    api_keys = extract_api_keys(request)
-    if not api_keys:
+    """列出可用模型（内存模型目录，支持 ETag / If-None-Match）"""
+    if not extract_api_keys(request):
         raise HTTPException(
             status_code=401,
             detail={"error": {"message": "Authorization header required", "type": "authentication_error"}}
         )
-
-    lb = RequestLoadBalancer(api_keys)
-    account = lb.select_account()
-    if not account:
-        raise HTTPException(status_code=401, detail={"error": {"message": "Invalid API key", "type": "authentication_error"}})
-
-    original_headers = dict(request.headers)
-    forwarding_headers = build_forwarding_headers(account.api_key, original_headers)
-    client = get_client()
-    try:
-        resp = await client.get(f"{NODE_PROXY_URL}/v1/models", headers=forwarding_headers)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        return {"object": "list", "data": resp.json().get("data", [])}
-    except httpx.TimeoutException:
-        raise HTTPException(status_code=504, detail="Request timeout")
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=502, detail=str(e))
+    return model_catalog.response(request, "openai")
 
 
 @app.get("/health")
@@ -453,6 +943,17 @@ async def health():
         "mode": "node-proxy",
         "node_proxy": NODE_PROXY_URL,
         "node_status": node_status,
+        "model_catalog": model_catalog.status(),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "stream_modes": stream_selector.snapshot(),
+        "force_non_stream": FORCE_NON_STREAM,
+        "offload": offloader.stats(),
+        "event_loop": loop_monitor.stats(),
     }
 
 
@@ -488,6 +989,7 @@ if __name__ == "__main__":
 ╠══════════════════════════════════════════════════════════╣
 ║  管理接口:                                                ║
 ║    GET /health - 健康检查（含 Node.js 状态）              ║
+║    GET /metrics - 流式模式等运行指标                      ║
 ╚══════════════════════════════════════════════════════════╝
 """)
 
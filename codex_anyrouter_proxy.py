@@ -11,28 +11,47 @@ Flow:
 
 import asyncio
 import base64
+import fnmatch
 import hashlib
+import heapq
 import hmac
+import ipaddress
+import itertools
 import json
 import logging
+import math
+import mmap
 import os
+import random
+import re
 import secrets
+import shutil
+import socket
+import sqlite3
+import tempfile
 import time
+import urllib.request
 import uuid
-from collections.abc import AsyncGenerator
-from contextlib import asynccontextmanager
-from datetime import datetime
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from collections.abc import AsyncGenerator, Callable
+from contextlib import aclosing, asynccontextmanager
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-from threading import RLock
+from threading import Lock
 from typing import Any
 
 import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
 from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
+from model_catalog import etag_matches
+
 load_dotenv()
 
 logging.basicConfig(
@@ -46,9 +65,111 @@ DEFAULT_CODEX_PROXY_MODEL = "gpt-5.5"
 DEFAULT_ADMIN_USERNAME = "admin"
 DEFAULT_ADMIN_PASSWORD = "changeme"
 HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "300"))
+# Upstream connection pool: HTTP/2 needs the optional h2 package (pip install "httpx[http2]").
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").strip().lower() in ("true", "1", "yes", "on")
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY_SECONDS", "90"))
+# Connections opened at startup and kept warm by idle pings (0 disables both).
+UPSTREAM_PREWARM_CONNECTIONS = int(os.getenv("UPSTREAM_PREWARM_CONNECTIONS", "2"))
+UPSTREAM_KEEPALIVE_INTERVAL_SECONDS = float(os.getenv("UPSTREAM_KEEPALIVE_INTERVAL_SECONDS", "30"))
+UPSTREAM_DNS_TTL_SECONDS = float(os.getenv("UPSTREAM_DNS_TTL_SECONDS", "300"))
 ADMIN_TOKEN_TTL_SECONDS = int(os.getenv("ADMIN_TOKEN_TTL_SECONDS", "86400"))
 ADMIN_TOKEN_SECRET = os.getenv("ADMIN_TOKEN_SECRET") or secrets.token_urlsafe(32)
 ADMIN_STATIC_DIR = Path(__file__).resolve().parent / "admin-static"
+# Upstream key scheduling: latency smoothing and cooldowns after 429 / auth failures / 5xx.
+KEY_EWMA_ALPHA = float(os.getenv("KEY_EWMA_ALPHA", "0.2"))
+KEY_RATE_LIMIT_COOLDOWN_SECONDS = float(os.getenv("KEY_RATE_LIMIT_COOLDOWN_SECONDS", "30"))
+KEY_AUTH_COOLDOWN_SECONDS = float(os.getenv("KEY_AUTH_COOLDOWN_SECONDS", "300"))
+KEY_FAILURE_COOLDOWN_SECONDS = float(os.getenv("KEY_FAILURE_COOLDOWN_SECONDS", "30"))
+KEY_FAILURE_THRESHOLD = int(os.getenv("KEY_FAILURE_THRESHOLD", "3"))
+KEY_MAX_COOLDOWN_SECONDS = 600.0
+KEY_DEFAULT_LATENCY_SECONDS = 1.0
+KEY_RECENT_WINDOW_SECONDS = 300.0
+# Background key prober: validates configured keys and quarantines revoked / out-of-credit ones.
+KEY_PROBE_INTERVAL_SECONDS = float(os.getenv("KEY_PROBE_INTERVAL_SECONDS", "300"))
+KEY_PROBE_CONCURRENCY = int(os.getenv("KEY_PROBE_CONCURRENCY", "4"))
+KEY_PROBE_PATH = os.getenv("KEY_PROBE_PATH", "models").strip("/")
+KEY_PROBE_TIMEOUT_SECONDS = 15.0
+KEY_QUARANTINE_STATUSES = (401, 402, 403)
+# Live traffic quarantines only on auth/credit errors: upstreams also answer 403 for per-request
+# policy or content reasons, so a 403 counts toward KEY_FAILURE_THRESHOLD like a 5xx instead.
+KEY_PASSIVE_QUARANTINE_STATUSES = (401, 402)
+# Proxy-key rpm / tpm limits (PROXY_API_KEY_META) refill over this window.
+RATE_LIMIT_WINDOW_SECONDS = 60.0
+# Global in-flight cap (0 = unlimited); above it requests queue per tenant and are admitted by weighted fair queuing.
+MAX_INFLIGHT_REQUESTS = int(os.getenv("MAX_INFLIGHT_REQUESTS", "0"))
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("QUEUE_TIMEOUT_SECONDS", "30"))
+QUEUE_MAX_PER_TENANT = int(os.getenv("QUEUE_MAX_PER_TENANT", "200"))
+
+# Request bodies that must be buffered (model rewrite, chat bridge) spill to a temp file above this size.
+MAX_IN_MEMORY_BODY_BYTES = int(os.getenv("MAX_IN_MEMORY_BODY_BYTES", str(4 * 1024 * 1024)))
+BODY_CHUNK_SIZE = 64 * 1024
+# Relay compressed upstream bodies untouched when the client accepts the encoding.
+UPSTREAM_COMPRESSION_PASSTHROUGH = os.getenv("UPSTREAM_COMPRESSION_PASSTHROUGH", "true").strip().lower() in (
+    "true", "1", "yes", "on"
+)
+
+# Bridged chat conversations keep a stable Codex session (and prompt_cache_key) for this long after their last turn.
+CHAT_SESSION_TTL_SECONDS = float(os.getenv("CHAT_SESSION_TTL_SECONDS", "3600"))
+CHAT_SESSION_MAX_ENTRIES = int(os.getenv("CHAT_SESSION_MAX_ENTRIES", "10000"))
+
+# Local Responses conversation store backing previous_response_id (0 bytes disables it).
+RESPONSE_STORE_MAX_BYTES = int(os.getenv("RESPONSE_STORE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_STORE_TTL_SECONDS = float(os.getenv("RESPONSE_STORE_TTL_SECONDS", "3600"))
+RESPONSE_STORE_SPILL_DIR = os.getenv("RESPONSE_STORE_SPILL_DIR", "").strip()
+RESPONSE_STORE_MAX_DISK_BYTES = int(os.getenv("RESPONSE_STORE_MAX_DISK_BYTES", str(1024 * 1024 * 1024)))
+
+# Idempotency-Key replay cache for POSTs: retries attach to the in-flight request or replay its result (0 TTL disables it).
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "1000"))
+IDEMPOTENCY_MAX_BYTES = int(os.getenv("IDEMPOTENCY_MAX_BYTES", str(64 * 1024 * 1024)))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# WebSocket transport for /v1/responses: connections idle this long between turns are closed (0 disables).
+RESPONSES_WEBSOCKET_IDLE_SECONDS = float(os.getenv("RESPONSES_WEBSOCKET_IDLE_SECONDS", "600"))
+
+# Usage accounting: per-minute aggregates flushed to SQLite (empty path disables it).
+USAGE_DB_PATH = os.getenv(
+    "USAGE_DB_PATH",
+    str(Path(os.getenv("ENV_FILE_PATH", Path(__file__).resolve().parent / ".env")).parent / "usage.sqlite3"),
+).strip()
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+USAGE_RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", "90"))
+# Aggregates kept in memory while the database cannot be written; new ones are dropped past this.
+USAGE_MAX_PENDING = int(os.getenv("USAGE_MAX_PENDING", "100000"))
+
+# Cache for idempotent upstream GETs (fnmatch patterns relative to /v1; empty disables it).
+UPSTREAM_CACHE_PATHS = tuple(
+    item.strip().strip("/") for item in os.getenv("UPSTREAM_CACHE_PATHS", "models,models/*").split(",") if item.strip()
+)
+UPSTREAM_CACHE_TTL_SECONDS = float(os.getenv("UPSTREAM_CACHE_TTL_SECONDS", "60"))
+# Past the TTL, a stale entry is still served for this long while one background request revalidates it.
+UPSTREAM_CACHE_STALE_SECONDS = float(os.getenv("UPSTREAM_CACHE_STALE_SECONDS", "600"))
+UPSTREAM_CACHE_MAX_ENTRIES = int(os.getenv("UPSTREAM_CACHE_MAX_ENTRIES", "256"))
+
+# Shared runtime config store: SQLite (WAL) polled by every worker (empty path writes .env directly).
+CONFIG_DB_PATH = os.getenv(
+    "CONFIG_DB_PATH",
+    str(Path(os.getenv("ENV_FILE_PATH", Path(__file__).resolve().parent / ".env")).parent / "config.sqlite3"),
+).strip()
+CONFIG_POLL_SECONDS = float(os.getenv("CONFIG_POLL_SECONDS", "1"))
+CONFIG_HISTORY_LIMIT = int(os.getenv("CONFIG_HISTORY_LIMIT", "50"))
+
+# Settings owned by RuntimeConfig; the only keys imported into / exported from the config store.
+CONFIG_KEYS = (
+    "ANYROUTER_OPENAI_BASE_URL",
+    "ANYROUTER_API_KEY",
+    "ANYROUTER_API_KEY_WEIGHTS",
+    "ANYROUTER_KEY_POOLS",
+    "PROXY_API_KEY",
+    "PROXY_API_KEYS",
+    "PROXY_API_KEY_META",
+    "CODEX_PROXY_MODEL",
+    "CODEX_PROXY_FORCE_MODEL",
+    "ADMIN_USERNAME",
+    "ADMIN_PASSWORD",
+)
 
 CREATE_ENDPOINTS_WITH_MODEL = {
     "responses",
@@ -97,19 +218,9 @@ class EnvFile:
         return self.path.is_file()
 
     def read(self) -> dict[str, str]:
-        result: dict[str, str] = {}
         if not self.exists():
-            return result
-        for raw_line in self.path.read_text(encoding="utf-8").splitlines():
-            line = raw_line.strip()
-            if not line or line.startswith("#") or "=" not in line:
-                continue
-            key, value = line.split("=", 1)
-            key = key.strip()
-            value = value.strip().strip("'\"")
-            if key:
-                result[key] = value
-        return result
+            return {}
+        return parse_env_text(self.path.read_text(encoding="utf-8"))
 
     def set_many(self, items: dict[str, str]) -> None:
         self.path.parent.mkdir(parents=True, exist_ok=True)
@@ -147,29 +258,459 @@ class EnvFile:
         os.replace(tmp_path, self.path)
 
     def _backup(self) -> None:
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        backup_path = self.path.with_name(f"{self.path.name}.backup.{timestamp}")
+        # A single rolling copy of the previous version; the config store keeps the real history.
+        backup_path = self.path.with_name(f"{self.path.name}.backup")
         backup_path.write_text(self.path.read_text(encoding="utf-8"), encoding="utf-8")
 
 
-class RuntimeConfig:
-    """Runtime settings shared by the proxy and admin API."""
+def parse_env_text(text: str) -> dict[str, str]:
+    result: dict[str, str] = {}
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        key = key.strip()
+        value = value.strip().strip("'\"")
+        if key:
+            result[key] = value
+    return result
+
+
+def render_env_text(items: dict[str, str]) -> str:
+    return "".join(f"{key}={value}\n" for key, value in items.items())
+
+
+class ConfigConflict(RuntimeError):
+    """Another worker committed a config change since this process last loaded."""
+
+
+class ConfigStore:
+    """Runtime settings in SQLite (WAL), shared by every worker process.
+
+    Each commit bumps a version counter and stores a full snapshot of the
+    settings in a bounded history table. Workers poll the counter (a single
+    primary-key lookup) and reload when it moves. Writes are compare-and-set
+    against the version this process last saw, so two workers editing at
+    once cannot silently overwrite each other. On first use the store
+    imports the managed keys from the .env file; afterwards, keys whose value
+    changes in .env are imported again (see sync_env_file), so hand edits are
+    not lost behind the store.
+    """
 
-    def __init__(self, env_file: EnvFile):
+    def __init__(self, path: str, env_file: "EnvFile", history_limit: int):
+        self.path = Path(path)
         self.env_file = env_file
-        self._lock = RLock()
-        self.upstream_base_url = DEFAULT_UPSTREAM_BASE_URL
-        self.api_keys: list[str] = []
-        self.proxy_api_keys: list[str] = []
-        self.model = DEFAULT_CODEX_PROXY_MODEL
-        self.force_model = False
-        self.admin_username = DEFAULT_ADMIN_USERNAME
-        self.admin_password = DEFAULT_ADMIN_PASSWORD
-        self.has_custom_admin_password = False
-        self.load()
-
-    def load(self) -> None:
-        env_data = self.env_file.read()
+        self.history_limit = max(history_limit, 1)
+        # Last store version this process read or wrote.
+        self.version = 0
+        self._connection: sqlite3.Connection | None = None
+        self._db_lock = Lock()
+        # .env mtime this process last compared against the store.
+        self._env_mtime: int | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+                connection.execute("PRAGMA journal_mode=WAL")
+            except (OSError, sqlite3.OperationalError) as exc:
+                raise RuntimeError(
+                    f"Cannot open config store {self.path}: {exc}. "
+                    "Its directory must be writable by the proxy's user (uid 1000 in the Docker image)."
+                ) from exc
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS history (
+                    version INTEGER PRIMARY KEY,
+                    changed_at INTEGER NOT NULL,
+                    note TEXT NOT NULL,
+                    changed_keys TEXT NOT NULL,
+                    snapshot TEXT NOT NULL
+                )
+                """
+            )
+            # The managed .env values last imported, to tell which keys a later .env edit changed.
+            connection.execute("CREATE TABLE IF NOT EXISTS env_import (id INTEGER PRIMARY KEY CHECK (id = 1), items TEXT NOT NULL)")
+            self._connection = connection
+            if self._current_version(connection) == 0:
+                try:
+                    items = env_file_items(self.env_file)
+                    self._commit(connection, items, f"import {self.env_file.path.name}", expected=0, env_items=items)
+                except ConfigConflict:
+                    pass  # Another worker imported first.
+        return self._connection
+
+    @staticmethod
+    def _current_version(connection: sqlite3.Connection) -> int:
+        return connection.execute("SELECT COALESCE(MAX(version), 0) FROM history").fetchone()[0]
+
+    def _commit(
+        self,
+        connection: sqlite3.Connection,
+        items: dict[str, str],
+        note: str,
+        expected: int | None,
+        replace_all: bool = False,
+        env_items: dict[str, str] | None = None,
+    ) -> int:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = self._current_version(connection)
+            if expected is not None and version != expected:
+                raise ConfigConflict(f"config store is at version {version}, expected {expected}")
+            if env_items is not None:
+                self._save_env_import(connection, env_items)
+            version = self._write(connection, version, items, note, replace_all)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self.version = version
+        return version
+
+    def _write(self, connection: sqlite3.Connection, version: int, items: dict[str, str], note: str, replace_all: bool) -> int:
+        """Apply items on top of `version` inside the caller's transaction; returns the new version."""
+        if replace_all:
+            connection.execute("DELETE FROM settings")
+        connection.executemany(
+            "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            list(items.items()),
+        )
+        snapshot = dict(connection.execute("SELECT key, value FROM settings").fetchall())
+        version += 1
+        connection.execute(
+            "INSERT INTO history (version, changed_at, note, changed_keys, snapshot) VALUES (?, ?, ?, ?, ?)",
+            (version, int(time.time()), note, json.dumps(sorted(items)), json.dumps(snapshot, ensure_ascii=False)),
+        )
+        connection.execute("DELETE FROM history WHERE version <= ?", (version - self.history_limit,))
+        return version
+
+    @staticmethod
+    def _save_env_import(connection: sqlite3.Connection, items: dict[str, str]) -> None:
+        connection.execute(
+            "INSERT INTO env_import (id, items) VALUES (1, ?) ON CONFLICT (id) DO UPDATE SET items = excluded.items",
+            (json.dumps(items, ensure_ascii=False),),
+        )
+
+    def sync_env_file(self) -> list[str]:
+        """Import the managed keys whose .env value changed since the last import.
+
+        Checked by mtime, so it costs one stat() unless the file was touched.
+        Only keys edited in .env are written, which keeps admin changes to the
+        other keys; keys deleted from .env are left as they are in the store.
+        Returns the imported key names.
+        """
+        try:
+            mtime = self.env_file.path.stat().st_mtime_ns
+        except OSError:
+            return []
+        if mtime == self._env_mtime:
+            return []
+        items = env_file_items(self.env_file)
+        with self._db_lock:
+            connection = self._connect()
+            # One write transaction, so workers noticing the same edit import it once.
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT items FROM env_import WHERE id = 1").fetchone()
+                # A store created before imports were tracked takes the current file as its baseline.
+                previous = json.loads(row[0]) if row is not None else items
+                edited = {key: value for key, value in items.items() if previous.get(key) != value}
+                current = dict(connection.execute("SELECT key, value FROM settings").fetchall())
+                changed = {key: value for key, value in edited.items() if current.get(key) != value}
+                if changed:
+                    self._write(
+                        connection,
+                        self._current_version(connection),
+                        changed,
+                        f"import {self.env_file.path.name} changes",
+                        replace_all=False,
+                    )
+                if edited or row is None:
+                    self._save_env_import(connection, items)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        self._env_mtime = mtime
+        return sorted(changed)
+
+    def read(self) -> dict[str, str]:
+        with self._db_lock:
+            connection = self._connect()
+            # One read transaction, so the settings and the version match.
+            connection.execute("BEGIN")
+            try:
+                items = dict(connection.execute("SELECT key, value FROM settings").fetchall())
+                self.version = self._current_version(connection)
+            finally:
+                connection.execute("COMMIT")
+        return items
+
+    def set_many(self, items: dict[str, str], note: str = "admin") -> None:
+        with self._db_lock:
+            self._commit(self._connect(), items, note, expected=self.version)
+
+    def replace_all(self, items: dict[str, str], note: str) -> None:
+        with self._db_lock:
+            self._commit(self._connect(), items, note, expected=None, replace_all=True)
+
+    def changed(self) -> bool:
+        with self._db_lock:
+            return self._current_version(self._connect()) != self.version
+
+    def history(self) -> list[dict[str, Any]]:
+        with self._db_lock:
+            rows = self._connect().execute(
+                "SELECT version, changed_at, note, changed_keys FROM history ORDER BY version DESC"
+            ).fetchall()
+        return [
+            {"version": version, "changed_at": changed_at, "note": note, "changed_keys": json.loads(changed_keys)}
+            for version, changed_at, note, changed_keys in rows
+        ]
+
+    def restore(self, version: int) -> None:
+        with self._db_lock:
+            connection = self._connect()
+            row = connection.execute("SELECT snapshot FROM history WHERE version = ?", (version,)).fetchone()
+            if row is None:
+                raise ValueError(f"配置历史中没有版本 {version}")
+            self._commit(connection, json.loads(row[0]), f"rollback to {version}", expected=None, replace_all=True)
+
+    def close(self) -> None:
+        with self._db_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def env_file_items(env_file: "EnvFile") -> dict[str, str]:
+    """The RuntimeConfig-managed keys present in a .env file."""
+    data = env_file.read()
+    return {key: data[key] for key in CONFIG_KEYS if key in data}
+
+
+# Per-process secret for the proxy-key index; digests never leave memory.
+PROXY_KEY_INDEX_SECRET = secrets.token_bytes(32)
+
+
+def _optional_positive_int(value: Any) -> int | None:
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number > 0 else None
+
+
+def _positive_float(value: Any, default: float) -> float:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return default
+    return number if number > 0 else default
+
+
+def parse_proxy_key_meta(raw_value: str) -> dict[str, dict[str, Any]]:
+    """Parse PROXY_API_KEY_META: {"<proxy key>": {"tenant": "...", "rpm": 60, "tpm": 100000}}."""
+    if not raw_value.strip():
+        return {}
+    try:
+        data = json.loads(raw_value)
+    except json.JSONDecodeError as exc:
+        logger.warning("Ignoring invalid PROXY_API_KEY_META: %s", exc)
+        return {}
+    if not isinstance(data, dict):
+        logger.warning("Ignoring PROXY_API_KEY_META: expected a JSON object")
+        return {}
+    return {str(key): value for key, value in data.items() if isinstance(value, dict)}
+
+
+def serialize_proxy_key_meta(meta: dict[str, dict[str, Any]]) -> str:
+    return json.dumps(meta, ensure_ascii=False, separators=(",", ":")) if meta else ""
+
+
+def proxy_key_fingerprint(key: str) -> str:
+    return f"key-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:8]}"
+
+
+@dataclass(frozen=True)
+class KeyPool:
+    """A named subset of upstream keys reserved for the proxy keys assigned to it.
+
+    Members are upstream key fingerprints (proxy_key_fingerprint), so the pool
+    definition never repeats the secrets. With overflow enabled, requests spill
+    into the shared pool once every member is cooling down or quarantined.
+    """
+
+    name: str
+    keys: tuple[str, ...] = ()
+    overflow: bool = False
+
+
+def parse_key_pools(raw_value: str) -> tuple[KeyPool, ...]:
+    """Parse ANYROUTER_KEY_POOLS: {"<pool>": {"keys": ["key-1a2b3c4d", ...], "overflow": true}}."""
+    if not raw_value.strip():
+        return ()
+    try:
+        data = json.loads(raw_value)
+    except json.JSONDecodeError as exc:
+        logger.warning("Ignoring invalid ANYROUTER_KEY_POOLS: %s", exc)
+        return ()
+    if not isinstance(data, dict):
+        logger.warning("Ignoring ANYROUTER_KEY_POOLS: expected a JSON object")
+        return ()
+    pools: list[KeyPool] = []
+    for name, value in data.items():
+        if isinstance(value, list):
+            value = {"keys": value}
+        if not str(name).strip() or not isinstance(value, dict) or not isinstance(value.get("keys", []), list):
+            logger.warning("Ignoring ANYROUTER_KEY_POOLS entry %r", name)
+            continue
+        keys = tuple(dict.fromkeys(str(key).strip() for key in value.get("keys", []) if str(key).strip()))
+        pools.append(KeyPool(str(name).strip(), keys, bool(value.get("overflow", False))))
+    return tuple(pools)
+
+
+def serialize_key_pools(pools: tuple[KeyPool, ...]) -> str:
+    if not pools:
+        return ""
+    data = {pool.name: {"keys": list(pool.keys), "overflow": pool.overflow} for pool in pools}
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+@dataclass(frozen=True)
+class ProxyKeyInfo:
+    """Metadata attached to an accepted proxy key, available as request.state.proxy_key."""
+
+    key_id: str
+    tenant: str
+    rpm_limit: int | None = None
+    tpm_limit: int | None = None
+    weight: float = 1.0
+    # Upstream key pool name from ANYROUTER_KEY_POOLS; empty means the shared pool.
+    pool: str = ""
+    # Stable per-key secret (not the key itself) used to derive bridged chat session ids.
+    session_secret: bytes = field(default=b"", repr=False)
+
+
+class ProxyKeyIndex:
+    """Proxy keys indexed by keyed HMAC-SHA256 digest.
+
+    Lookup hashes the presented key once and does a single dict probe, so
+    cost does not grow with the number of configured keys. Digests are keyed
+    with a per-process secret, which keeps the probe timing useless to an
+    attacker.
+    """
+
+    def __init__(self, keys: tuple[str, ...] = (), meta: dict[str, dict[str, Any]] | None = None):
+        meta = meta or {}
+        self._entries: dict[bytes, ProxyKeyInfo] = {}
+        for key in keys:
+            key_meta = meta.get(key, {})
+            key_id = proxy_key_fingerprint(key)
+            self._entries[self.digest(key)] = ProxyKeyInfo(
+                key_id=key_id,
+                tenant=str(key_meta.get("tenant") or key_id),
+                rpm_limit=_optional_positive_int(key_meta.get("rpm")),
+                tpm_limit=_optional_positive_int(key_meta.get("tpm")),
+                weight=_positive_float(key_meta.get("weight"), 1.0),
+                pool=str(key_meta.get("pool") or ""),
+                session_secret=hmac.new(key.encode("utf-8"), b"codex-chat-session", hashlib.sha256).digest(),
+            )
+
+    @staticmethod
+    def digest(key: str) -> bytes:
+        return hmac.new(PROXY_KEY_INDEX_SECRET, key.encode("utf-8"), hashlib.sha256).digest()
+
+    def lookup(self, presented: str) -> ProxyKeyInfo | None:
+        return self._entries.get(self.digest(presented))
+
+    def key_ids(self) -> frozenset[str]:
+        return frozenset(info.key_id for info in self._entries.values())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """Immutable runtime settings.
+
+    Every change publishes a new snapshot with a higher version; request
+    handlers read the current reference once and never copy or lock.
+    """
+
+    version: int
+    upstream_base_url: str = DEFAULT_UPSTREAM_BASE_URL
+    api_keys: tuple[str, ...] = ()
+    api_key_weights: tuple[float, ...] = ()
+    key_pools: tuple[KeyPool, ...] = ()
+    proxy_api_keys: tuple[str, ...] = ()
+    model: str = DEFAULT_CODEX_PROXY_MODEL
+    force_model: bool = False
+    admin_username: str = DEFAULT_ADMIN_USERNAME
+    admin_password: str = field(default=DEFAULT_ADMIN_PASSWORD, repr=False)
+    has_custom_admin_password: bool = False
+    # Treated as read-only; replaced together with proxy_key_index.
+    proxy_key_meta: dict[str, dict[str, Any]] = field(default_factory=dict, repr=False)
+    proxy_key_index: ProxyKeyIndex = field(default_factory=ProxyKeyIndex, repr=False, compare=False)
+
+
+class RuntimeConfig:
+    """Runtime settings shared by the proxy and admin API.
+
+    Settings live in a ConfigStore (shared by all workers) or, with
+    CONFIG_DB_PATH empty, directly in the .env file. Both are blocking, so
+    admin handlers go through apply_config_change() on a worker thread.
+    """
+
+    def __init__(self, store: "ConfigStore | EnvFile"):
+        self.store = store
+        # Only writers take the lock; readers just load self.current.
+        self._write_lock = Lock()
+        # Serializes read-modify-write mutations within this process.
+        self._mutation_lock = Lock()
+        self.current = ConfigSnapshot(version=0)
+
+    def open(self) -> ConfigSnapshot:
+        """First load, run at startup rather than import: a ConfigStore creates its database here."""
+        if not self.refresh():
+            self.load()
+        return self.current
+
+    def refresh(self) -> bool:
+        """Reload if .env was edited or another worker committed a change; returns whether a reload happened."""
+        if not isinstance(self.store, ConfigStore):
+            return False
+        imported = self.store.sync_env_file()
+        if imported:
+            logger.info("Imported %s from %s into the config store", ", ".join(imported), self.store.env_file.path)
+        if imported or self.store.changed():
+            self.load()
+            return True
+        return False
+
+    def apply(self, mutation: Callable[[], ConfigSnapshot]) -> ConfigSnapshot:
+        """Run a read-modify-write against fresh settings, retrying if another worker wins the write.
+
+        The mutation must read the settings it builds on from self.current
+        inside the call, so a retry sees the other worker's change.
+        """
+        with self._mutation_lock:
+            for _ in range(3):
+                self.refresh()
+                try:
+                    return mutation()
+                except ConfigConflict:
+                    continue
+            raise ConfigConflict("config store kept changing during the update")
+
+    def load(self) -> ConfigSnapshot:
+        env_data = self.store.read()
 
         def setting(key: str, default: str = "") -> str:
             if key in env_data:
@@ -181,6 +722,7 @@ class RuntimeConfig:
             or DEFAULT_UPSTREAM_BASE_URL
         ).rstrip("/")
         raw_keys = setting("ANYROUTER_API_KEY")
+        api_keys = tuple(split_api_keys(raw_keys))
         raw_proxy_keys = setting("PROXY_API_KEY") or setting("PROXY_API_KEYS")
         model = setting("CODEX_PROXY_MODEL") or DEFAULT_CODEX_PROXY_MODEL
         force_model = _str_to_bool(setting("CODEX_PROXY_FORCE_MODEL", "false"))
@@ -189,29 +731,35 @@ class RuntimeConfig:
         raw_admin_password = setting("ADMIN_PASSWORD")
         admin_password = raw_admin_password or DEFAULT_ADMIN_PASSWORD
 
-        with self._lock:
-            self.upstream_base_url = upstream_base_url
-            self.api_keys = split_api_keys(raw_keys)
-            self.proxy_api_keys = split_api_keys(raw_proxy_keys)
-            self.model = model.strip() or DEFAULT_CODEX_PROXY_MODEL
-            self.force_model = force_model
-            self.admin_username = admin_username.strip() or DEFAULT_ADMIN_USERNAME
-            self.admin_password = admin_password
-            self.has_custom_admin_password = bool(raw_admin_password)
-
-    def snapshot(self) -> dict[str, Any]:
-        with self._lock:
-            return {
-                "upstream_base_url": self.upstream_base_url,
-                "api_keys": list(self.api_keys),
-                "proxy_api_keys": list(self.proxy_api_keys),
-                "model": self.model,
-                "force_model": self.force_model,
-                "admin_username": self.admin_username,
-                "has_custom_admin_password": self.has_custom_admin_password,
-            }
+        return self._publish(
+            upstream_base_url=upstream_base_url,
+            api_keys=api_keys,
+            api_key_weights=parse_key_weights(setting("ANYROUTER_API_KEY_WEIGHTS"), len(api_keys)),
+            key_pools=parse_key_pools(setting("ANYROUTER_KEY_POOLS")),
+            proxy_api_keys=tuple(split_api_keys(raw_proxy_keys)),
+            model=model.strip() or DEFAULT_CODEX_PROXY_MODEL,
+            force_model=force_model,
+            admin_username=admin_username.strip() or DEFAULT_ADMIN_USERNAME,
+            admin_password=admin_password,
+            has_custom_admin_password=bool(raw_admin_password),
+            proxy_key_meta=parse_proxy_key_meta(setting("PROXY_API_KEY_META")),
+        )
 
-    def update_settings(self, upstream_base_url: str, model: str, force_model: bool) -> dict[str, Any]:
+    def _publish(self, **changes: Any) -> ConfigSnapshot:
+        with self._write_lock:
+            if "proxy_api_keys" in changes or "proxy_key_meta" in changes:
+                changes["proxy_key_index"] = ProxyKeyIndex(
+                    changes.get("proxy_api_keys", self.current.proxy_api_keys),
+                    changes.get("proxy_key_meta", self.current.proxy_key_meta),
+                )
+            snapshot = replace(self.current, version=self.current.version + 1, **changes)
+            self.current = snapshot
+        return snapshot
+
+    def snapshot(self) -> ConfigSnapshot:
+        return self.current
+
+    def update_settings(self, upstream_base_url: str, model: str, force_model: bool) -> ConfigSnapshot:
         upstream_base_url = upstream_base_url.strip().rstrip("/")
         model = model.strip()
         if not upstream_base_url.startswith(("http://", "https://")):
@@ -219,55 +767,114 @@ class RuntimeConfig:
         if not model:
             raise ValueError("默认模型不能为空")
 
-        self.env_file.set_many(
+        self.store.set_many(
             {
                 "ANYROUTER_OPENAI_BASE_URL": upstream_base_url,
                 "CODEX_PROXY_MODEL": model,
                 "CODEX_PROXY_FORCE_MODEL": "true" if force_model else "false",
             }
         )
-        os.environ["ANYROUTER_OPENAI_BASE_URL"] = upstream_base_url
-        os.environ["CODEX_PROXY_MODEL"] = model
-        os.environ["CODEX_PROXY_FORCE_MODEL"] = "true" if force_model else "false"
 
-        with self._lock:
-            self.upstream_base_url = upstream_base_url
-            self.model = model
-            self.force_model = force_model
-        return self.snapshot()
+        return self._publish(upstream_base_url=upstream_base_url, model=model, force_model=force_model)
 
-    def update_api_keys(self, keys: list[str]) -> dict[str, Any]:
+    def update_api_keys(self, keys: list[str], weights: list[float] | None = None) -> ConfigSnapshot:
+        """Replace upstream keys; without explicit weights, existing keys keep theirs."""
         clean_keys = [key.strip() for key in keys if key.strip()]
-        self.env_file.set_many({"ANYROUTER_API_KEY": ",".join(clean_keys)})
-        os.environ["ANYROUTER_API_KEY"] = ",".join(clean_keys)
-        with self._lock:
-            self.api_keys = clean_keys
-        return self.snapshot()
+        if weights is None:
+            current = dict(zip(self.current.api_keys, self.current.api_key_weights))
+            weights = [current.get(key, 1.0) for key in clean_keys]
+        clean_weights = tuple(max(float(weight), 0.01) for weight in weights)
+        if len(clean_weights) != len(clean_keys):
+            raise ValueError("权重数量必须与 Key 数量一致")
+        raw_weights = "" if all(weight == 1.0 for weight in clean_weights) else ",".join(
+            f"{weight:g}" for weight in clean_weights
+        )
+        self.store.set_many({
+            "ANYROUTER_API_KEY": ",".join(clean_keys),
+            "ANYROUTER_API_KEY_WEIGHTS": raw_weights,
+        })
+        return self._publish(api_keys=tuple(clean_keys), api_key_weights=clean_weights)
 
-    def update_proxy_api_keys(self, keys: list[str]) -> dict[str, Any]:
+    def update_proxy_api_keys(self, keys: list[str]) -> ConfigSnapshot:
         clean_keys = [key.strip() for key in keys if key.strip()]
-        self.env_file.set_many({"PROXY_API_KEY": ",".join(clean_keys)})
-        os.environ["PROXY_API_KEY"] = ",".join(clean_keys)
-        with self._lock:
-            self.proxy_api_keys = clean_keys
-        return self.snapshot()
-
-    def update_admin_password(self, old_password: str, new_password: str) -> None:
-        if not verify_password(old_password, self.admin_password):
+        items = {"PROXY_API_KEY": ",".join(clean_keys)}
+        meta = {key: value for key, value in self.current.proxy_key_meta.items() if key in clean_keys}
+        if meta != self.current.proxy_key_meta:
+            items["PROXY_API_KEY_META"] = serialize_proxy_key_meta(meta)
+        self.store.set_many(items)
+        return self._publish(proxy_api_keys=tuple(clean_keys), proxy_key_meta=meta)
+
+    def update_proxy_key_limits(self, key: str, rpm: int | None, tpm: int | None) -> ConfigSnapshot:
+        """Set (or clear, with None/0) the rpm / tpm limits of one proxy key."""
+        return self._update_proxy_key_meta(key, {"rpm": rpm, "tpm": tpm})
+
+    def update_proxy_key_pool(self, key: str, pool: str) -> ConfigSnapshot:
+        """Assign one proxy key to an upstream key pool; an empty name returns it to the shared pool."""
+        pool = pool.strip()
+        if pool and pool not in {item.name for item in self.current.key_pools}:
+            raise ValueError(f"Key 池 {pool} 不存在")
+        return self._update_proxy_key_meta(key, {"pool": pool})
+
+    def _update_proxy_key_meta(self, key: str, fields: dict[str, Any]) -> ConfigSnapshot:
+        meta = {name: dict(value) for name, value in self.current.proxy_key_meta.items()}
+        entry = meta.setdefault(key, {})
+        for name, value in fields.items():
+            if value:
+                entry[name] = value
+            else:
+                entry.pop(name, None)
+        if not entry:
+            meta.pop(key)
+        self.store.set_many({"PROXY_API_KEY_META": serialize_proxy_key_meta(meta)})
+        return self._publish(proxy_key_meta=meta)
+
+    def update_key_pools(self, pools: tuple[KeyPool, ...]) -> ConfigSnapshot:
+        """Replace the pool definitions; proxy keys assigned to a removed pool fall back to the shared pool."""
+        names = [pool.name for pool in pools]
+        if any(not name or name == "shared" for name in names):
+            raise ValueError("Key 池名称不能为空，也不能使用保留名称 shared")
+        if len(set(names)) != len(names):
+            raise ValueError("Key 池名称不能重复")
+        items = {"ANYROUTER_KEY_POOLS": serialize_key_pools(pools)}
+        meta = {name: dict(value) for name, value in self.current.proxy_key_meta.items()}
+        for entry in meta.values():
+            if entry.get("pool") and entry["pool"] not in names:
+                entry.pop("pool")
+        meta = {name: value for name, value in meta.items() if value}
+        if meta == self.current.proxy_key_meta:
+            self.store.set_many(items)
+            return self._publish(key_pools=pools)
+        items["PROXY_API_KEY_META"] = serialize_proxy_key_meta(meta)
+        self.store.set_many(items)
+        return self._publish(key_pools=pools, proxy_key_meta=meta)
+
+    def import_settings(self, items: dict[str, str]) -> ConfigSnapshot:
+        """Overwrite the given managed keys (e.g. from an uploaded .env) and reload."""
+        if isinstance(self.store, ConfigStore):
+            self.store.set_many(items, note="import .env")
+        else:
+            self.store.set_many(items)
+        return self.load()
+
+    def restore(self, version: int) -> ConfigSnapshot:
+        """Roll the shared store back to a snapshot from its history."""
+        if not isinstance(self.store, ConfigStore):
+            raise ValueError("配置库未启用（CONFIG_DB_PATH 为空）")
+        self.store.restore(version)
+        return self.load()
+
+    def update_admin_password(self, old_password: str, new_password: str) -> ConfigSnapshot:
+        if not verify_password(old_password, self.current.admin_password):
             raise ValueError("当前密码不正确")
         if len(new_password) < 8:
             raise ValueError("新密码至少需要 8 个字符")
 
-        self.env_file.set_many({"ADMIN_PASSWORD": new_password})
-        os.environ["ADMIN_PASSWORD"] = new_password
-        with self._lock:
-            self.admin_password = new_password
-            self.has_custom_admin_password = True
+        self.store.set_many({"ADMIN_PASSWORD": new_password})
+        return self._publish(admin_password=new_password, has_custom_admin_password=True)
 
 
 http_client: httpx.AsyncClient | None = None
-api_key_index = 0
-api_key_lock = asyncio.Lock()
+client_key_counter = itertools.count()
 
 
 def get_client() -> httpx.AsyncClient:
@@ -276,15 +883,299 @@ def get_client() -> httpx.AsyncClient:
     return http_client
 
 
+class CachingResolver:
+    """Caches DNS answers for ttl seconds; concurrent lookups of a cold host share one query.
+
+    Lookups are bounded by the caller's connect timeout and fail as
+    httpx.ConnectError / httpx.ConnectTimeout, like a failed connect.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._cache: dict[tuple[str, int], tuple[tuple[str, ...], float]] = {}
+        # Concurrent connects to a cold host share one lookup.
+        self._pending: dict[tuple[str, int], asyncio.Future] = {}
+        self.lookups = 0
+        self.cache_hits = 0
+
+    async def resolve(self, host: str, port: int, timeout: float | None = None) -> tuple[str, ...]:
+        try:
+            ipaddress.ip_address(host)
+            return (host,)
+        except ValueError:
+            pass
+        while True:
+            cached = self._cache.get((host, port))
+            if cached is not None and cached[1] > time.monotonic():
+                self.cache_hits += 1
+                return cached[0]
+            pending = self._pending.get((host, port))
+            if pending is None:
+                return await self._lookup(host, port, timeout)
+            self.cache_hits += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(pending), timeout)
+            except asyncio.TimeoutError:
+                raise httpx.ConnectTimeout(f"DNS lookup for {host} timed out") from None
+            except asyncio.CancelledError:
+                # The leading lookup was cancelled by its own caller: take over; our own cancellation propagates.
+                if not pending.cancelled():
+                    raise
+
+    async def _lookup(self, host: str, port: int, timeout: float | None) -> tuple[str, ...]:
+        self.lookups += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending[(host, port)] = future
+        try:
+            try:
+                infos = await asyncio.wait_for(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout)
+            except asyncio.TimeoutError:
+                raise httpx.ConnectTimeout(f"DNS lookup for {host} timed out") from None
+            except OSError as exc:
+                # Surface as httpx.ConnectError so callers handle it like any failed connect.
+                raise httpx.ConnectError(f"DNS lookup for {host} failed: {exc}") from exc
+            addresses = tuple(dict.fromkeys(info[4][0] for info in infos))
+            if not addresses:
+                raise httpx.ConnectError(f"DNS lookup for {host} returned no addresses")
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Mark retrieved: with no waiters asyncio would log "exception was never retrieved".
+            future.exception()
+            raise
+        finally:
+            self._pending.pop((host, port), None)
+        future.set_result(addresses)
+        if self.ttl > 0:
+            self._cache[(host, port)] = (addresses, time.monotonic() + self.ttl)
+        return addresses
+
+    def forget(self, host: str, port: int) -> None:
+        self._cache.pop((host, port), None)
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Wraps a regular AsyncHTTPTransport with DNS caching and per-HTTP-version counters.
+
+    Each request is sent to a cached address of its host, trying every
+    address of the answer in order; Host, TLS SNI and certificate checks
+    keep using the original name (the sni_hostname request extension). When
+    no address accepts, the cached answer is dropped so the next attempt
+    resolves again. New connections are counted through httpcore's trace
+    extension.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, resolver: CachingResolver):
+        self.transport = transport
+        self.resolver = resolver
+        self.requests = 0
+        self.connects = 0
+        self.connect_errors = 0
+        self.http_versions: dict[str, int] = {}
+
+    async def _trace(self, event: str, info: dict[str, Any]) -> None:
+        if event == "connection.connect_tcp.complete":
+            self.connects += 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host, port = request.url.host, request.url.port or (443 if request.url.scheme == "https" else 80)
+        timeout = request.extensions.get("timeout", {}).get("connect")
+        extensions = {**request.extensions, "trace": self._trace}
+        if request.url.scheme == "https":
+            extensions.setdefault("sni_hostname", host)
+        try:
+            addresses = await self.resolver.resolve(host, port, timeout)
+            for index, address in enumerate(addresses):
+                attempt = httpx.Request(
+                    request.method,
+                    request.url.copy_with(host=address),
+                    headers=request.headers,
+                    stream=request.stream,
+                    extensions=extensions,
+                )
+                try:
+                    response = await self.transport.handle_async_request(attempt)
+                    break
+                except (httpx.ConnectError, httpx.ConnectTimeout):
+                    # Nothing was sent yet, so the next address can reuse the request stream.
+                    if index == len(addresses) - 1:
+                        raise
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            self.connect_errors += 1
+            self.resolver.forget(host, port)
+            raise
+        self.requests += 1
+        version = response.extensions.get("http_version", b"")
+        version = version.decode("ascii", "replace") if isinstance(version, bytes) else str(version)
+        self.http_versions[version] = self.http_versions.get(version, 0) + 1
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def environment_proxies() -> dict[str, str]:
+    """Proxy settings from HTTP(S)_PROXY / ALL_PROXY / NO_PROXY, as httpx would read them."""
+    return {scheme: url for scheme, url in urllib.request.getproxies().items() if url}
+
+
+class UpstreamConnections:
+    """Builds the upstream HTTP client and keeps its connections warm.
+
+    HTTP/2 (when h2 is installed) multiplexes concurrent streams over one
+    TLS connection. At startup a few connections are opened in the
+    background, and while the proxy is idle a HEAD to the upstream origin is
+    sent every keepalive interval so the next request skips DNS, TCP and TLS
+    setup. Each new connection is one handshake; requests minus handshakes
+    is the number served on a reused connection.
+    """
+
+    def __init__(
+        self,
+        http2: bool,
+        limits: httpx.Limits,
+        prewarm: int,
+        keepalive_interval: float,
+        dns_ttl: float,
+    ):
+        self.http2 = http2 and self._h2_available()
+        self.limits = limits
+        self.prewarm = max(prewarm, 0)
+        self.keepalive_interval = keepalive_interval
+        self.dns_ttl = dns_ttl
+        self.transport: InstrumentedTransport | None = None
+        self.resolver: CachingResolver | None = None
+        self.pings = 0
+        self.ping_errors = 0
+        self._task: asyncio.Task | None = None
+        self._last_requests = 0
+
+    @staticmethod
+    def _h2_available() -> bool:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("UPSTREAM_HTTP2 is enabled but the h2 package is missing; using HTTP/1.1")
+            return False
+        return True
+
+    def create_client(self) -> httpx.AsyncClient:
+        proxies = environment_proxies()
+        if set(proxies) - {"no"}:
+            # A custom transport would bypass httpx's env proxy mounts; the proxy resolves names itself anyway.
+            logger.info("Upstream proxy configured via environment; DNS caching and connection stats are off")
+            self.transport = self.resolver = None
+            return httpx.AsyncClient(timeout=HTTP_TIMEOUT, http2=self.http2, limits=self.limits)
+        self.resolver = CachingResolver(self.dns_ttl)
+        self.transport = InstrumentedTransport(
+            httpx.AsyncHTTPTransport(http2=self.http2, limits=self.limits),
+            self.resolver,
+        )
+        return httpx.AsyncClient(timeout=HTTP_TIMEOUT, transport=self.transport)
+
+    async def ping(self, count: int) -> None:
+        """Send `count` concurrent HEADs to the upstream origin; each reuses or opens one connection."""
+        parts = httpx.URL(runtime_config.snapshot().upstream_base_url)
+        origin = f"{parts.scheme}://{parts.netloc.decode('ascii')}/"
+
+        async def one() -> None:
+            try:
+                await get_client().head(origin, timeout=10)
+                self.pings += 1
+            except httpx.HTTPError as exc:
+                self.ping_errors += 1
+                logger.debug("Upstream keepalive ping failed: %s", exc)
+
+        await asyncio.gather(*(one() for _ in range(count)))
+
+    async def _run(self) -> None:
+        # HTTP/2 multiplexes the pings onto a single connection, which is all it needs.
+        count = 1 if self.http2 else max(self.prewarm, 1)
+        if self.prewarm > 0:
+            await self.ping(count)
+            logger.info("Prewarmed upstream connections (%s)", "HTTP/2" if self.http2 else "HTTP/1.1")
+        if self.keepalive_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            requests = self.transport.requests if self.transport is not None else 0
+            # Real traffic in the last interval already kept the pool warm.
+            if requests - self._last_requests <= count:
+                await self.ping(count)
+            self._last_requests = self.transport.requests if self.transport is not None else 0
+
+    def start(self) -> None:
+        if (self.prewarm > 0 or self.keepalive_interval > 0) and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict[str, Any]:
+        transport, resolver = self.transport, self.resolver
+        if transport is None or resolver is None:
+            return {"http2": self.http2}
+        return {
+            "http2": self.http2,
+            "requests": transport.requests,
+            "http_versions": dict(transport.http_versions),
+            "handshakes": transport.connects,
+            "reused_requests": max(transport.requests - transport.connects, 0),
+            "connect_errors": transport.connect_errors,
+            "dns_lookups": resolver.lookups,
+            "dns_cache_hits": resolver.cache_hits,
+            "keepalive_pings": self.pings,
+            "keepalive_ping_errors": self.ping_errors,
+        }
+
+
+upstream_connections = UpstreamConnections(
+    UPSTREAM_HTTP2,
+    httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY_SECONDS,
+    ),
+    UPSTREAM_PREWARM_CONNECTIONS,
+    UPSTREAM_KEEPALIVE_INTERVAL_SECONDS,
+    UPSTREAM_DNS_TTL_SECONDS,
+)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     global http_client
-    http_client = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
-    config = runtime_config.snapshot()
+    config = await asyncio.to_thread(runtime_config.open)
+    http_client = upstream_connections.create_client()
     logger.info("Started: Codex AnyRouter proxy")
-    logger.info("Upstream OpenAI base URL: %s", config["upstream_base_url"])
-    logger.info("Default model: %s", config["model"])
+    logger.info("Upstream OpenAI base URL: %s", config.upstream_base_url)
+    logger.info("Default model: %s", config.model)
+    if isinstance(runtime_config.store, ConfigStore):
+        logger.info(
+            "Runtime config store: %s (edited keys in %s are imported automatically)",
+            runtime_config.store.path,
+            runtime_config.store.env_file.path,
+        )
+    key_prober.start()
+    usage_ledger.start()
+    config_watcher.start()
+    upstream_connections.start()
     yield
+    await upstream_connections.stop()
+    await config_watcher.stop()
+    await key_prober.stop()
+    await usage_ledger.stop()
+    await idempotency_store.close()
+    await response_store.close()
     await http_client.aclose()
 
 
@@ -297,20 +1188,735 @@ def split_api_keys(raw_value: str) -> list[str]:
     return [key.strip() for key in raw_value.split(",") if key.strip()]
 
 
-async def select_api_key(keys: list[str]) -> str | None:
-    global api_key_index
+def parse_key_weights(raw_value: str, count: int) -> tuple[float, ...]:
+    """Positional weights for ANYROUTER_API_KEY; missing or invalid entries default to 1."""
+    weights: list[float] = []
+    for item in raw_value.split(",")[:count] if raw_value.strip() else []:
+        try:
+            weights.append(max(float(item), 0.01))
+        except ValueError:
+            weights.append(1.0)
+    weights.extend([1.0] * (count - len(weights)))
+    return tuple(weights)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
+def select_client_key(keys: list[str]) -> str | None:
+    """Round-robin over keys supplied by the client itself (no health tracking)."""
     if not keys:
         return None
-    if len(keys) == 1:
-        return keys[0]
+    return keys[next(client_key_counter) % len(keys)]
+
+
+class KeyState:
+    """Live scheduling state for one configured upstream key.
+
+    Only touched from the event loop, so plain attribute updates are safe
+    without a lock.
+    """
+
+    def __init__(self, key: str, weight: float):
+        self.key = key
+        self.weight = weight
+        self.in_flight = 0
+        self.requests = 0
+        self.ewma_latency: float | None = None
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.last_status: int | None = None
+        self.last_error = ""
+        self.recent: deque[tuple[float, int]] = deque(maxlen=64)
+        # Health as seen by the prober and by auth/credit failures on live traffic.
+        self.health = "unknown"
+        self.quarantine_reason = ""
+        self.last_success_at = 0.0
+        self.last_check_at: float | None = None
+        self.last_check_status: int | None = None
+
+    @property
+    def quarantined(self) -> bool:
+        return self.health == "quarantined"
+
+    def available(self, now: float) -> bool:
+        return not self.quarantined and now >= self.cooldown_until
+
+    def quarantine(self, reason: str) -> None:
+        if not self.quarantined:
+            logger.warning("Upstream key %s quarantined: %s", mask_key(self.key), reason)
+        self.health = "quarantined"
+        self.quarantine_reason = reason[:300]
+
+    def lift_quarantine(self) -> None:
+        if self.quarantined:
+            logger.info("Upstream key %s reinstated", mask_key(self.key))
+        self.health = "healthy"
+        self.quarantine_reason = ""
+
+    def reinstate(self) -> None:
+        self.lift_quarantine()
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def observe_probe(self, status: int | None, error: str = "", retry_after: float | None = None) -> None:
+        """Apply a prober result. Only auth/credit errors are conclusive failures.
+
+        Only a 2xx clears a cooldown set by live traffic; a 429 or other 4xx
+        proves the key is accepted (lifting quarantine) but not that it may
+        be used again yet.
+        """
+        self.last_check_at = time.time()
+        self.last_check_status = status
+        if status in KEY_QUARANTINE_STATUSES:
+            self.quarantine(error or f"HTTP {status}")
+        elif status is not None and 200 <= status < 300:
+            self.reinstate()
+        elif status is not None and status < 500:
+            self.lift_quarantine()
+            if status == 429:
+                self.last_error = (error or "HTTP 429")[:300]
+                self._cool_down(retry_after if retry_after is not None else KEY_RATE_LIMIT_COOLDOWN_SECONDS, self.last_error)
+        elif error:
+            self.last_error = error[:300]
+
+    def recent_count(self, now: float, status: int) -> int:
+        return sum(1 for at, code in self.recent if code == status and now - at <= KEY_RECENT_WINDOW_SECONDS)
+
+    def cost(self, now: float) -> float:
+        latency = self.ewma_latency if self.ewma_latency is not None else KEY_DEFAULT_LATENCY_SECONDS
+        recent_failures = sum(1 for at, _ in self.recent if now - at <= KEY_RECENT_WINDOW_SECONDS)
+        return latency * (self.in_flight + 1) * (1 + recent_failures) / self.weight
+
+    def _cool_down(self, seconds: float, reason: str) -> None:
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + min(seconds, KEY_MAX_COOLDOWN_SECONDS))
+        logger.warning("Upstream key %s cooling down for %.0fs: %s", mask_key(self.key), seconds, reason)
+
+    def observe(self, status: int | None, latency: float, error: str = "", retry_after: float | None = None) -> None:
+        """Record the outcome of one request (status None means a transport error)."""
+        now = time.monotonic()
+        self.last_status = status
+        if status is not None and status < 500 and status not in (401, 402, 403, 429):
+            self.ewma_latency = latency if self.ewma_latency is None else (
+                KEY_EWMA_ALPHA * latency + (1 - KEY_EWMA_ALPHA) * self.ewma_latency
+            )
+            self.consecutive_failures = 0
+            self.last_success_at = now
+            if self.health == "unknown":
+                self.health = "healthy"
+            return
+
+        self.recent.append((now, status or 0))
+        self.consecutive_failures += 1
+        self.last_error = (error or f"HTTP {status}")[:300]
+        if status == 429:
+            backoff = KEY_RATE_LIMIT_COOLDOWN_SECONDS * 2 ** (self.consecutive_failures - 1)
+            self._cool_down(retry_after if retry_after is not None else backoff, self.last_error)
+        elif status in KEY_PASSIVE_QUARANTINE_STATUSES:
+            if KEY_PROBE_INTERVAL_SECONDS > 0:
+                # Passive signal: stop using the key until the prober sees it recover.
+                self.quarantine(self.last_error)
+            else:
+                self._cool_down(KEY_AUTH_COOLDOWN_SECONDS, self.last_error)
+        elif self.consecutive_failures >= KEY_FAILURE_THRESHOLD:
+            self._cool_down(KEY_FAILURE_COOLDOWN_SECONDS, self.last_error)
+
+    def snapshot(self, now: float) -> dict[str, Any]:
+        return {
+            "key": mask_key(self.key),
+            "weight": self.weight,
+            "available": self.available(now),
+            "cooldown_remaining": round(max(self.cooldown_until - now, 0.0), 1),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            "recent_429": self.recent_count(now, 429),
+            "recent_401": self.recent_count(now, 401),
+            "recent_402": self.recent_count(now, 402),
+            "consecutive_failures": self.consecutive_failures,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+            "health": self.health,
+            "quarantine_reason": self.quarantine_reason,
+            "last_check_at": int(self.last_check_at) if self.last_check_at else None,
+            "last_check_status": self.last_check_status,
+        }
+
+
+class KeyLease:
+    """One request's use of an upstream key.
+
+    record() stores the outcome once the upstream status is known; release()
+    ends the in-flight accounting when the body is done. Both are idempotent.
+    """
+
+    def __init__(self, key: str, state: KeyState | None = None):
+        self.key = key
+        self.state = state
+        # Admission slot held for the same lifetime; freed by release().
+        self.admission: "AdmissionTicket | None" = None
+        self.started = time.monotonic()
+        self._recorded = False
+        self._released = False
+        if state is not None:
+            state.in_flight += 1
+            state.requests += 1
+
+    def record(self, status: int | None, error: str = "", headers: httpx.Headers | None = None) -> None:
+        if self._recorded or self.state is None:
+            return
+        self._recorded = True
+        retry_after = parse_retry_after(headers.get("retry-after")) if headers is not None else None
+        self.state.observe(status, time.monotonic() - self.started, error, retry_after)
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        if self.admission is not None:
+            self.admission.release()
+        if self.state is not None:
+            self.state.in_flight -= 1
+
+
+class UpstreamKeyScheduler:
+    """Weighted power-of-two-choices over healthy upstream keys.
+
+    Two keys are drawn by weight and the one with the lower cost (EWMA
+    latency x in-flight x recent failures / weight) wins. Keys in cooldown
+    are skipped unless every key is cooling down. State survives config
+    changes for keys that are still configured.
+
+    Keys listed in ANYROUTER_KEY_POOLS are only drawn for proxy keys assigned
+    to that pool; every other key forms the shared pool. A pool with overflow
+    enabled spills into the shared pool when none of its own keys is available.
+    """
+
+    SHARED_POOL = ""
+
+    def __init__(self):
+        self.version = -1
+        self.states: dict[str, KeyState] = {}
+        self._pools: dict[str, tuple[tuple[KeyState, ...], tuple[float, ...]]] = {}
+        self._overflow: frozenset[str] = frozenset()
+        self._pool_of: dict[str, str] = {}
+        self.overflowed: dict[str, int] = {}
+
+    def sync(self, config: ConfigSnapshot) -> None:
+        if config.version == self.version:
+            return
+        states: dict[str, KeyState] = {}
+        for key, weight in zip(config.api_keys, config.api_key_weights):
+            state = self.states.get(key) or KeyState(key, weight)
+            state.weight = weight
+            states[key] = state
+        self.states = states
+
+        by_id = {proxy_key_fingerprint(key): state for key, state in states.items()}
+        members: dict[str, list[KeyState]] = {}
+        pool_of: dict[str, str] = {}
+        for pool in config.key_pools:
+            for ref in pool.keys:
+                state = by_id.get(ref) or states.get(ref)
+                # A key belongs to the first pool that lists it.
+                if state is not None and state.key not in pool_of:
+                    pool_of[state.key] = pool.name
+                    members.setdefault(pool.name, []).append(state)
+        members[self.SHARED_POOL] = [state for key, state in states.items() if key not in pool_of]
+        self._pools = {
+            name: (tuple(pool), tuple(itertools.accumulate(state.weight for state in pool)))
+            for name, pool in members.items()
+        }
+        self._overflow = frozenset(pool.name for pool in config.key_pools if pool.overflow)
+        self._pool_of = pool_of
+        self.version = config.version
+
+    def _pick(self, name: str, now: float, strict: bool) -> KeyState | None:
+        """Choose a key from one pool; strict returns None instead of a cooling-down key."""
+        pool, cum_weights = self._pools.get(name, ((), ()))
+        if not pool:
+            return None
+        if len(pool) == 1:
+            return pool[0] if not strict or pool[0].available(now) else None
+
+        first, second = random.choices(pool, cum_weights=cum_weights, k=2)
+        if second is first:
+            second = random.choices(pool, cum_weights=cum_weights)[0]
+        candidates = [state for state in (first, second) if state.available(now)]
+        if not candidates:
+            # Both draws were cooling down: fall back to a scan of the healthy keys.
+            healthy = [state for state in pool if state.available(now)]
+            if healthy:
+                candidates = random.sample(healthy, min(2, len(healthy)))
+            elif strict:
+                return None
+            else:
+                # Every key is cooling down or quarantined: prefer the least bad one over failing outright.
+                candidates = [min(pool, key=lambda state: (state.quarantined, state.cooldown_until))]
+        return min(candidates, key=lambda state: state.cost(now))
+
+    def acquire(self, config: ConfigSnapshot, pool: str = "") -> KeyLease | None:
+        """Lease a key for a proxy key in `pool`; unknown or empty pool names use the shared pool."""
+        self.sync(config)
+        now = time.monotonic()
+        if pool not in self._pools:
+            pool = self.SHARED_POOL
+        if pool != self.SHARED_POOL and pool in self._overflow:
+            chosen = self._pick(pool, now, strict=True)
+            if chosen is None:
+                chosen = self._pick(self.SHARED_POOL, now, strict=True)
+                if chosen is not None:
+                    self.overflowed[pool] = self.overflowed.get(pool, 0) + 1
+                else:
+                    chosen = self._pick(pool, now, strict=False)
+        else:
+            chosen = self._pick(pool, now, strict=False)
+        return KeyLease(chosen.key, chosen) if chosen is not None else None
+
+    def snapshot(self, config: ConfigSnapshot) -> list[dict[str, Any]]:
+        self.sync(config)
+        now = time.monotonic()
+        return [
+            {**state.snapshot(now), "id": proxy_key_fingerprint(key), "pool": self._pool_of.get(key, self.SHARED_POOL)}
+            for key, state in self.states.items()
+        ]
+
+    def pool_stats(self, config: ConfigSnapshot) -> dict[str, dict[str, Any]]:
+        self.sync(config)
+        now = time.monotonic()
+        return {
+            name or "shared": {
+                "keys": len(pool),
+                "available": sum(1 for state in pool if state.available(now)),
+                "in_flight": sum(state.in_flight for state in pool),
+                "overflow": name in self._overflow,
+                "overflowed": self.overflowed.get(name, 0),
+            }
+            for name, (pool, _) in self._pools.items()
+        }
+
+
+key_scheduler = UpstreamKeyScheduler()
+
+
+class KeyHealthProber:
+    """Periodically validates configured upstream keys with a cheap GET.
+
+    Keys that answered a live request successfully within the last interval
+    are skipped, so steady traffic costs no extra upstream calls.
+    """
+
+    def __init__(self, scheduler: UpstreamKeyScheduler, interval: float, concurrency: int, path: str):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.concurrency = max(concurrency, 1)
+        self.path = path
+        self.last_run_at: float | None = None
+        self._task: asyncio.Task | None = None
+
+    async def probe_key(self, config: ConfigSnapshot, state: KeyState) -> None:
+        url = build_upstream_url(config.upstream_base_url, self.path, "")
+        try:
+            response = await get_client().get(
+                url,
+                headers={"Authorization": f"Bearer {state.key}", "Accept": "application/json"},
+                timeout=KEY_PROBE_TIMEOUT_SECONDS,
+            )
+        except httpx.HTTPError as exc:
+            state.observe_probe(None, f"{type(exc).__name__}: {exc}")
+            return
+        error = ""
+        if response.status_code >= 400:
+            error = f"HTTP {response.status_code}: {normalize_openai_error(response.content).get('message', '')}"
+        state.observe_probe(response.status_code, error, parse_retry_after(response.headers.get("retry-after")))
+
+    async def probe_all(self, force: bool = False) -> int:
+        config = runtime_config.snapshot()
+        self.scheduler.sync(config)
+        now = time.monotonic()
+        states = [
+            state for state in self.scheduler.states.values()
+            if force or state.health != "healthy" or now - state.last_success_at > self.interval
+        ]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(state: KeyState) -> None:
+            async with semaphore:
+                await self.probe_key(config, state)
+
+        await asyncio.gather(*(run(state) for state in states))
+        self.last_run_at = time.time()
+        return len(states)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.probe_all()
+            except Exception:
+                logger.exception("Upstream key probe failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+key_prober = KeyHealthProber(key_scheduler, KEY_PROBE_INTERVAL_SECONDS, KEY_PROBE_CONCURRENCY, KEY_PROBE_PATH)
+
+
+class TokenBucket:
+    """Bucket refilled continuously at capacity per minute; refill is computed lazily in O(1)."""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated_at")
+
+    def __init__(self, capacity: int):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / RATE_LIMIT_WINDOW_SECONDS
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def wait_seconds(self, needed: float) -> float:
+        return max(needed - self.tokens, 0.0) / self.rate
+
+    def reset_seconds(self) -> float:
+        return (self.capacity - self.tokens) / self.rate
+
+
+def format_reset_seconds(seconds: float) -> str:
+    return f"{seconds:.3f}s" if seconds < 60 else f"{int(seconds // 60)}m{seconds % 60:.0f}s"
+
+
+@dataclass
+class RateLimitDecision:
+    allowed: bool
+    retry_after: float
+    headers: dict[str, str]
+
+
+class ProxyKeyRateLimiter:
+    """Per-proxy-key RPM / TPM token buckets.
+
+    Requests take one RPM token up front. Token usage is unknown until the
+    upstream reports it, so admission only requires a positive TPM balance and
+    usage is charged afterwards (the balance may go negative, delaying the
+    next request until it refills).
+    """
+
+    def __init__(self):
+        self.version = -1
+        self._buckets: dict[tuple[str, str], TokenBucket] = {}
+
+    def sync(self, config: ConfigSnapshot) -> None:
+        """Drop the buckets of proxy keys that were removed or rotated since the last config."""
+        if config.version == self.version:
+            return
+        key_ids = config.proxy_key_index.key_ids()
+        self._buckets = {slot: bucket for slot, bucket in self._buckets.items() if slot[0] in key_ids}
+        self.version = config.version
+
+    def _bucket(self, key_id: str, kind: str, limit: int | None) -> TokenBucket | None:
+        if not limit:
+            return None
+        bucket = self._buckets.get((key_id, kind))
+        if bucket is None or bucket.capacity != limit:
+            # A new or changed limit starts from a full bucket.
+            bucket = self._buckets[(key_id, kind)] = TokenBucket(limit)
+        return bucket
+
+    def admit(self, config: ConfigSnapshot, info: ProxyKeyInfo) -> RateLimitDecision:
+        self.sync(config)
+        now = time.monotonic()
+        requests = self._bucket(info.key_id, "requests", info.rpm_limit)
+        tokens = self._bucket(info.key_id, "tokens", info.tpm_limit)
+        retry_after = 0.0
+        if requests is not None:
+            requests.refill(now)
+            if requests.tokens < 1:
+                retry_after = requests.wait_seconds(1)
+        if tokens is not None:
+            tokens.refill(now)
+            if tokens.tokens <= 0:
+                retry_after = max(retry_after, tokens.wait_seconds(1))
+        if retry_after == 0 and requests is not None:
+            requests.tokens -= 1
+        return RateLimitDecision(retry_after == 0, retry_after, self._headers(requests, tokens))
+
+    def charge(self, info: ProxyKeyInfo, used_tokens: int) -> None:
+        bucket = self._bucket(info.key_id, "tokens", info.tpm_limit)
+        if bucket is not None and used_tokens > 0:
+            bucket.refill(time.monotonic())
+            bucket.tokens -= used_tokens
+
+    @staticmethod
+    def _headers(requests: TokenBucket | None, tokens: TokenBucket | None) -> dict[str, str]:
+        headers: dict[str, str] = {}
+        for kind, bucket in (("requests", requests), ("tokens", tokens)):
+            if bucket is None:
+                continue
+            headers[f"x-ratelimit-limit-{kind}"] = str(int(bucket.capacity))
+            headers[f"x-ratelimit-remaining-{kind}"] = str(max(int(bucket.tokens), 0))
+            headers[f"x-ratelimit-reset-{kind}"] = format_reset_seconds(bucket.reset_seconds())
+        return headers
+
+    def snapshot(self, info: ProxyKeyInfo) -> dict[str, Any]:
+        now = time.monotonic()
+        result: dict[str, Any] = {"rpm": info.rpm_limit, "tpm": info.tpm_limit}
+        for kind, limit in (("requests", info.rpm_limit), ("tokens", info.tpm_limit)):
+            bucket = self._bucket(info.key_id, kind, limit)
+            if bucket is not None:
+                bucket.refill(now)
+                result[f"remaining_{kind}"] = max(int(bucket.tokens), 0)
+        return result
+
+
+rate_limiter = ProxyKeyRateLimiter()
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+@dataclass
+class TenantQueue:
+    weight: float = 1.0
+    last_finish: float = 0.0
+    queued: int = 0
+    in_flight: int = 0
+    admitted: int = 0
+    queued_total: int = 0
+    timeouts: int = 0
+    rejected_full: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "weight": self.weight,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "queued_total": self.queued_total,
+            "timeouts": self.timeouts,
+            "rejected_full": self.rejected_full,
+            "avg_wait_ms": round(self.total_wait / self.queued_total * 1000, 1) if self.queued_total else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+        }
+
+
+class AdmissionTicket:
+    def __init__(self, scheduler: "AdmissionScheduler", tenant: TenantQueue):
+        self.scheduler = scheduler
+        self.tenant = tenant
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.scheduler._release(self.tenant)
+
+
+class AdmissionScheduler:
+    """Global in-flight cap with weighted fair queuing across tenants.
+
+    Below max_inflight requests are admitted immediately. Above it each
+    request gets a virtual finish tag, start = max(virtual time, tenant's last
+    finish) plus 1 / weight, and freed slots go to the smallest tag. A tenant
+    that bursts therefore queues behind itself, while other tenants' requests
+    are interleaved in proportion to their weights.
+    """
+
+    def __init__(self, max_inflight: int, queue_timeout: float, max_queue_per_tenant: int):
+        self.max_inflight = max_inflight
+        self.queue_timeout = queue_timeout
+        self.max_queue_per_tenant = max_queue_per_tenant
+        self.in_flight = 0
+        self.waiting = 0
+        self.virtual_time = 0.0
+        self._heap: list[tuple[float, int, float, asyncio.Future, TenantQueue]] = []
+        self._sequence = itertools.count()
+        self._tenants: dict[str, TenantQueue] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_inflight > 0
+
+    def _tenant(self, name: str, weight: float) -> TenantQueue:
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            tenant = self._tenants[name] = TenantQueue()
+        tenant.weight = weight
+        return tenant
+
+    def _grant(self, tenant: TenantQueue) -> AdmissionTicket:
+        self.in_flight += 1
+        tenant.in_flight += 1
+        tenant.admitted += 1
+        return AdmissionTicket(self, tenant)
+
+    async def acquire(self, name: str, weight: float = 1.0) -> AdmissionTicket | None:
+        """Wait for a slot; raises AdmissionRejected on timeout or a full tenant queue."""
+        if not self.enabled:
+            return None
+        tenant = self._tenant(name, weight)
+        if self.in_flight < self.max_inflight and not self.waiting:
+            return self._grant(tenant)
+        if tenant.queued >= self.max_queue_per_tenant:
+            tenant.rejected_full += 1
+            raise AdmissionRejected("queue_full")
+
+        start_tag = max(self.virtual_time, tenant.last_finish)
+        finish_tag = tenant.last_finish = start_tag + 1.0 / tenant.weight
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (finish_tag, next(self._sequence), start_tag, future, tenant))
+        tenant.queued += 1
+        tenant.queued_total += 1
+        self.waiting += 1
+        enqueued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            if future.done() and not future.cancelled():
+                # Granted just as the wait ended: keep the slot on timeout, hand it back on cancellation.
+                ticket = AdmissionTicket(self, tenant)
+                if isinstance(exc, asyncio.CancelledError):
+                    ticket.release()
+                    raise
+                return ticket
+            future.cancel()
+            tenant.queued -= 1
+            self.waiting -= 1
+            # Never served: refund its share so the tenant's next request is not pushed back.
+            tenant.last_finish -= finish_tag - start_tag
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            tenant.timeouts += 1
+            raise AdmissionRejected("queue_timeout") from None
+        finally:
+            waited = time.monotonic() - enqueued_at
+            tenant.total_wait += waited
+            tenant.max_wait = max(tenant.max_wait, waited)
+        return AdmissionTicket(self, tenant)
+
+    def _release(self, tenant: TenantQueue) -> None:
+        self.in_flight -= 1
+        tenant.in_flight -= 1
+        while self._heap and self.in_flight < self.max_inflight:
+            _, _, start_tag, future, waiting = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            self.virtual_time = max(self.virtual_time, start_tag)
+            self.waiting -= 1
+            waiting.queued -= 1
+            self.in_flight += 1
+            waiting.in_flight += 1
+            waiting.admitted += 1
+            future.set_result(None)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "max_inflight": self.max_inflight,
+            "in_flight": self.in_flight,
+            "queued": self.waiting,
+            "queue_timeout_seconds": self.queue_timeout,
+            "tenants": {name or "anonymous": tenant.snapshot() for name, tenant in self._tenants.items()},
+        }
+
+
+admission = AdmissionScheduler(MAX_INFLIGHT_REQUESTS, QUEUE_TIMEOUT_SECONDS, QUEUE_MAX_PER_TENANT)
+
+
+def create_admission_rejected_response(reason: str) -> JSONResponse:
+    message = "服务繁忙，排队等待超时，请稍后重试" if reason == "queue_timeout" else "服务繁忙，当前租户排队请求过多，请稍后重试"
+    response = create_error_response({"message": message, "type": "server_overloaded", "code": reason}, 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+def create_rate_limit_response(decision: RateLimitDecision) -> JSONResponse:
+    response = create_error_response(
+        {
+            "message": f"代理 Key 超出速率限制，请在 {math.ceil(decision.retry_after)} 秒后重试",
+            "type": "rate_limit_error",
+            "code": "rate_limit_exceeded",
+        },
+        429,
+    )
+    response.headers.update(decision.headers)
+    response.headers["Retry-After"] = str(max(math.ceil(decision.retry_after), 1))
+    return response
+
+
+env_file = EnvFile()
+runtime_config = RuntimeConfig(
+    ConfigStore(CONFIG_DB_PATH, env_file, CONFIG_HISTORY_LIMIT) if CONFIG_DB_PATH else env_file
+)
+
+
+async def apply_config_change(mutation: Callable[[], ConfigSnapshot]) -> ConfigSnapshot:
+    """Apply an admin change on a worker thread; the store and .env writes block."""
+    try:
+        return await asyncio.to_thread(runtime_config.apply, mutation)
+    except ConfigConflict as exc:
+        raise HTTPException(status_code=409, detail="配置正在被其他进程修改，请稍后重试") from exc
 
-    async with api_key_lock:
-        key = keys[api_key_index % len(keys)]
-        api_key_index += 1
-        return key
+
+class ConfigWatcher:
+    """Polls the shared config store and reloads this worker when another one commits."""
+
+    def __init__(self, config: RuntimeConfig, interval: float):
+        self.config = config
+        self.interval = max(interval, 0.1)
+        self.reloads = 0
+        self._task: asyncio.Task | None = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await asyncio.to_thread(self.config.refresh):
+                    self.reloads += 1
+                    logger.info("Reloaded runtime config from the shared store")
+            except Exception:
+                logger.exception("Config store poll failed")
+
+    def start(self) -> None:
+        if isinstance(self.config.store, ConfigStore) and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
 
-runtime_config = RuntimeConfig(EnvFile())
+config_watcher = ConfigWatcher(runtime_config, CONFIG_POLL_SECONDS)
 
 
 class LoginRequest(BaseModel):
@@ -332,6 +1938,35 @@ class KeyAddRequest(BaseModel):
     key: str
 
 
+class KeyWeightRequest(BaseModel):
+    weight: float
+
+
+class ProxyKeyLimitsRequest(BaseModel):
+    rpm: int | None = None
+    tpm: int | None = None
+
+
+class KeyPoolSpec(BaseModel):
+    name: str
+    # Upstream key fingerprints ("key-1a2b3c4d") or positions in ANYROUTER_API_KEY.
+    keys: list[str | int] = []
+    overflow: bool = False
+
+
+class KeyPoolsUpdateRequest(BaseModel):
+    pools: list[KeyPoolSpec]
+
+
+class ProxyKeyPoolRequest(BaseModel):
+    pool: str = ""
+
+
+class ConfigImportRequest(BaseModel):
+    # .env formatted text; omitted to import the ENV_FILE_PATH file.
+    content: str | None = None
+
+
 class PasswordUpdateRequest(BaseModel):
     old_password: str
     new_password: str
@@ -401,6 +2036,13 @@ def mask_key(key: str) -> str:
     return f"{key[:4]}...{key[-4:]}"
 
 
+def proxy_key_at(index: int) -> str:
+    keys = runtime_config.snapshot().proxy_api_keys
+    if index < 0 or index >= len(keys):
+        raise HTTPException(status_code=400, detail="代理 Key 序号超出范围")
+    return keys[index]
+
+
 def normalize_key_list(values: list[str]) -> list[str]:
     keys: list[str] = []
     for value in values:
@@ -411,7 +2053,7 @@ def normalize_key_list(values: list[str]) -> list[str]:
     return keys
 
 
-def extract_presented_api_keys(request: Request) -> list[str]:
+def extract_presented_api_keys(request: HTTPConnection) -> list[str]:
     values: list[str] = []
     auth_header = request.headers.get("authorization", "")
     if auth_header.lower().startswith("bearer "):
@@ -422,17 +2064,17 @@ def extract_presented_api_keys(request: Request) -> list[str]:
     return values
 
 
-async def validate_proxy_access(request: Request) -> None:
-    config = runtime_config.snapshot()
-    proxy_keys = config["proxy_api_keys"]
-    if not proxy_keys:
-        return
+async def validate_proxy_access(request: HTTPConnection, config: ConfigSnapshot) -> ProxyKeyInfo | None:
+    """Authenticate the presented proxy key and expose its metadata as request.state.proxy_key."""
+    if not config.proxy_api_keys:
+        request.state.proxy_key = None
+        return None
 
-    presented_keys = extract_presented_api_keys(request)
-    for presented in presented_keys:
-        for expected in proxy_keys:
-            if hmac.compare_digest(presented, expected):
-                return
+    for presented in extract_presented_api_keys(request):
+        info = config.proxy_key_index.lookup(presented)
+        if info is not None:
+            request.state.proxy_key = info
+            return info
 
     raise HTTPException(
         status_code=401,
@@ -447,31 +2089,47 @@ async def validate_proxy_access(request: Request) -> None:
 
 def build_admin_config() -> dict[str, Any]:
     config = runtime_config.snapshot()
-    keys = config["api_keys"]
-    proxy_keys = config["proxy_api_keys"]
+    keys = config.api_keys
+    proxy_keys = config.proxy_api_keys
     return {
         "settings": {
-            "upstream_base_url": config["upstream_base_url"],
-            "model": config["model"],
-            "force_model": config["force_model"],
+            "upstream_base_url": config.upstream_base_url,
+            "model": config.model,
+            "force_model": config.force_model,
         },
         "api_keys": {
             "count": len(keys),
             "masked": [mask_key(key) for key in keys],
+            "weights": list(config.api_key_weights),
+            "states": key_scheduler.snapshot(config),
+            "probe_interval_seconds": KEY_PROBE_INTERVAL_SECONDS,
+            "last_probe_at": int(key_prober.last_run_at) if key_prober.last_run_at else None,
+        },
+        "key_pools": {
+            "pools": [
+                {"name": pool.name, "keys": list(pool.keys), "overflow": pool.overflow}
+                for pool in config.key_pools
+            ],
+            "stats": key_scheduler.pool_stats(config),
         },
         "proxy_api_keys": {
             "count": len(proxy_keys),
-            "values": proxy_keys,
+            "values": list(proxy_keys),
             "masked": [mask_key(key) for key in proxy_keys],
+            "tenants": [config.proxy_key_index.lookup(key).tenant for key in proxy_keys],
+            "limits": [rate_limiter.snapshot(config.proxy_key_index.lookup(key)) for key in proxy_keys],
+            "pools": [config.proxy_key_index.lookup(key).pool for key in proxy_keys],
             "enabled": bool(proxy_keys),
         },
         "admin": {
-            "username": config["admin_username"],
-            "using_default_password": not config["has_custom_admin_password"],
+            "username": config.admin_username,
+            "using_default_password": not config.has_custom_admin_password,
         },
         "service": {
             "port": int(os.getenv("CODEX_PROXY_PORT", "9996")),
-            "env_file": str(runtime_config.env_file.path),
+            "env_file": str(env_file.path),
+            "config_store": str(runtime_config.store.path) if isinstance(runtime_config.store, ConfigStore) else "",
+            "config_version": config.version,
         },
     }
 
@@ -681,7 +2339,8 @@ ADMIN_HTML = """<!doctype html>
           <label class="check"><input id="forceModel" type="checkbox"> 强制所有请求使用默认模型</label>
           <div class="actions">
             <button id="saveSettings">保存配置</button>
-            <button class="secondary" id="reloadConfig">从 .env 重载</button>
+            <button class="secondary" id="reloadConfig">重载配置</button>
+            <button class="secondary" id="importEnv">从 .env 导入</button>
             <button class="ghost" id="logoutButton">退出登录</button>
           </div>
           <p id="settingsMessage" class="message"></p>
@@ -718,6 +2377,9 @@ ADMIN_HTML = """<!doctype html>
         <section class="panel">
           <h2>AnyRouter API Key</h2>
           <div id="keyList" class="key-list"></div>
+          <div class="actions">
+            <button id="probeKeys" class="secondary">立即检测 Key 状态</button>
+          </div>
           <div class="field">
             <label for="newKey">添加单个 Key</label>
             <div class="row">
@@ -768,6 +2430,9 @@ base_url = "http://127.0.0.1:9996/v1"</code></pre>
     const $ = (id) => document.getElementById(id);
 
     function token() { return localStorage.getItem(tokenKey) || ""; }
+    function escapeHtml(value) {
+      return String(value).replace(/[&<>"']/g, (ch) => ({ "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;" })[ch]);
+    }
     function setMessage(id, text, kind = "") {
       const el = $(id);
       el.textContent = text || "";
@@ -799,7 +2464,9 @@ base_url = "http://127.0.0.1:9996/v1"</code></pre>
       $("loginView").classList.toggle("hidden", show);
       $("dashboardView").classList.toggle("hidden", !show);
     }
+    let currentConfig = null;
     function renderConfig(config) {
+      currentConfig = config;
       $("baseUrl").value = config.settings.upstream_base_url;
       $("model").value = config.settings.model;
       $("forceModel").checked = Boolean(config.settings.force_model);
@@ -813,9 +2480,12 @@ base_url = "http://127.0.0.1:9996/v1"</code></pre>
         proxyList.innerHTML = "<p class='message'>当前没有启用代理 Key。启用后第三方平台必须使用这里的 Key 调用。</p>";
       } else {
         config.proxy_api_keys.values.forEach((key, index) => {
+          const limits = (config.proxy_api_keys.limits || [])[index] || {};
+          const pool = (config.proxy_api_keys.pools || [])[index] || "";
+          const limitText = `RPM ${limits.rpm || "不限"} · TPM ${limits.tpm || "不限"} · Key 池 ${escapeHtml(pool || "共享")}`;
           const row = document.createElement("div");
           row.className = "key-item";
-          row.innerHTML = `<span>${index + 1}. ${key}</span><span class="actions"><button class="secondary" data-copy-proxy="${index}">复制</button><button class="danger" data-delete-proxy="${index}">删除</button></span>`;
+          row.innerHTML = `<span>${index + 1}. ${escapeHtml(key)}<br><small>${limitText}</small></span><span class="actions"><button class="secondary" data-copy-proxy="${index}">复制</button><button class="secondary" data-limits-proxy="${index}">限额</button><button class="secondary" data-pool-proxy="${index}">Key 池</button><button class="danger" data-delete-proxy="${index}">删除</button></span>`;
           proxyList.appendChild(row);
         });
       }
@@ -825,9 +2495,13 @@ base_url = "http://127.0.0.1:9996/v1"</code></pre>
         list.innerHTML = "<p class='message'>当前没有配置服务端 Key，将透传客户端 Authorization。</p>";
       } else {
         config.api_keys.masked.forEach((key, index) => {
+          const state = (config.api_keys.states || [])[index] || {};
+          const checked = state.last_check_at ? new Date(state.last_check_at * 1000).toLocaleString() : "未检测";
+          const health = { healthy: "正常", quarantined: "已隔离", unknown: "未知" }[state.health] || "未知";
+          const reason = state.quarantine_reason ? ` · ${escapeHtml(state.quarantine_reason)}` : "";
           const row = document.createElement("div");
           row.className = "key-item";
-          row.innerHTML = `<span>${index + 1}. ${key}</span><button class="danger" data-index="${index}">删除</button>`;
+          row.innerHTML = `<span>${index + 1}. ${key}<br><small>${health} · 最近检测 ${checked}${reason}</small></span><button class="danger" data-index="${index}">删除</button>`;
           list.appendChild(row);
         });
       }
@@ -872,8 +2546,18 @@ base_url = "http://127.0.0.1:9996/v1"</code></pre>
     };
     $("reloadConfig").onclick = async () => {
       try {
-        await api("/admin/api/reload", { method: "POST" });
-        setMessage("settingsMessage", "已从 .env 重载配置。", "ok");
+        const data = await api("/admin/api/reload", { method: "POST" });
+        setMessage("settingsMessage", data.message, "ok");
+        await loadConfig();
+      } catch (err) {
+        setMessage("settingsMessage", err.message, "error");
+      }
+    };
+    $("importEnv").onclick = async () => {
+      if (!window.confirm("用 .env 文件中的配置覆盖当前配置？")) return;
+      try {
+        const data = await api("/admin/api/config/import", { method: "POST", body: "{}" });
+        setMessage("settingsMessage", data.message, "ok");
         await loadConfig();
       } catch (err) {
         setMessage("settingsMessage", err.message, "error");
@@ -907,8 +2591,43 @@ base_url = "http://127.0.0.1:9996/v1"</code></pre>
     $("proxyKeyList").onclick = async (event) => {
       const copyButton = event.target.closest("button[data-copy-proxy]");
       if (copyButton) {
-        const rowText = copyButton.closest(".key-item").querySelector("span").textContent;
-        await copyText(rowText.replace(/^\\d+\\.\\s*/, ""), "proxyKeysMessage");
+        await copyText(currentConfig.proxy_api_keys.values[copyButton.dataset.copyProxy], "proxyKeysMessage");
+        return;
+      }
+      const limitsButton = event.target.closest("button[data-limits-proxy]");
+      if (limitsButton) {
+        const limits = (currentConfig.proxy_api_keys.limits || [])[limitsButton.dataset.limitsProxy] || {};
+        const value = window.prompt("RPM,TPM（留空或 0 表示不限）", `${limits.rpm || 0},${limits.tpm || 0}`);
+        if (value === null) return;
+        const [rpm, tpm] = value.split(",").map((item) => parseInt(item, 10) || null);
+        try {
+          await api(`/admin/api/proxy-keys/${limitsButton.dataset.limitsProxy}/limits`, {
+            method: "PUT",
+            body: JSON.stringify({ rpm, tpm: tpm || null }),
+          });
+          setMessage("proxyKeysMessage", "代理 Key 限额已更新。", "ok");
+          await loadConfig();
+        } catch (err) {
+          setMessage("proxyKeysMessage", err.message, "error");
+        }
+        return;
+      }
+      const poolButton = event.target.closest("button[data-pool-proxy]");
+      if (poolButton) {
+        const names = ((currentConfig.key_pools || {}).pools || []).map((pool) => pool.name);
+        const current = (currentConfig.proxy_api_keys.pools || [])[poolButton.dataset.poolProxy] || "";
+        const value = window.prompt(`Key 池名称（可选：${names.join("、") || "无"}；留空使用共享池）`, current);
+        if (value === null) return;
+        try {
+          await api(`/admin/api/proxy-keys/${poolButton.dataset.poolProxy}/pool`, {
+            method: "PUT",
+            body: JSON.stringify({ pool: value.trim() }),
+          });
+          setMessage("proxyKeysMessage", "代理 Key 所属 Key 池已更新。", "ok");
+          await loadConfig();
+        } catch (err) {
+          setMessage("proxyKeysMessage", err.message, "error");
+        }
         return;
       }
       const deleteButton = event.target.closest("button[data-delete-proxy]");
@@ -944,6 +2663,15 @@ base_url = "http://127.0.0.1:9996/v1"</code></pre>
         setMessage("keysMessage", err.message, "error");
       }
     };
+    $("probeKeys").onclick = async () => {
+      try {
+        const data = await api("/admin/api/keys/probe", { method: "POST" });
+        setMessage("keysMessage", data.message, "ok");
+        renderConfig(data.config);
+      } catch (err) {
+        setMessage("keysMessage", err.message, "error");
+      }
+    };
     $("keyList").onclick = async (event) => {
       const button = event.target.closest("button[data-index]");
       if (!button) return;
@@ -980,14 +2708,24 @@ base_url = "http://127.0.0.1:9996/v1"</code></pre>
 </html>"""
 
 
-async def resolve_upstream_api_key(request: Request) -> str:
-    config = runtime_config.snapshot()
-    if config["api_keys"]:
-        api_key = await select_api_key(config["api_keys"])
-        if api_key:
-            return api_key
+async def resolve_upstream_api_key(request: HTTPConnection, config: ConfigSnapshot) -> KeyLease:
+    if config.api_keys:
+        proxy_key = getattr(request.state, "proxy_key", None)
+        lease = key_scheduler.acquire(config, proxy_key.pool if proxy_key else "")
+        if lease:
+            return lease
+        # Every upstream key is reserved for a pool this proxy key is not assigned to.
+        raise HTTPException(
+            status_code=503,
+            detail={
+                "error": {
+                    "type": "configuration_error",
+                    "message": "共享 Key 池为空：所有上游 API Key 都已分配给专用 Key 池。",
+                }
+            },
+        )
 
-    if config["proxy_api_keys"]:
+    if config.proxy_api_keys:
         raise HTTPException(
             status_code=500,
             detail={
@@ -1000,14 +2738,14 @@ async def resolve_upstream_api_key(request: Request) -> str:
 
     auth_header = request.headers.get("authorization", "")
     if auth_header.lower().startswith("bearer "):
-        api_key = await select_api_key(split_api_keys(auth_header[7:]))
+        api_key = select_client_key(split_api_keys(auth_header[7:]))
         if api_key:
-            return api_key
+            return KeyLease(api_key)
 
     x_api_key = request.headers.get("x-api-key", "")
-    api_key = await select_api_key(split_api_keys(x_api_key))
+    api_key = select_client_key(split_api_keys(x_api_key))
     if api_key:
-        return api_key
+        return KeyLease(api_key)
 
     raise HTTPException(
         status_code=401,
@@ -1020,7 +2758,20 @@ async def resolve_upstream_api_key(request: Request) -> str:
     )
 
 
-def build_upstream_headers(request: Request, api_key: str, body_is_json: bool) -> dict[str, str]:
+def build_upstream_headers(
+    request: HTTPConnection,
+    api_key: str,
+    body_is_json: bool,
+    forward_accept_encoding: bool = False,
+    decodable_only: bool = False,
+) -> dict[str, str]:
+    """Upstream request headers.
+
+    With forward_accept_encoding the client's Accept-Encoding is sent so a
+    compressed upstream body can be relayed without decoding; decodable_only
+    keeps just the codings StreamDecoder can unpack for body observers.
+    Otherwise httpx negotiates its own encoding and decodes the body.
+    """
     headers: dict[str, str] = {}
     for key, value in request.headers.items():
         lower_key = key.lower()
@@ -1028,9 +2779,17 @@ def build_upstream_headers(request: Request, api_key: str, body_is_json: bool) -
             continue
         if lower_key in ("authorization", "x-api-key"):
             continue
+        if body_is_json and lower_key == "content-type":
+            continue
         headers[key] = value
 
     headers["Authorization"] = f"Bearer {api_key}"
+    client_accept_encoding = request.headers.get("accept-encoding")
+    if forward_accept_encoding and client_accept_encoding:
+        if decodable_only:
+            client_accept_encoding = decodable_accept_encoding(client_accept_encoding)
+        if client_accept_encoding:
+            headers["Accept-Encoding"] = client_accept_encoding
     if body_is_json:
         headers["Content-Type"] = "application/json"
     return headers
@@ -1087,6 +2846,7 @@ def maybe_rewrite_json_body(
     model: str,
     force_model: bool,
 ) -> tuple[bytes, bool]:
+    """Full parse-and-serialize rewrite; fallback when the top-level patch cannot decide."""
     if not body:
         return body, False
 
@@ -1105,44 +2865,1347 @@ def maybe_rewrite_json_body(
     return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), True
 
 
-def filter_response_headers(headers: httpx.Headers) -> dict[str, str]:
-    return {
-        key: value
-        for key, value in headers.items()
-        if key.lower() not in RESPONSE_SKIP_HEADERS
-    }
+JSON_STRUCT_TOKEN_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+JSON_STRING_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+JSON_LITERAL_RE = re.compile(rb"null|true|false|-?[0-9][0-9.eE+-]*")
+JSON_COLON_RE = re.compile(rb"\s*:\s*")
+JSON_WHITESPACE_RE = re.compile(rb"\s*")
 
 
-def normalize_openai_error(value: Any, fallback_message: str = "上游请求失败") -> dict[str, Any]:
-    if isinstance(value, bytes):
-        return normalize_openai_error(value.decode("utf-8", errors="replace"), fallback_message)
+class BodyPatchUnsupported(ValueError):
+    """The top-level scan could not decide; callers fall back to a full parse."""
 
-    if isinstance(value, str):
-        stripped = value.strip()
-        if stripped:
-            try:
-                return normalize_openai_error(json.loads(stripped), fallback_message)
-            except json.JSONDecodeError:
-                pass
-        return {
-            "message": stripped or fallback_message,
-            "type": "upstream_error",
-            "param": None,
-            "code": None,
-        }
 
-    if isinstance(value, dict):
-        if "error" in value:
-            return normalize_openai_error(value["error"], fallback_message)
-        message = value.get("message") or value.get("detail") or fallback_message
-        return {
-            "message": str(message),
-            "type": str(value.get("type") or "upstream_error"),
-            "param": value.get("param"),
-            "code": value.get("code"),
-        }
+def patch_top_level_model(body: Any, model: str, force_model: bool) -> tuple[int, int, bytes] | None:
+    """Locate the top-level "model" member without parsing the whole document.
 
-    return {
+    Only string and bracket tokens are visited (via a C-level regex), so large
+    string values such as base64 images are skipped in one step. Returns the
+    (start, end, replacement) splice to apply, or None when the body can be
+    forwarded unchanged.
+    """
+    start = JSON_WHITESPACE_RE.match(body, 0).end()
+    if start >= len(body) or body[start:start + 1] != b"{":
+        raise BodyPatchUnsupported("not a JSON object")
+
+    encoded_model = json.dumps(model, ensure_ascii=False).encode("utf-8")
+    depth = 0
+    for token in JSON_STRUCT_TOKEN_RE.finditer(body, start):
+        text = token.group()
+        if text in (b"{", b"["):
+            depth += 1
+            continue
+        if text in (b"}", b"]"):
+            depth -= 1
+            if depth == 0:
+                break
+            continue
+        if depth != 1 or text != b'"model"':
+            continue
+        colon = JSON_COLON_RE.match(body, token.end())
+        if colon is None or b":" not in colon.group():
+            continue  # a string value that happens to be "model"
+        value = JSON_STRING_RE.match(body, colon.end()) or JSON_LITERAL_RE.match(body, colon.end())
+        if value is None:
+            raise BodyPatchUnsupported("non-scalar model value")
+        try:
+            current = json.loads(value.group())
+        except json.JSONDecodeError as exc:
+            raise BodyPatchUnsupported("invalid model value") from exc
+        if current == model or (current and not force_model):
+            return None
+        return value.start(), value.end(), encoded_model
+    else:
+        raise BodyPatchUnsupported("unterminated JSON object")
+
+    # No top-level model: insert it as the first member.
+    insert_at = start + 1
+    after_brace = JSON_WHITESPACE_RE.match(body, insert_at).end()
+    separator = b"" if body[after_brace:after_brace + 1] == b"}" else b","
+    return insert_at, insert_at, b'"model":' + encoded_model + separator
+
+
+class BufferedRequestBody:
+    """Request body held in memory up to MAX_IN_MEMORY_BODY_BYTES, then in an anonymous temp file.
+
+    view() exposes the whole body as a bytes-like object (an mmap once
+    spilled), so regex scans and slicing never need a second full copy.
+    """
+
+    def __init__(self, max_in_memory: int = MAX_IN_MEMORY_BODY_BYTES):
+        self.max_in_memory = max_in_memory
+        self.size = 0
+        self._chunks: list[bytes] = []
+        self._file: Any = None
+        self._map: mmap.mmap | None = None
+        self._joined: bytes | None = None
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    async def read_from(self, request: Request, digest: Any = None) -> "BufferedRequestBody":
+        """Read the request body once; digest (a hashlib object) is fed the same chunks."""
+        async for chunk in request.stream():
+            if chunk:
+                self.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+        return self
+
+    def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self._file is None and self.size > self.max_in_memory:
+            self._file = tempfile.TemporaryFile()
+            for buffered in self._chunks:
+                self._file.write(buffered)
+            self._chunks = []
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._chunks.append(chunk)
+
+    def view(self) -> Any:
+        if self._file is None:
+            if self._joined is None:
+                self._joined = b"".join(self._chunks)
+                self._chunks = [self._joined]
+            return self._joined
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        return self._map
+
+    def content(self, splice: tuple[int, int, bytes] | None = None) -> tuple[Any, int]:
+        """Body to send upstream (bytes in memory, a chunk iterator when spilled) and its length."""
+        view = self.view()
+        start, end, replacement = splice if splice is not None else (self.size, self.size, b"")
+        length = self.size - (end - start) + len(replacement)
+        if not self.spilled:
+            if splice is None:
+                return view, length
+            return view[:start] + replacement + view[end:], length
+        return self._iter_spliced(start, end, replacement), length
+
+    async def _iter_spliced(self, start: int, end: int, replacement: bytes) -> AsyncGenerator[bytes, None]:
+        view = self.view()
+        for offset in range(0, start, BODY_CHUNK_SIZE):
+            yield view[offset:min(offset + BODY_CHUNK_SIZE, start)]
+        if replacement:
+            yield replacement
+        for offset in range(end, self.size, BODY_CHUNK_SIZE):
+            yield view[offset:offset + BODY_CHUNK_SIZE]
+
+    def close(self) -> None:
+        if self._map is not None and isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._chunks = []
+        self._joined = None
+
+
+def request_has_body(request: Request) -> bool:
+    if "transfer-encoding" in request.headers:
+        return True
+    content_length = request.headers.get("content-length", "")
+    return content_length.isdigit() and int(content_length) > 0
+
+
+def prepare_rewritten_body(
+    upstream_path: str,
+    method: str,
+    body: BufferedRequestBody,
+    model: str,
+    force_model: bool,
+) -> tuple[Any, int, bool]:
+    """Apply the default/forced model to a create request; returns (content, length, body_is_json)."""
+    try:
+        splice = patch_top_level_model(body.view(), model, force_model)
+    except BodyPatchUnsupported:
+        rewritten, body_is_json = maybe_rewrite_json_body(upstream_path, method, bytes(body.view()), model, force_model)
+        return rewritten, len(rewritten), body_is_json
+    content, length = body.content(splice)
+    return content, length, True
+
+
+def locate_top_level_values(body: Any, names: set[bytes]) -> dict[bytes, tuple[int, int]]:
+    """Spans of the values of the named top-level members (names include their quotes).
+
+    Uses the same token scan as patch_top_level_model, so nested content and
+    long strings are skipped without building Python objects.
+    """
+    start = JSON_WHITESPACE_RE.match(body, 0).end()
+    if start >= len(body) or body[start:start + 1] != b"{":
+        raise BodyPatchUnsupported("not a JSON object")
+
+    found: dict[bytes, tuple[int, int]] = {}
+    pending: tuple[bytes, int] | None = None
+    depth = 0
+    for token in JSON_STRUCT_TOKEN_RE.finditer(body, start):
+        text = token.group()
+        if text in (b"{", b"["):
+            depth += 1
+            continue
+        if text in (b"}", b"]"):
+            depth -= 1
+            if pending is not None and depth == 1:
+                found[pending[0]] = (pending[1], token.end())
+                pending = None
+            if depth == 0:
+                break
+            continue
+        if depth != 1 or pending is not None or text not in names:
+            continue
+        colon = JSON_COLON_RE.match(body, token.end())
+        if colon is None or b":" not in colon.group():
+            continue
+        if body[colon.end():colon.end() + 1] in (b"{", b"["):
+            pending = (text, colon.end())
+            continue
+        value = JSON_STRING_RE.match(body, colon.end()) or JSON_LITERAL_RE.match(body, colon.end())
+        if value is None:
+            raise BodyPatchUnsupported("invalid member value")
+        found[text] = (value.start(), value.end())
+    else:
+        raise BodyPatchUnsupported("unterminated JSON object")
+    return found
+
+
+def concat_json_arrays(*arrays: bytes) -> bytes:
+    items = [array.strip()[1:-1].strip() for array in arrays]
+    return b"[" + b",".join(item for item in items if item) + b"]"
+
+
+def input_items_bytes(value: bytes | None) -> bytes:
+    """Responses `input` as a JSON array; a bare string becomes one user message."""
+    if value is None or value == b"null":
+        return b"[]"
+    if value.startswith(b"["):
+        return value
+    return b'[{"role":"user","content":' + value + b"}]"
+
+
+@dataclass
+class StoredConversation:
+    size: int
+    expires_at: float
+    items: bytes | None = None
+    path: Path | None = None
+
+
+class ResponseStore:
+    """Full Responses conversations (input + output items) keyed by response id.
+
+    Lets clients send previous_response_id plus only the new input items; the
+    proxy splices the stored history back in before forwarding, without
+    parsing it. Entries are scoped per proxy key, expire after ttl_seconds,
+    and are evicted oldest-first beyond max_bytes -- to spill_dir when one is
+    configured (itself bounded by max_disk_bytes), otherwise dropped.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, spill_dir: str = "", max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.spill_root = spill_dir
+        self.max_disk_bytes = max_disk_bytes if spill_dir else 0
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[tuple[str, str], StoredConversation] = OrderedDict()
+        self._disk: OrderedDict[tuple[str, str], StoredConversation] = OrderedDict()
+        self._spill_dir: Path | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    async def get(self, scope: str, response_id: str) -> bytes | None:
+        key = (scope, response_id)
+        now = time.monotonic()
+        self._expire(now)
+        if key in self._memory and self._memory[key].expires_at <= now:
+            self._drop_memory(key)
+        if key in self._disk and self._disk[key].expires_at <= now:
+            self._drop_disk(key)
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return entry.items
+        entry = self._disk.get(key)
+        if entry is None or entry.path is None:
+            self.misses += 1
+            return None
+        try:
+            items = await asyncio.to_thread(entry.path.read_bytes)
+        except OSError as exc:
+            logger.warning("Response store spill read failed: %s", exc)
+            self._drop_disk(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return items
+
+    async def put(self, scope: str, response_id: str, items: bytes, parent_id: str | None = None) -> None:
+        if len(items) > self.max_bytes:
+            return
+        key = (scope, response_id)
+        now = time.monotonic()
+        self._discard(key)
+        self._memory[key] = StoredConversation(size=len(items), expires_at=now + self.ttl_seconds, items=items)
+        self.memory_bytes += len(items)
+        if parent_id is not None and (scope, parent_id) in self._memory:
+            # The parent turn is now a strict prefix of this one; evict it first.
+            self._memory.move_to_end((scope, parent_id), last=False)
+        self._expire(now)
+        while self.memory_bytes > self.max_bytes and self._memory:
+            old_key, old_entry = self._memory.popitem(last=False)
+            self.memory_bytes -= old_entry.size
+            await self._spill(old_key, old_entry)
+
+    async def _spill(self, key: tuple[str, str], entry: StoredConversation) -> None:
+        if entry.items is None or entry.size > self.max_disk_bytes:
+            return
+        try:
+            if self._spill_dir is None:
+                Path(self.spill_root).mkdir(parents=True, exist_ok=True)
+                self._spill_dir = Path(tempfile.mkdtemp(prefix="responses-", dir=self.spill_root))
+            name = hashlib.sha256("\x1f".join(key).encode("utf-8")).hexdigest()
+            path = self._spill_dir / name
+            await asyncio.to_thread(path.write_bytes, entry.items)
+        except OSError as exc:
+            logger.warning("Response store spill write failed: %s", exc)
+            return
+        self._disk[key] = StoredConversation(size=entry.size, expires_at=entry.expires_at, path=path)
+        self.disk_bytes += entry.size
+        while self.disk_bytes > self.max_disk_bytes and self._disk:
+            self._drop_disk(next(iter(self._disk)))
+
+    def _expire(self, now: float) -> None:
+        # Entries are kept roughly in creation order, so expired ones sit at the front.
+        while self._memory and next(iter(self._memory.values())).expires_at <= now:
+            self._drop_memory(next(iter(self._memory)))
+        while self._disk and next(iter(self._disk.values())).expires_at <= now:
+            self._drop_disk(next(iter(self._disk)))
+
+    def _discard(self, key: tuple[str, str]) -> None:
+        self._drop_memory(key)
+        self._drop_disk(key)
+
+    def _drop_memory(self, key: tuple[str, str]) -> None:
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= entry.size
+
+    def _drop_disk(self, key: tuple[str, str]) -> None:
+        entry = self._disk.pop(key, None)
+        if entry is None:
+            return
+        self.disk_bytes -= entry.size
+        if entry.path is not None:
+            entry.path.unlink(missing_ok=True)
+
+    async def close(self) -> None:
+        self._memory.clear()
+        self._disk.clear()
+        self.memory_bytes = self.disk_bytes = 0
+        if self._spill_dir is not None:
+            await asyncio.to_thread(shutil.rmtree, self._spill_dir, True)
+            self._spill_dir = None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._memory),
+            "memory_bytes": self.memory_bytes,
+            "spilled_entries": len(self._disk),
+            "disk_bytes": self.disk_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+response_store = ResponseStore(
+    RESPONSE_STORE_MAX_BYTES,
+    RESPONSE_STORE_TTL_SECONDS,
+    RESPONSE_STORE_SPILL_DIR,
+    RESPONSE_STORE_MAX_DISK_BYTES,
+)
+
+
+class SSEEventBuffer:
+    """Splits a chunked SSE byte stream into complete events (without the blank-line terminator)."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        self._buffer += chunk
+        if b"\r" in self._buffer:
+            self._buffer[:] = self._buffer.replace(b"\r\n", b"\n")
+        events: list[bytes] = []
+        while True:
+            boundary = self._buffer.find(b"\n\n")
+            if boundary < 0:
+                return events
+            events.append(bytes(self._buffer[:boundary]))
+            del self._buffer[:boundary + 2]
+
+    def clear(self) -> None:
+        self._buffer.clear()
+
+
+def sse_event_data(event: bytes) -> bytes:
+    return b"\n".join(line[5:].lstrip() for line in event.split(b"\n") if line.startswith(b"data:"))
+
+
+def is_json_media_type(content_type: str) -> bool:
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return media_type == "application/json" or media_type.endswith("+json")
+
+
+def sse_event_json(event: bytes) -> Any:
+    data = sse_event_data(event)
+    if not data or data == b"[DONE]":
+        return None
+    try:
+        return json.loads(data)
+    except json.JSONDecodeError:
+        return None
+
+
+class ResponseRecorder:
+    """Tees an upstream Responses body and stores input + output once it completes.
+
+    Streaming bodies are scanned event by event and only response.completed is
+    parsed; JSON bodies are buffered up to the store's byte limit. Callers only
+    attach it to SSE or JSON bodies.
+    """
+
+    def __init__(
+        self,
+        store: ResponseStore,
+        scope: str,
+        input_items: bytes,
+        parent_id: str | None,
+        streaming: bool,
+    ):
+        self.store = store
+        self.scope = scope
+        self.input_items = input_items
+        self.parent_id = parent_id
+        self.streaming = streaming
+        self._events = SSEEventBuffer()
+        self._buffer = bytearray()
+        self._response: dict[str, Any] | None = None
+        self._overflow = False
+
+    def feed(self, chunk: bytes) -> None:
+        if self._overflow or self._response is not None:
+            return
+        if not self.streaming:
+            self._buffer += chunk
+            if len(self._buffer) > self.store.max_bytes:
+                self._overflow = True
+                self._buffer.clear()
+            return
+        for event in self._events.feed(chunk):
+            if b"response.completed" not in event:
+                continue
+            payload = sse_event_json(event)
+            if isinstance(payload, dict) and payload.get("type") == "response.completed":
+                response = payload.get("response")
+                if isinstance(response, dict):
+                    self._response = response
+                    self._events.clear()
+                    return
+
+    async def finish(self) -> None:
+        if not self.streaming and not self._overflow and self._buffer:
+            try:
+                payload = json.loads(bytes(self._buffer))
+            except ValueError:
+                payload = None
+            self._buffer.clear()
+            if isinstance(payload, dict) and payload.get("object") == "response":
+                self._response = payload
+        response = self._response
+        if response is None or not response.get("id") or not isinstance(response.get("output"), list):
+            return
+        output = json.dumps(response["output"], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        await self.store.put(
+            self.scope,
+            str(response["id"]),
+            concat_json_arrays(self.input_items, output),
+            self.parent_id,
+        )
+
+
+def usage_total_tokens(usage: Any) -> int:
+    if not isinstance(usage, dict):
+        return 0
+    total = usage.get("total_tokens")
+    if isinstance(total, int):
+        return total
+    input_tokens = usage.get("input_tokens", usage.get("prompt_tokens")) or 0
+    output_tokens = usage.get("output_tokens", usage.get("completion_tokens")) or 0
+    return int(input_tokens) + int(output_tokens)
+
+
+class UsageMeter:
+    """Reports the token usage of an upstream body once it is seen.
+
+    As a stream observer it scans SSE events for a usage object (Responses
+    response.completed, or the final chat chunk when include_usage is set) or
+    reads `usage` from a JSON body (callers skip other content types); the chat
+    bridge calls observe() directly with the usage it already parsed. on_usage
+    runs at most once.
+    """
+
+    def __init__(self, on_usage: Callable[[dict[str, Any], str], None], streaming: bool = True, model: str = ""):
+        self.on_usage = on_usage
+        self.streaming = streaming
+        self.model = model
+        self.usage: dict[str, Any] | None = None
+        self._events = SSEEventBuffer()
+        self._body = bytearray()
+
+    def observe(self, usage: Any, model: Any = None) -> None:
+        if self.usage is None and isinstance(usage, dict) and usage:
+            self.usage = usage
+            self._events.clear()
+            self._body.clear()
+            self.on_usage(usage, str(model or self.model))
+
+    def feed(self, chunk: bytes) -> None:
+        if self.usage is not None:
+            return
+        if not self.streaming:
+            if len(self._body) <= MAX_IN_MEMORY_BODY_BYTES:
+                self._body += chunk
+            return
+        for event in self._events.feed(chunk):
+            if b'"usage":{' not in event and b'"usage": {' not in event:
+                continue
+            payload = sse_event_json(event)
+            if isinstance(payload, dict):
+                response = payload.get("response")
+                source = response if isinstance(response, dict) else payload
+                self.observe(source.get("usage"), source.get("model"))
+            if self.usage is not None:
+                return
+
+    async def finish(self) -> None:
+        if self.usage is None and self._body and len(self._body) <= MAX_IN_MEMORY_BODY_BYTES:
+            try:
+                payload = json.loads(bytes(self._body))
+            except ValueError:
+                payload = None
+            if isinstance(payload, dict):
+                self.observe(payload.get("usage"), payload.get("model"))
+        self._body.clear()
+
+
+USAGE_COLUMNS = ("requests", "input_tokens", "output_tokens", "cached_tokens", "total_tokens")
+USAGE_GROUP_COLUMNS = ("proxy_key", "tenant", "upstream_key", "model")
+USAGE_BUCKET_SECONDS = {"minute": 60, "hour": 3600, "day": 86400}
+
+
+def usage_counts(usage: dict[str, Any]) -> tuple[int, int, int, int, int]:
+    """(requests, input, output, cached, total) from Responses or Chat usage."""
+    input_tokens = int(usage.get("input_tokens", usage.get("prompt_tokens")) or 0)
+    output_tokens = int(usage.get("output_tokens", usage.get("completion_tokens")) or 0)
+    details = usage.get("input_tokens_details") or usage.get("prompt_tokens_details") or {}
+    cached_tokens = int(details.get("cached_tokens") or 0) if isinstance(details, dict) else 0
+    return 1, input_tokens, output_tokens, cached_tokens, usage_total_tokens(usage)
+
+
+class UsageLedger:
+    """Token usage per (minute, proxy key, upstream key, model).
+
+    record() only bumps an in-memory aggregate. A background task swaps the
+    pending aggregates out every flush_seconds and upserts them in a single
+    SQLite transaction on a worker thread, so the event loop never touches
+    the database. Upstream keys are stored as fingerprints, never in full.
+    Aggregates that fail to flush are kept for the next attempt, up to
+    max_pending; beyond that new aggregates are dropped and counted.
+    """
+
+    def __init__(self, path: str, flush_seconds: float, retention_days: int, max_pending: int = USAGE_MAX_PENDING):
+        self.path = path
+        self.flush_seconds = max(flush_seconds, 1.0)
+        self.retention_days = retention_days
+        self.max_pending = max(max_pending, 1)
+        self.dropped = 0
+        self._pending: dict[tuple[int, str, str, str, str], list[int]] = {}
+        self._connection: sqlite3.Connection | None = None
+        self._db_lock = Lock()
+        self._task: asyncio.Task | None = None
+        self._last_prune = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def record(self, proxy_key: ProxyKeyInfo | None, upstream_key: str, model: str, usage: dict[str, Any]) -> None:
+        minute = int(time.time()) // 60 * 60
+        key = (
+            minute,
+            proxy_key.key_id if proxy_key else "",
+            proxy_key.tenant if proxy_key else "",
+            proxy_key_fingerprint(upstream_key) if upstream_key else "",
+            model,
+        )
+        self._add(key, usage_counts(usage))
+
+    def _add(self, key: tuple[int, str, str, str, str], counts: tuple[int, ...]) -> None:
+        totals = self._pending.get(key)
+        if totals is None:
+            if len(self._pending) >= self.max_pending:
+                if not self.dropped:
+                    logger.warning("Usage database unwritable and %d aggregates pending; dropping new usage", self.max_pending)
+                self.dropped += 1
+                return
+            totals = self._pending[key] = [0] * len(USAGE_COLUMNS)
+        for index, value in enumerate(counts):
+            totals[index] += value
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS usage_minutes (
+                    minute INTEGER NOT NULL,
+                    proxy_key TEXT NOT NULL,
+                    tenant TEXT NOT NULL,
+                    upstream_key TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    requests INTEGER NOT NULL DEFAULT 0,
+                    input_tokens INTEGER NOT NULL DEFAULT 0,
+                    output_tokens INTEGER NOT NULL DEFAULT 0,
+                    cached_tokens INTEGER NOT NULL DEFAULT 0,
+                    total_tokens INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (minute, proxy_key, upstream_key, model)
+                )
+                """
+            )
+            self._connection = connection
+        return self._connection
+
+    def _write(self, rows: list[tuple[Any, ...]], prune_before: int | None) -> None:
+        with self._db_lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    """
+                    INSERT INTO usage_minutes
+                        (minute, proxy_key, tenant, upstream_key, model,
+                         requests, input_tokens, output_tokens, cached_tokens, total_tokens)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (minute, proxy_key, upstream_key, model) DO UPDATE SET
+                        tenant = excluded.tenant,
+                        requests = requests + excluded.requests,
+                        input_tokens = input_tokens + excluded.input_tokens,
+                        output_tokens = output_tokens + excluded.output_tokens,
+                        cached_tokens = cached_tokens + excluded.cached_tokens,
+                        total_tokens = total_tokens + excluded.total_tokens
+                    """,
+                    rows,
+                )
+                if prune_before is not None:
+                    connection.execute("DELETE FROM usage_minutes WHERE minute < ?", (prune_before,))
+
+    async def flush(self) -> int:
+        if not self.enabled or not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        rows = [key + tuple(totals) for key, totals in pending.items()]
+        prune_before = None
+        now = time.time()
+        if self.retention_days > 0 and now - self._last_prune > 3600:
+            self._last_prune = now
+            prune_before = int(now) - self.retention_days * 86400
+        try:
+            await asyncio.to_thread(self._write, rows, prune_before)
+        except Exception as exc:
+            # Includes OSError from creating the data directory, not only sqlite3.Error.
+            logger.warning("Usage flush failed, keeping %d aggregates for retry: %s", len(rows), exc)
+            for row in rows:
+                self._add(row[:5], row[5:])
+            return 0
+        if self.dropped:
+            logger.warning("Usage database writable again; %d usage aggregates were dropped", self.dropped)
+            self.dropped = 0
+        return len(rows)
+
+    def _query(self, start: int, end: int, bucket_seconds: int, group_by: tuple[str, ...]) -> list[dict[str, Any]]:
+        bucket_expr = f"(minute / {bucket_seconds}) * {bucket_seconds}"
+        group_expr = ", ".join((bucket_expr, *group_by))
+        sums = ", ".join(f"SUM({column}) AS {column}" for column in USAGE_COLUMNS)
+        with self._db_lock:
+            connection = self._connect()
+            cursor = connection.execute(
+                f"SELECT {group_expr}, {sums} FROM usage_minutes "
+                f"WHERE minute >= ? AND minute < ? GROUP BY {group_expr} ORDER BY 1",
+                (start, end),
+            )
+            names = ("time", *group_by, *USAGE_COLUMNS)
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    async def query(self, start: int, end: int, bucket: str, group_by: tuple[str, ...]) -> list[dict[str, Any]]:
+        """Aggregated rows in [start, end); group_by must come from USAGE_GROUP_COLUMNS."""
+        await self.flush()
+        return await asyncio.to_thread(self._query, start, end, USAGE_BUCKET_SECONDS[bucket], group_by)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Usage flush failed unexpectedly")
+
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._connection is not None:
+            with self._db_lock:
+                self._connection.close()
+                self._connection = None
+
+
+usage_ledger = UsageLedger(USAGE_DB_PATH, USAGE_FLUSH_SECONDS, USAGE_RETENTION_DAYS)
+
+
+def usage_metering_enabled(request: HTTPConnection) -> bool:
+    proxy_key = getattr(request.state, "proxy_key", None)
+    return usage_ledger.enabled or (proxy_key is not None and bool(proxy_key.tpm_limit))
+
+
+def create_usage_meter(request: HTTPConnection, lease: KeyLease, streaming: bool = True, model: str = "") -> UsageMeter | None:
+    """Meter that records usage and charges the caller's TPM bucket; None when neither applies."""
+    if not usage_metering_enabled(request):
+        return None
+    proxy_key = getattr(request.state, "proxy_key", None)
+    charge = proxy_key is not None and bool(proxy_key.tpm_limit)
+    upstream_key = lease.key
+
+    def on_usage(usage: dict[str, Any], usage_model: str) -> None:
+        if charge:
+            rate_limiter.charge(proxy_key, usage_total_tokens(usage))
+        if usage_ledger.enabled:
+            usage_ledger.record(proxy_key, upstream_key, usage_model, usage)
+
+    return UsageMeter(on_usage, streaming, model)
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    media_type: str
+    # ETag sent to clients: the upstream one when present, otherwise a body hash.
+    etag: str
+    # Validators for conditional revalidation against the upstream.
+    upstream_etag: str
+    last_modified: str
+    fetched_at: float
+
+    def age(self, now: float) -> float:
+        return now - self.fetched_at
+
+
+class UpstreamResponseCache:
+    """TTL + stale-while-revalidate cache for whitelisted upstream GETs.
+
+    Entries are keyed by (path, query, scope), where scope is the upstream
+    key pool serving the caller (or the caller's own key when keys are passed
+    through), so callers never see a listing fetched with another account's
+    keys. Concurrent misses share one upstream request; a stale hit is served
+    at once while a single background request revalidates it with
+    If-None-Match / If-Modified-Since. Only 200 responses are stored.
+    """
+
+    def __init__(self, patterns: tuple[str, ...], ttl: float, stale: float, max_entries: int):
+        self.patterns = patterns
+        self.ttl = max(ttl, 0.0)
+        self.stale = max(stale, 0.0)
+        self.max_entries = max(max_entries, 1)
+        self.entries: OrderedDict[tuple[str, str, str], CachedResponse] = OrderedDict()
+        self._inflight: dict[tuple[str, str, str], asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.errors = 0
+
+    def cacheable(self, method: str, path: str) -> bool:
+        if method.upper() != "GET" or self.ttl <= 0:
+            return False
+        path = path.strip("/")
+        return any(fnmatch.fnmatchcase(path, pattern) for pattern in self.patterns)
+
+    async def get(
+        self,
+        key: tuple[str, str, str],
+        fetch: Callable[[dict[str, str]], Any],
+    ) -> tuple[CachedResponse | None, httpx.Response | None, str]:
+        """Return (entry, uncacheable upstream response, cache status)."""
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None and entry.age(now) <= self.ttl:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry, None, "HIT"
+        if entry is not None and entry.age(now) <= self.ttl + self.stale:
+            self.stale_hits += 1
+            self.entries.move_to_end(key)
+            if key not in self._inflight:
+                self._start_refresh(key, fetch, entry)
+            return entry, None, "STALE"
+        self.misses += 1
+        task = self._inflight.get(key) or self._start_refresh(key, fetch, entry)
+        entry, response = await asyncio.shield(task)
+        return entry, response, "MISS"
+
+    def _start_refresh(
+        self,
+        key: tuple[str, str, str],
+        fetch: Callable[[dict[str, str]], Any],
+        entry: CachedResponse | None,
+    ) -> asyncio.Task:
+        task = asyncio.create_task(self._refresh(key, fetch, entry))
+        self._inflight[key] = task
+
+        def done(finished: asyncio.Task) -> None:
+            self._inflight.pop(key, None)
+            if not finished.cancelled():
+                # Waiters may all have gone away; don't leave the error unretrieved.
+                finished.exception()
+
+        task.add_done_callback(done)
+        return task
+
+    async def _refresh(
+        self,
+        key: tuple[str, str, str],
+        fetch: Callable[[dict[str, str]], Any],
+        entry: CachedResponse | None,
+    ) -> tuple[CachedResponse | None, httpx.Response | None]:
+        validators: dict[str, str] = {}
+        if entry is not None and entry.upstream_etag:
+            validators["If-None-Match"] = entry.upstream_etag
+        if entry is not None and entry.last_modified:
+            validators["If-Modified-Since"] = entry.last_modified
+        try:
+            response = await fetch(validators)
+        except Exception as exc:
+            self.errors += 1
+            if entry is not None:
+                logger.warning("Upstream cache revalidation of /v1/%s failed: %s", key[0], exc)
+                return entry, None
+            raise
+        if response.status_code == 304 and entry is not None:
+            self.not_modified += 1
+            entry.fetched_at = time.monotonic()
+            return entry, None
+        if response.status_code != 200:
+            self.errors += 1
+            # Keep serving the last good copy through a transient upstream error.
+            return (entry, None) if entry is not None and response.status_code >= 500 else (None, response)
+        body = response.content
+        upstream_etag = response.headers.get("etag", "")
+        fresh = CachedResponse(
+            body=body,
+            media_type=response.headers.get("content-type", "application/json"),
+            etag=upstream_etag or f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+            upstream_etag=upstream_etag,
+            last_modified=response.headers.get("last-modified", ""),
+            fetched_at=time.monotonic(),
+        )
+        self.entries[key] = fresh
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return fresh, None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "paths": list(self.patterns),
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "errors": self.errors,
+        }
+
+
+upstream_cache = UpstreamResponseCache(
+    UPSTREAM_CACHE_PATHS,
+    UPSTREAM_CACHE_TTL_SECONDS,
+    UPSTREAM_CACHE_STALE_SECONDS,
+    UPSTREAM_CACHE_MAX_ENTRIES,
+)
+
+
+class IdempotencyConflict(ValueError):
+    """An Idempotency-Key was reused with a different request."""
+
+
+class ReplayCursor:
+    """Position of one reader in an IdempotentResponse, counted in chunks from the start."""
+
+    __slots__ = ("index", "__weakref__")
+
+    def __init__(self):
+        self.index = 0
+
+
+@dataclass
+class IdempotentResponse:
+    """One recorded response; readers follow the chunks as they arrive.
+
+    Past the store's byte limit the entry is marked overflowed: it will not be
+    replayed, and chunks every current reader has consumed are dropped, so it
+    only holds what its slowest reader has not sent yet.
+    """
+
+    body_hash: str
+    status_code: int = 0
+    headers: dict[str, str] = field(default_factory=dict)
+    chunks: list[bytes] = field(default_factory=list)
+    # Chunks dropped from the front of `chunks` after an overflow.
+    offset: int = 0
+    size: int = 0
+    started: bool = False
+    done: bool = False
+    overflowed: bool = False
+    retained: bool = False
+    expires_at: float = 0.0
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    cursors: weakref.WeakSet = field(default_factory=weakref.WeakSet)
+
+    def _notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def start(self, status_code: int, headers: dict[str, str]) -> None:
+        self.status_code = status_code
+        self.headers = headers
+        self.started = True
+        self._notify()
+
+    def append(self, chunk: bytes) -> None:
+        if chunk:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self._notify()
+
+    def overflow(self) -> None:
+        self.overflowed = True
+        self._trim()
+
+    def finish(self) -> None:
+        self.started = self.done = True
+        self._notify()
+
+    def _trim(self) -> None:
+        if not self.overflowed:
+            return
+        low = min((cursor.index for cursor in self.cursors), default=self.offset + len(self.chunks))
+        if low > self.offset:
+            del self.chunks[:low - self.offset]
+            self.offset = low
+
+    async def wait_started(self) -> None:
+        while not self.started:
+            await self.changed.wait()
+
+    def follow(self) -> AsyncGenerator[bytes, None]:
+        """A reader from the first chunk; call before the entry overflows."""
+        cursor = ReplayCursor()
+        # Registered now, not on first iteration, so chunks are kept for a reader that has not started yet.
+        self.cursors.add(cursor)
+        return self._follow(cursor)
+
+    async def _follow(self, cursor: ReplayCursor) -> AsyncGenerator[bytes, None]:
+        try:
+            while True:
+                changed = self.changed
+                while cursor.index < self.offset + len(self.chunks):
+                    chunk = self.chunks[cursor.index - self.offset]
+                    cursor.index += 1
+                    if self.overflowed:
+                        self._trim()
+                        # Wakes the pump waiting for readers to drain.
+                        self._notify()
+                    yield chunk
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            self.cursors.discard(cursor)
+            self._trim()
+            self._notify()
+
+
+class IdempotencyStore:
+    """Responses to POSTs carrying an Idempotency-Key, keyed by (scope, key).
+
+    The first request runs normally, but its response body is pumped by a
+    detached task into the entry, so a client that times out and retries
+    with the same key and body attaches to the still-running upstream
+    generation instead of starting a second one. Finished results are
+    replayed until ttl_seconds after completion; 5xx and 429 results are
+    dropped so the retry executes again. Completed entries are evicted
+    oldest-first beyond max_entries / max_bytes.
+
+    A response larger than max_bytes is never replayed: once it crosses the
+    limit it stops being buffered, is read from upstream only as fast as its
+    readers consume it, and retries get a 409 until it finishes.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int, max_bytes: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.executions = 0
+        self.attaches = 0
+        self.replays = 0
+        self.conflicts = 0
+        self.overflows = 0
+        self.entries: OrderedDict[tuple[str, str], IdempotentResponse] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def claim(self, key: tuple[str, str], body_hash: str) -> tuple[IdempotentResponse, bool]:
+        """Return (entry, whether the caller must execute the request)."""
+        self._expire(time.monotonic())
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = IdempotentResponse(body_hash)
+            self.entries[key] = entry
+            self.executions += 1
+            return entry, True
+        if entry.body_hash != body_hash:
+            self.conflicts += 1
+            raise IdempotencyConflict(key[1])
+        if entry.done:
+            self.replays += 1
+        else:
+            self.attaches += 1
+        return entry, False
+
+    def record(self, key: tuple[str, str], entry: IdempotentResponse, response: Response) -> None:
+        headers = {name: value for name, value in response.headers.items() if name.lower() != "content-length"}
+        entry.start(response.status_code, headers)
+        if not isinstance(response, StreamingResponse):
+            entry.append(bytes(response.body))
+            self._finish(key, entry, True)
+            return
+        task = asyncio.create_task(self._pump(key, entry, response.body_iterator))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _pump(self, key: tuple[str, str], entry: IdempotentResponse, body: Any) -> None:
+        ok = False
+        try:
+            async for chunk in body:
+                entry.append(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+                if not entry.overflowed and entry.size > self.max_bytes:
+                    self.overflows += 1
+                    entry.overflow()
+                if entry.overflowed:
+                    # Unbuffered: wait for the readers, and stop the upstream once none is left.
+                    while entry.chunks and entry.cursors:
+                        await entry.changed.wait()
+                    if not entry.cursors:
+                        logger.info("Idempotent response for key %s has no readers left; closing it", key[1])
+                        return
+            ok = True
+        except Exception as exc:
+            logger.warning("Idempotent response for key %s failed mid-stream: %s", key[1], exc)
+        finally:
+            self._finish(key, entry, ok)
+            close = getattr(body, "aclose", None)
+            if close is not None:
+                # Releases the upstream stream and key lease now rather than at garbage collection.
+                await close()
+
+    def _finish(self, key: tuple[str, str], entry: IdempotentResponse, ok: bool) -> None:
+        entry.expires_at = time.monotonic() + self.ttl_seconds
+        entry.finish()
+        if self.entries.get(key) is not entry:
+            return
+        if not ok or entry.overflowed or entry.size > self.max_bytes or entry.status_code >= 500 or entry.status_code == 429:
+            self.discard(key)
+            return
+        entry.retained = True
+        self.bytes += entry.size
+        # Finished entries sit in completion order, which is also expiry order.
+        self.entries.move_to_end(key)
+        self._evict()
+
+    def abandon(self, key: tuple[str, str], entry: IdempotentResponse) -> None:
+        """The original request failed before producing a response; wake attached retries."""
+        entry.finish()
+        if self.entries.get(key) is entry:
+            self.discard(key)
+
+    def discard(self, key: tuple[str, str]) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry.retained:
+            self.bytes -= entry.size
+
+    def _expire(self, now: float) -> None:
+        for key, entry in list(self.entries.items()):
+            if not entry.done:
+                continue
+            if entry.expires_at > now:
+                break
+            self.discard(key)
+
+    def _evict(self) -> None:
+        for key, entry in list(self.entries.items()):
+            if len(self.entries) <= self.max_entries and self.bytes <= self.max_bytes:
+                break
+            if entry.done:
+                self.discard(key)
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "in_flight": sum(1 for entry in self.entries.values() if not entry.done),
+            "bytes": self.bytes,
+            "executions": self.executions,
+            "attaches": self.attaches,
+            "replays": self.replays,
+            "conflicts": self.conflicts,
+            "overflows": self.overflows,
+        }
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_MAX_BYTES)
+
+
+def response_store_scope(request: HTTPConnection, config: ConfigSnapshot, lease: KeyLease) -> str:
+    proxy_key = getattr(request.state, "proxy_key", None)
+    if proxy_key is not None:
+        return proxy_key.key_id
+    if not config.api_keys:
+        return proxy_key_fingerprint(lease.key)
+    return ""
+
+
+async def prepare_stored_response_body(
+    body: BufferedRequestBody,
+    scope: str,
+    model: str,
+    force_model: bool,
+) -> tuple[BufferedRequestBody, bytes | None, str | None]:
+    """Expand previous_response_id from the local store.
+
+    Returns (body to forward, full input items to record, parent response id).
+    Only requests with "store": true are recorded, so clients that resend the
+    full history (Codex sends store: false) pay nothing. Unknown ids are
+    forwarded untouched and not recorded, since the full history is not
+    known here.
+    """
+    view = body.view()
+    try:
+        members = locate_top_level_values(view, {b'"input"', b'"previous_response_id"', b'"store"'})
+    except BodyPatchUnsupported:
+        return body, None, None
+    store_span = members.get(b'"store"')
+    record = store_span is not None and bytes(view[store_span[0]:store_span[1]]) == b"true"
+    previous_span = members.get(b'"previous_response_id"')
+    if not record and previous_span is None:
+        return body, None, None
+    input_span = members.get(b'"input"')
+    input_items = input_items_bytes(bytes(view[input_span[0]:input_span[1]]) if input_span else None)
+    try:
+        previous_id = json.loads(bytes(view[previous_span[0]:previous_span[1]])) if previous_span else None
+    except json.JSONDecodeError:
+        return body, None, None
+    if not isinstance(previous_id, str) or not previous_id:
+        return body, input_items if record else None, None
+
+    history = await response_store.get(scope, previous_id)
+    if history is None:
+        return body, None, None
+
+    # Only the (small) delta request is parsed; the stored history is spliced in as bytes.
+    try:
+        data = json.loads(bytes(view))
+    except json.JSONDecodeError:
+        return body, None, None
+    data.pop("previous_response_id", None)
+    data.pop("input", None)
+    if force_model or not data.get("model"):
+        data["model"] = model
+    merged = concat_json_arrays(history, input_items)
+    head = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    expanded = BufferedRequestBody()
+    expanded.write(head[:-1] + (b"," if data else b"") + b'"input":' + merged + b"}")
+    body.close()
+    return expanded, merged if record else None, previous_id
+
+
+def filter_response_headers(headers: httpx.Headers, keep_encoding: bool = False) -> dict[str, str]:
+    """Drop hop-by-hop headers; keep_encoding retains Content-Encoding/Length for raw passthrough."""
+    kept = {"content-encoding", "content-length"} if keep_encoding else set()
+    return {
+        key: value
+        for key, value in headers.items()
+        if key.lower() not in RESPONSE_SKIP_HEADERS or key.lower() in kept
+    }
+
+
+def parse_accept_encoding(value: str) -> dict[str, float]:
+    accepted: dict[str, float] = {}
+    for item in value.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, raw_quality = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(raw_quality)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def client_accepts_encoding(accept_encoding: str, content_encoding: str) -> bool:
+    """True when every coding in content_encoding (e.g. "gzip" or "gzip, br") is acceptable."""
+    accepted = parse_accept_encoding(accept_encoding)
+    codings = [coding.strip().lower() for coding in content_encoding.split(",") if coding.strip()]
+    if not codings:
+        return False
+    return all(accepted.get(coding, accepted.get("*", 0.0)) > 0 for coding in codings)
+
+
+# Codings StreamDecoder can unpack incrementally (zlib only, no optional packages).
+DECODABLE_CODINGS = ("gzip", "x-gzip", "deflate", "identity")
+
+
+def decodable_accept_encoding(accept_encoding: str) -> str:
+    """The client's Accept-Encoding limited to DECODABLE_CODINGS; empty when none remain."""
+    return ", ".join(
+        item.strip()
+        for item in accept_encoding.split(",")
+        if item.strip() and item.partition(";")[0].strip().lower() in DECODABLE_CODINGS
+    )
+
+
+class StreamDecoder:
+    """Incrementally undoes a Content-Encoding so observers can read a body relayed raw."""
+
+    def __init__(self, content_encoding: str):
+        codings = [coding.strip().lower() for coding in content_encoding.split(",") if coding.strip()]
+        # Codings are listed in the order they were applied, so undo them in reverse.
+        self._decoders: list[list[Any]] = [
+            [coding, self._decoder(coding), False] for coding in reversed(codings) if coding != "identity"
+        ]
+
+    @staticmethod
+    def supports(content_encoding: str) -> bool:
+        return all(
+            coding.strip().lower() in DECODABLE_CODINGS for coding in content_encoding.split(",") if coding.strip()
+        )
+
+    @staticmethod
+    def _decoder(coding: str) -> Any:
+        if coding in ("gzip", "x-gzip"):
+            return zlib.decompressobj(zlib.MAX_WBITS | 16)
+        return zlib.decompressobj()
+
+    def decode(self, chunk: bytes) -> bytes:
+        for entry in self._decoders:
+            coding, decoder, started = entry
+            try:
+                decoded = decoder.decompress(chunk)
+            except zlib.error:
+                if coding != "deflate" or started:
+                    raise
+                # Some servers send raw deflate without the zlib header.
+                decoder = entry[1] = zlib.decompressobj(-zlib.MAX_WBITS)
+                decoded = decoder.decompress(chunk)
+            entry[2] = True
+            chunk = decoded
+        return chunk
+
+    def flush(self) -> bytes:
+        data = b""
+        for _, decoder, _ in self._decoders:
+            data = decoder.decompress(data) + decoder.flush()
+        return data
+
+
+def normalize_openai_error(value: Any, fallback_message: str = "上游请求失败") -> dict[str, Any]:
+    if isinstance(value, bytes):
+        return normalize_openai_error(value.decode("utf-8", errors="replace"), fallback_message)
+
+    if isinstance(value, str):
+        stripped = value.strip()
+        if stripped:
+            try:
+                return normalize_openai_error(json.loads(stripped), fallback_message)
+            except json.JSONDecodeError:
+                pass
+        return {
+            "message": stripped or fallback_message,
+            "type": "upstream_error",
+            "param": None,
+            "code": None,
+        }
+
+    if isinstance(value, dict):
+        if "error" in value:
+            return normalize_openai_error(value["error"], fallback_message)
+        message = value.get("message") or value.get("detail") or fallback_message
+        return {
+            "message": str(message),
+            "type": str(value.get("type") or "upstream_error"),
+            "param": value.get("param"),
+            "code": value.get("code"),
+        }
+
+    return {
         "message": fallback_message,
         "type": "upstream_error",
         "param": None,
@@ -1194,11 +4257,129 @@ def create_responses_message(role: str, content: str) -> dict[str, Any]:
     }
 
 
-def create_codex_client_metadata() -> dict[str, str]:
-    session_id = str(uuid.uuid4())
+def derive_uuid(secret: bytes, *parts: str) -> str:
+    digest = hmac.new(secret, "\x1f".join(parts).encode("utf-8"), hashlib.sha256).digest()
+    return str(uuid.UUID(bytes=digest[:16], version=4))
+
+
+@dataclass
+class ChatSession:
+    session_id: str
+    installation_id: str
+    last_seen: float = 0.0
+
+
+class ChatSessionRegistry:
+    """Stable Codex identities for conversations bridged from /v1/chat/completions.
+
+    A conversation is anchored by its instructions and its input up to and
+    including the first assistant item, which every later turn repeats
+    verbatim; chats sharing a system prompt and opening message diverge there.
+    The session id is an HMAC of that anchor under the caller's secret (the
+    proxy key's, or a digest of the presented upstream credential), so
+    consecutive turns (on any worker) send the same session/thread ids and
+    prompt_cache_key and can hit the upstream prompt cache, while different
+    callers never share one. The registry is bounded by TTL and entry count.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(max_entries, 1)
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+
+    def resolve(self, secret: bytes, instructions: str, response_input: list[dict[str, Any]]) -> ChatSession:
+        prefix_length = len(response_input)
+        for index, item in enumerate(response_input):
+            if item.get("role") == "assistant" or item.get("type") == "function_call":
+                prefix_length = index + 1
+                break
+        prefix = json.dumps(response_input[:prefix_length], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        anchor = hashlib.sha256(f"{instructions}\x1f{prefix}".encode("utf-8")).hexdigest()
+        session_id = derive_uuid(secret, "session", anchor)
+        now = time.monotonic()
+        session = self._sessions.pop(session_id, None)
+        if session is None or now - session.last_seen > self.ttl_seconds:
+            session = ChatSession(session_id=session_id, installation_id=derive_uuid(secret, "installation"))
+        session.last_seen = now
+        self._sessions[session_id] = session
+        self._evict(now)
+        return session
+
+    def _evict(self, now: float) -> None:
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_entries and now - oldest.last_seen <= self.ttl_seconds:
+                break
+            self._sessions.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+chat_sessions = ChatSessionRegistry(CHAT_SESSION_TTL_SECONDS, CHAT_SESSION_MAX_ENTRIES)
+
+
+def chat_session_secret(request: HTTPConnection) -> bytes:
+    """Per-caller secret for chat session ids: the proxy key's, else one derived from the presented credential."""
+    proxy_key = getattr(request.state, "proxy_key", None)
+    if proxy_key is not None:
+        return proxy_key.session_secret
+    caller = ",".join(extract_presented_api_keys(request)) or (request.client.host if request.client else "")
+    return hmac.new(caller.encode("utf-8"), b"codex-chat-session", hashlib.sha256).digest()
+
+
+def convert_chat_tools(tools: Any) -> list[dict[str, Any]]:
+    """Chat `tools` ({"type": "function", "function": {...}}) to flat Responses function tools."""
+    converted: list[dict[str, Any]] = []
+    for tool in tools if isinstance(tools, list) else []:
+        if not isinstance(tool, dict) or tool.get("type") != "function":
+            continue
+        function = tool.get("function") or {}
+        if not function.get("name"):
+            continue
+        converted_tool: dict[str, Any] = {
+            "type": "function",
+            "name": function["name"],
+            "parameters": function.get("parameters") or {"type": "object", "properties": {}},
+        }
+        if function.get("description"):
+            converted_tool["description"] = function["description"]
+        if "strict" in function:
+            converted_tool["strict"] = function["strict"]
+        converted.append(converted_tool)
+    return converted
+
+
+def convert_chat_tool_choice(tool_choice: Any) -> Any:
+    if isinstance(tool_choice, dict):
+        function = tool_choice.get("function") or {}
+        if tool_choice.get("type") == "function" and function.get("name"):
+            return {"type": "function", "name": function["name"]}
+        return "auto"
+    if tool_choice in ("auto", "none", "required"):
+        return tool_choice
+    return "auto"
+
+
+def convert_chat_tool_call(tool_call: dict[str, Any]) -> dict[str, Any]:
+    """An assistant tool_call becomes a function_call item; the chat id is the Responses call_id."""
+    function = tool_call.get("function") or {}
+    arguments = function.get("arguments", "")
+    if not isinstance(arguments, str):
+        arguments = json.dumps(arguments, ensure_ascii=False)
+    return {
+        "type": "function_call",
+        "call_id": str(tool_call.get("id") or f"call_{secrets.token_hex(12)}"),
+        "name": str(function.get("name", "")),
+        "arguments": arguments,
+    }
+
+
+def create_codex_client_metadata(session: ChatSession | None = None) -> dict[str, str]:
+    session_id = session.session_id if session else str(uuid.uuid4())
     turn_id = str(uuid.uuid4())
     window_id = f"{session_id}:0"
-    installation_id = str(uuid.uuid4())
+    installation_id = session.installation_id if session else str(uuid.uuid4())
     turn_metadata = {
         "installation_id": installation_id,
         "session_id": session_id,
@@ -1219,11 +4400,14 @@ def create_codex_client_metadata() -> dict[str, str]:
     }
 
 
-def convert_chat_to_responses_request(chat_request: dict[str, Any], model: str) -> dict[str, Any]:
+def convert_chat_to_responses_request(
+    chat_request: dict[str, Any],
+    model: str,
+    session_secret: bytes = b"",
+) -> dict[str, Any]:
     messages = chat_request.get("messages", [])
     instructions: list[str] = [CODEX_COMPAT_INSTRUCTIONS]
     response_input: list[dict[str, Any]] = []
-    client_metadata = create_codex_client_metadata()
 
     for message in messages:
         if not isinstance(message, dict):
@@ -1235,25 +4419,43 @@ def convert_chat_to_responses_request(chat_request: dict[str, Any], model: str)
                 instructions.append(content)
             continue
         if role == "assistant":
-            response_input.append(create_responses_message("assistant", content))
+            tool_calls = message.get("tool_calls") or []
+            if content or not tool_calls:
+                response_input.append(create_responses_message("assistant", content))
+            response_input.extend(convert_chat_tool_call(tool_call) for tool_call in tool_calls if isinstance(tool_call, dict))
+        elif role == "tool" and message.get("tool_call_id"):
+            response_input.append({
+                "type": "function_call_output",
+                "call_id": str(message["tool_call_id"]),
+                "output": content,
+            })
         elif role == "tool":
             response_input.append(create_responses_message("user", f"Tool result:\n{content}"))
         else:
             response_input.append(create_responses_message("user", content))
 
+    response_input = response_input or [create_responses_message("user", "")]
+    joined_instructions = "\n\n".join(instructions)
+    client_metadata = create_codex_client_metadata(
+        chat_sessions.resolve(session_secret, joined_instructions, response_input)
+    )
+
     responses_request: dict[str, Any] = {
         "model": model,
-        "input": response_input or [create_responses_message("user", "")],
+        "input": response_input,
         "stream": True,
-        "instructions": "\n\n".join(instructions),
+        "instructions": joined_instructions,
         "client_metadata": client_metadata,
         "prompt_cache_key": client_metadata["session_id"],
         "store": False,
-        "parallel_tool_calls": True,
-        "tool_choice": "auto",
+        "parallel_tool_calls": bool(chat_request.get("parallel_tool_calls", True)),
+        "tool_choice": convert_chat_tool_choice(chat_request.get("tool_choice")),
         "include": ["reasoning.encrypted_content"],
         "text": {"verbosity": "low"},
     }
+    tools = convert_chat_tools(chat_request.get("tools"))
+    if tools:
+        responses_request["tools"] = tools
 
     max_tokens = chat_request.get("max_completion_tokens", chat_request.get("max_tokens"))
     if max_tokens is not None:
@@ -1300,8 +4502,29 @@ def convert_responses_usage(response_json: dict[str, Any]) -> dict[str, int]:
     }
 
 
+def extract_responses_tool_calls(response_json: dict[str, Any]) -> list[dict[str, Any]]:
+    tool_calls: list[dict[str, Any]] = []
+    for item in response_json.get("output", []):
+        if isinstance(item, dict) and item.get("type") == "function_call":
+            tool_calls.append({
+                "id": str(item.get("call_id") or item.get("id") or ""),
+                "type": "function",
+                "function": {"name": str(item.get("name", "")), "arguments": str(item.get("arguments") or "")},
+            })
+    return tool_calls
+
+
 def create_chat_completion_response(response_json: dict[str, Any], model: str) -> dict[str, Any]:
     finish_reason = "stop" if response_json.get("status") != "cancelled" else "length"
+    message: dict[str, Any] = {
+        "role": "assistant",
+        "content": extract_responses_text(response_json),
+    }
+    tool_calls = extract_responses_tool_calls(response_json)
+    if tool_calls:
+        message["content"] = message["content"] or None
+        message["tool_calls"] = tool_calls
+        finish_reason = "tool_calls"
     return {
         "id": f"chatcmpl-{secrets.token_hex(12)}",
         "object": "chat.completion",
@@ -1310,10 +4533,7 @@ def create_chat_completion_response(response_json: dict[str, Any], model: str) -
         "choices": [
             {
                 "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": extract_responses_text(response_json),
-                },
+                "message": message,
                 "finish_reason": finish_reason,
             }
         ],
@@ -1327,12 +4547,15 @@ def create_chat_stream_chunk(
     content: str | None = None,
     role: str | None = None,
     finish_reason: str | None = None,
+    tool_calls: list[dict[str, Any]] | None = None,
 ) -> dict[str, Any]:
-    delta: dict[str, str] = {}
+    delta: dict[str, Any] = {}
     if role is not None:
         delta["role"] = role
     if content is not None:
         delta["content"] = content
+    if tool_calls is not None:
+        delta["tool_calls"] = tool_calls
     return {
         "id": request_id,
         "object": "chat.completion.chunk",
@@ -1348,23 +4571,110 @@ def create_chat_stream_chunk(
     }
 
 
+class ToolCallStream:
+    """Maps streamed Responses function_call items to chat tool_calls deltas.
+
+    Each item gets the next tool_calls index when it is added; argument deltas
+    are forwarded as they arrive, and the final arguments are sent in one piece
+    only when the upstream produced no deltas for the item.
+    """
+
+    def __init__(self):
+        self._indexes: dict[str, int] = {}
+        self._streamed: set[str] = set()
+
+    @property
+    def count(self) -> int:
+        return len(self._indexes)
+
+    def _start(self, item: dict[str, Any]) -> dict[str, Any] | None:
+        item_id = str(item.get("id") or item.get("call_id") or "")
+        if item_id in self._indexes:
+            return None
+        index = self._indexes[item_id] = len(self._indexes)
+        return {
+            "index": index,
+            "id": str(item.get("call_id") or item_id),
+            "type": "function",
+            "function": {"name": str(item.get("name", "")), "arguments": ""},
+        }
+
+    def feed(self, event: dict[str, Any]) -> list[dict[str, Any]]:
+        event_type = event.get("type")
+        item = event.get("item")
+        if event_type == "response.output_item.added":
+            if isinstance(item, dict) and item.get("type") == "function_call":
+                started = self._start(item)
+                return [started] if started else []
+        elif event_type == "response.function_call_arguments.delta":
+            item_id = str(event.get("item_id", ""))
+            delta = event.get("delta", "")
+            if item_id in self._indexes and delta:
+                self._streamed.add(item_id)
+                return [{"index": self._indexes[item_id], "function": {"arguments": delta}}]
+        elif event_type == "response.output_item.done":
+            if isinstance(item, dict) and item.get("type") == "function_call":
+                item_id = str(item.get("id") or item.get("call_id") or "")
+                started = self._start(item)
+                arguments = str(item.get("arguments") or "") if item_id not in self._streamed else ""
+                self._streamed.add(item_id)
+                if started:
+                    started["function"]["arguments"] = arguments
+                    return [started]
+                if arguments:
+                    return [{"index": self._indexes[item_id], "function": {"arguments": arguments}}]
+        return []
+
+
 async def iter_upstream_response(
     response: httpx.Response,
     stream_context: Any,
+    lease: KeyLease,
+    raw: bool = False,
+    observers: tuple[Any, ...] = (),
 ) -> AsyncGenerator[bytes, None]:
+    """Relay the upstream body; observers (feed/finish) see the decoded bytes as they pass.
+
+    With raw the still-encoded bytes are relayed and a StreamDecoder unpacks
+    a copy for the observers; a body it cannot decode is still relayed, just
+    no longer observed.
+    """
+    chunks = response.aiter_raw() if raw else response.aiter_bytes()
+    decoder = StreamDecoder(response.headers.get("content-encoding", "")) if raw and observers else None
     try:
-        async for chunk in response.aiter_bytes():
+        async for chunk in chunks:
             if chunk:
+                if observers:
+                    observers = feed_observers(observers, decoder, chunk)
                 yield chunk
+        if decoder is not None and observers:
+            observers = feed_observers(observers, decoder, None)
+        for observer in observers:
+            await observer.finish()
     finally:
+        lease.release()
         await stream_context.__aexit__(None, None, None)
 
 
-def should_bridge_chat_completions(upstream_path: str, request_body: dict[str, Any], config: dict[str, Any]) -> bool:
+def feed_observers(observers: tuple[Any, ...], decoder: StreamDecoder | None, chunk: bytes | None) -> tuple[Any, ...]:
+    """Feed one chunk (None flushes the decoder); returns the observers still attached."""
+    if decoder is not None:
+        try:
+            chunk = decoder.decode(chunk) if chunk is not None else decoder.flush()
+        except zlib.error as exc:
+            logger.warning("Cannot decode upstream body for inspection, relaying it unobserved: %s", exc)
+            return ()
+    if chunk:
+        for observer in observers:
+            observer.feed(chunk)
+    return observers
+
+
+def should_bridge_chat_completions(upstream_path: str, request_body: dict[str, Any], config: ConfigSnapshot) -> bool:
     if upstream_path.strip("/") != "chat/completions":
         return False
-    model = request_body.get("model") or config["model"]
-    return bool(config["force_model"] or model == config["model"])
+    model = request_body.get("model") or config.model
+    return bool(config.force_model or model == config.model)
 
 
 async def stream_responses_as_chat_completions(
@@ -1372,12 +4682,16 @@ async def stream_responses_as_chat_completions(
     upstream_url: str,
     headers: dict[str, str],
     model: str,
+    lease: KeyLease,
+    meter: UsageMeter | None = None,
 ) -> AsyncGenerator[str, None]:
     request_id = f"chatcmpl-{secrets.token_hex(12)}"
     yielded_role = False
+    tool_calls = ToolCallStream()
 
     try:
         async with get_client().stream("POST", upstream_url, headers=headers, json=responses_request) as resp:
+            lease.record(resp.status_code, headers=resp.headers)
             if resp.status_code != 200:
                 error_text = await resp.aread()
                 yield f"data: {json.dumps({'error': normalize_openai_error(error_text)}, ensure_ascii=False)}\n\n"
@@ -1403,21 +4717,41 @@ async def stream_responses_as_chat_completions(
                     delta = event.get("delta", "")
                     if delta:
                         yield f"data: {json.dumps(create_chat_stream_chunk(request_id, model, content=delta), ensure_ascii=False)}\n\n"
+                elif event_type in (
+                    "response.output_item.added",
+                    "response.function_call_arguments.delta",
+                    "response.output_item.done",
+                ):
+                    tool_call_deltas = tool_calls.feed(event)
+                    if tool_call_deltas:
+                        if not yielded_role:
+                            yield f"data: {json.dumps(create_chat_stream_chunk(request_id, model, role='assistant'), ensure_ascii=False)}\n\n"
+                            yielded_role = True
+                        chunk = create_chat_stream_chunk(request_id, model, tool_calls=tool_call_deltas)
+                        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
                 elif event_type == "response.error":
                     yield f"data: {json.dumps({'error': normalize_openai_error(event.get('error', event))}, ensure_ascii=False)}\n\n"
                 elif event_type in ("response.completed", "response.failed", "response.cancelled", "response.incomplete"):
+                    response = event.get("response")
+                    if meter is not None and isinstance(response, dict):
+                        meter.observe(response.get("usage"))
                     break
 
             if not yielded_role:
                 yield f"data: {json.dumps(create_chat_stream_chunk(request_id, model, role='assistant'), ensure_ascii=False)}\n\n"
-            yield f"data: {json.dumps(create_chat_stream_chunk(request_id, model, finish_reason='stop'), ensure_ascii=False)}\n\n"
+            finish_reason = "tool_calls" if tool_calls.count else "stop"
+            yield f"data: {json.dumps(create_chat_stream_chunk(request_id, model, finish_reason=finish_reason), ensure_ascii=False)}\n\n"
             yield "data: [DONE]\n\n"
     except httpx.TimeoutException:
+        lease.record(None, "upstream timeout")
         yield f"data: {json.dumps({'error': normalize_openai_error({'message': '上游请求超时', 'type': 'timeout_error', 'code': 'upstream_timeout'})}, ensure_ascii=False)}\n\n"
         yield "data: [DONE]\n\n"
     except httpx.HTTPError as exc:
+        lease.record(None, str(exc))
         yield f"data: {json.dumps({'error': normalize_openai_error({'message': str(exc), 'type': 'upstream_error'})}, ensure_ascii=False)}\n\n"
         yield "data: [DONE]\n\n"
+    finally:
+        lease.release()
 
 
 async def collect_responses_stream_as_chat_completion(
@@ -1425,12 +4759,16 @@ async def collect_responses_stream_as_chat_completion(
     upstream_url: str,
     headers: dict[str, str],
     model: str,
+    lease: KeyLease,
+    meter: UsageMeter | None = None,
 ) -> JSONResponse:
     text_parts: list[str] = []
+    output_items: list[dict[str, Any]] = []
     final_response: dict[str, Any] = {}
 
     try:
         async with get_client().stream("POST", upstream_url, headers=headers, json=responses_request) as resp:
+            lease.record(resp.status_code, headers=resp.headers)
             if resp.status_code != 200:
                 return create_error_response(await resp.aread(), resp.status_code)
 
@@ -1450,24 +4788,37 @@ async def collect_responses_stream_as_chat_completion(
                     delta = event.get("delta", "")
                     if delta:
                         text_parts.append(str(delta))
+                elif event_type == "response.output_item.done":
+                    if isinstance(event.get("item"), dict):
+                        output_items.append(event["item"])
                 elif event_type == "response.error":
                     return create_error_response(event.get("error", event), 502)
                 elif event_type == "response.completed":
                     response = event.get("response")
                     if isinstance(response, dict):
                         final_response = response
+                        if meter is not None:
+                            meter.observe(response.get("usage"))
                 elif event_type in ("response.failed", "response.cancelled", "response.incomplete"):
                     response = event.get("response")
+                    if meter is not None and isinstance(response, dict):
+                        meter.observe(response.get("usage"))
                     if isinstance(response, dict) and response.get("error"):
                         return create_error_response(response["error"], 502)
                     break
     except httpx.TimeoutException:
+        lease.record(None, "upstream timeout")
         return create_error_response({"message": "上游请求超时", "type": "timeout_error", "code": "upstream_timeout"}, 504)
     except httpx.HTTPError as exc:
+        lease.record(None, str(exc))
         return create_error_response({"message": str(exc), "type": "upstream_error"}, 502)
+    finally:
+        lease.release()
 
     if text_parts:
         final_response["output_text"] = "".join(text_parts)
+    if not final_response.get("output") and output_items:
+        final_response["output"] = output_items
     final_response.setdefault("status", "completed")
     final_response.setdefault("usage", {})
     return JSONResponse(create_chat_completion_response(final_response, model))
@@ -1476,8 +4827,8 @@ async def collect_responses_stream_as_chat_completion(
 async def handle_chat_completions_via_responses(
     request: Request,
     original_body: bytes,
-    config: dict[str, Any],
-    api_key: str,
+    config: ConfigSnapshot,
+    lease: KeyLease,
 ) -> Response | None:
     try:
         chat_request = json.loads(original_body)
@@ -1488,22 +4839,36 @@ async def handle_chat_completions_via_responses(
     if not should_bridge_chat_completions("chat/completions", chat_request, config):
         return None
 
-    model = config["model"] if config["force_model"] or not chat_request.get("model") else chat_request["model"]
-    responses_request = convert_chat_to_responses_request(chat_request, model)
+    model = config.model if config.force_model or not chat_request.get("model") else chat_request["model"]
+    responses_request = convert_chat_to_responses_request(chat_request, model, chat_session_secret(request))
     headers = apply_codex_responses_headers(
-        build_upstream_headers(request, api_key, True),
+        build_upstream_headers(request, lease.key, True),
         responses_request["client_metadata"],
     )
-    upstream_url = build_upstream_url(config["upstream_base_url"], "responses", request.url.query)
+    upstream_url = build_upstream_url(config.upstream_base_url, "responses", request.url.query)
 
     if chat_request.get("stream"):
         return StreamingResponse(
-            stream_responses_as_chat_completions(responses_request, upstream_url, headers, model),
+            stream_responses_as_chat_completions(
+                responses_request,
+                upstream_url,
+                headers,
+                model,
+                lease,
+                create_usage_meter(request, lease, model=model),
+            ),
             media_type="text/event-stream",
             headers={"Cache-Control": "no-cache", "Connection": "keep-alive"},
         )
 
-    return await collect_responses_stream_as_chat_completion(responses_request, upstream_url, headers, model)
+    return await collect_responses_stream_as_chat_completion(
+        responses_request,
+        upstream_url,
+        headers,
+        model,
+        lease,
+        create_usage_meter(request, lease, model=model),
+    )
 
 
 @app.get("/admin", response_class=HTMLResponse)
@@ -1517,7 +4882,7 @@ async def admin_page():
 @app.post("/admin/api/login")
 async def admin_login(req: LoginRequest):
     config = runtime_config.snapshot()
-    if req.username != config["admin_username"] or not verify_password(req.password, runtime_config.admin_password):
+    if req.username != config.admin_username or not verify_password(req.password, config.admin_password):
         raise HTTPException(status_code=401, detail="用户名或密码不正确")
     return {"token": create_admin_token(req.username), "expires_in": ADMIN_TOKEN_TTL_SECONDS}
 
@@ -1532,7 +4897,9 @@ async def admin_get_config(request: Request):
 async def admin_update_settings(req: SettingsUpdateRequest, request: Request):
     await require_admin(request)
     try:
-        runtime_config.update_settings(req.upstream_base_url, req.model, req.force_model)
+        await apply_config_change(
+            lambda: runtime_config.update_settings(req.upstream_base_url, req.model, req.force_model)
+        )
     except ValueError as exc:
         raise HTTPException(status_code=400, detail=str(exc))
     return {"message": "配置已更新", "config": build_admin_config()}
@@ -1541,7 +4908,8 @@ async def admin_update_settings(req: SettingsUpdateRequest, request: Request):
 @app.put("/admin/api/keys")
 async def admin_replace_keys(req: KeysUpdateRequest, request: Request):
     await require_admin(request)
-    runtime_config.update_api_keys(normalize_key_list(req.keys))
+    keys = normalize_key_list(req.keys)
+    await apply_config_change(lambda: runtime_config.update_api_keys(keys))
     return {"message": "Key 列表已替换", "config": build_admin_config()}
 
 
@@ -1557,21 +4925,49 @@ async def admin_add_key(req: KeyAddRequest, request: Request):
     key = req.key.strip()
     if not key:
         raise HTTPException(status_code=400, detail="Key 不能为空")
-    keys = runtime_config.snapshot()["api_keys"]
-    keys.append(key)
-    runtime_config.update_api_keys(keys)
+    await apply_config_change(lambda: runtime_config.update_api_keys([*runtime_config.snapshot().api_keys, key]))
     return {"message": "Key 已添加", "config": build_admin_config()}
 
 
 @app.delete("/admin/api/keys/{index}")
 async def admin_delete_key(index: int, request: Request):
     await require_admin(request)
-    keys = runtime_config.snapshot()["api_keys"]
-    if index < 0 or index >= len(keys):
-        raise HTTPException(status_code=400, detail="Key 序号超出范围")
-    removed = keys.pop(index)
-    runtime_config.update_api_keys(keys)
-    return {"message": "Key 已删除", "removed_key": mask_key(removed), "config": build_admin_config()}
+    removed: list[str] = []
+
+    def mutate() -> ConfigSnapshot:
+        keys = list(runtime_config.snapshot().api_keys)
+        if index < 0 or index >= len(keys):
+            raise HTTPException(status_code=400, detail="Key 序号超出范围")
+        removed[:] = [keys.pop(index)]
+        return runtime_config.update_api_keys(keys)
+
+    await apply_config_change(mutate)
+    return {"message": "Key 已删除", "removed_key": mask_key(removed[0]), "config": build_admin_config()}
+
+
+@app.post("/admin/api/keys/probe")
+async def admin_probe_keys(request: Request):
+    await require_admin(request)
+    checked = await key_prober.probe_all(force=True)
+    return {"message": f"已检测 {checked} 个上游 Key", "config": build_admin_config()}
+
+
+@app.put("/admin/api/keys/{index}/weight")
+async def admin_update_key_weight(index: int, req: KeyWeightRequest, request: Request):
+    await require_admin(request)
+    if req.weight <= 0:
+        raise HTTPException(status_code=400, detail="权重必须大于 0")
+
+    def mutate() -> ConfigSnapshot:
+        config = runtime_config.snapshot()
+        if index < 0 or index >= len(config.api_keys):
+            raise HTTPException(status_code=400, detail="Key 序号超出范围")
+        weights = list(config.api_key_weights)
+        weights[index] = req.weight
+        return runtime_config.update_api_keys(list(config.api_keys), weights)
+
+    await apply_config_change(mutate)
+    return {"message": "Key 权重已更新", "config": build_admin_config()}
 
 
 @app.get("/admin/api/proxy-keys")
@@ -1583,7 +4979,8 @@ async def admin_get_proxy_keys(request: Request):
 @app.put("/admin/api/proxy-keys")
 async def admin_replace_proxy_keys(req: KeysUpdateRequest, request: Request):
     await require_admin(request)
-    runtime_config.update_proxy_api_keys(normalize_key_list(req.keys))
+    keys = normalize_key_list(req.keys)
+    await apply_config_change(lambda: runtime_config.update_proxy_api_keys(keys))
     return {"message": "代理 Key 列表已替换", "config": build_admin_config()}
 
 
@@ -1593,9 +4990,9 @@ async def admin_add_proxy_key(req: KeyAddRequest, request: Request):
     key = req.key.strip()
     if not key:
         raise HTTPException(status_code=400, detail="代理 Key 不能为空")
-    keys = runtime_config.snapshot()["proxy_api_keys"]
-    keys.append(key)
-    runtime_config.update_proxy_api_keys(keys)
+    await apply_config_change(
+        lambda: runtime_config.update_proxy_api_keys([*runtime_config.snapshot().proxy_api_keys, key])
+    )
     return {"message": "代理 Key 已添加", "config": build_admin_config()}
 
 
@@ -1603,28 +5000,118 @@ async def admin_add_proxy_key(req: KeyAddRequest, request: Request):
 async def admin_generate_proxy_key(request: Request):
     await require_admin(request)
     key = f"sk-proxy-{secrets.token_hex(24)}"
-    keys = runtime_config.snapshot()["proxy_api_keys"]
-    keys.append(key)
-    runtime_config.update_proxy_api_keys(keys)
+    await apply_config_change(
+        lambda: runtime_config.update_proxy_api_keys([*runtime_config.snapshot().proxy_api_keys, key])
+    )
     return {"message": "代理 Key 已生成", "key": key, "config": build_admin_config()}
 
 
 @app.delete("/admin/api/proxy-keys/{index}")
 async def admin_delete_proxy_key(index: int, request: Request):
     await require_admin(request)
-    keys = runtime_config.snapshot()["proxy_api_keys"]
-    if index < 0 or index >= len(keys):
-        raise HTTPException(status_code=400, detail="代理 Key 序号超出范围")
-    removed = keys.pop(index)
-    runtime_config.update_proxy_api_keys(keys)
-    return {"message": "代理 Key 已删除", "removed_key": mask_key(removed), "config": build_admin_config()}
+    removed: list[str] = []
+
+    def mutate() -> ConfigSnapshot:
+        keys = list(runtime_config.snapshot().proxy_api_keys)
+        if index < 0 or index >= len(keys):
+            raise HTTPException(status_code=400, detail="代理 Key 序号超出范围")
+        removed[:] = [keys.pop(index)]
+        return runtime_config.update_proxy_api_keys(keys)
+
+    await apply_config_change(mutate)
+    return {"message": "代理 Key 已删除", "removed_key": mask_key(removed[0]), "config": build_admin_config()}
+
+
+@app.put("/admin/api/proxy-keys/{index}/limits")
+async def admin_update_proxy_key_limits(index: int, req: ProxyKeyLimitsRequest, request: Request):
+    await require_admin(request)
+    if (req.rpm is not None and req.rpm < 0) or (req.tpm is not None and req.tpm < 0):
+        raise HTTPException(status_code=400, detail="限额不能为负数")
+    await apply_config_change(
+        lambda: runtime_config.update_proxy_key_limits(proxy_key_at(index), req.rpm, req.tpm)
+    )
+    return {"message": "代理 Key 限额已更新", "config": build_admin_config()}
+
+
+@app.put("/admin/api/proxy-keys/{index}/pool")
+async def admin_update_proxy_key_pool(index: int, req: ProxyKeyPoolRequest, request: Request):
+    await require_admin(request)
+    try:
+        await apply_config_change(lambda: runtime_config.update_proxy_key_pool(proxy_key_at(index), req.pool))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return {"message": "代理 Key 所属 Key 池已更新", "config": build_admin_config()}
+
+
+@app.get("/admin/api/key-pools")
+async def admin_get_key_pools(request: Request):
+    await require_admin(request)
+    return build_admin_config()["key_pools"]
+
+
+@app.put("/admin/api/key-pools")
+async def admin_replace_key_pools(req: KeyPoolsUpdateRequest, request: Request):
+    await require_admin(request)
+
+    def mutate() -> ConfigSnapshot:
+        api_keys = runtime_config.snapshot().api_keys
+        known = {proxy_key_fingerprint(key) for key in api_keys}
+        pools: list[KeyPool] = []
+        for spec in req.pools:
+            refs: list[str] = []
+            for ref in spec.keys:
+                if isinstance(ref, int):
+                    if ref < 0 or ref >= len(api_keys):
+                        raise HTTPException(status_code=400, detail="Key 序号超出范围")
+                    ref = proxy_key_fingerprint(api_keys[ref])
+                elif ref not in known:
+                    raise HTTPException(status_code=400, detail=f"未知的上游 Key 标识：{ref}")
+                refs.append(ref)
+            pools.append(KeyPool(spec.name.strip(), tuple(dict.fromkeys(refs)), spec.overflow))
+        return runtime_config.update_key_pools(tuple(pools))
+
+    try:
+        await apply_config_change(mutate)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return {"message": "Key 池已更新", "config": build_admin_config()}
+
+
+@app.get("/admin/api/usage")
+async def admin_get_usage(
+    request: Request,
+    start: int | None = None,
+    end: int | None = None,
+    bucket: str = "hour",
+    group_by: str = "proxy_key,model",
+):
+    await require_admin(request)
+    if not usage_ledger.enabled:
+        raise HTTPException(status_code=400, detail="用量统计未启用（USAGE_DB_PATH 为空）")
+    if bucket not in USAGE_BUCKET_SECONDS:
+        raise HTTPException(status_code=400, detail="bucket 只能是 minute、hour 或 day")
+    columns = tuple(dict.fromkeys(item.strip() for item in group_by.split(",") if item.strip()))
+    if any(column not in USAGE_GROUP_COLUMNS for column in columns):
+        raise HTTPException(status_code=400, detail=f"group_by 只能包含 {', '.join(USAGE_GROUP_COLUMNS)}")
+    end = end if end is not None else int(time.time()) + 60
+    start = start if start is not None else end - 86400
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start 必须早于 end")
+
+    rows = await usage_ledger.query(start, end, bucket, columns)
+    if "upstream_key" in columns:
+        masked = {proxy_key_fingerprint(key): mask_key(key) for key in runtime_config.snapshot().api_keys}
+        for row in rows:
+            row["upstream_key_masked"] = masked.get(row["upstream_key"], "")
+    totals = {column: sum(row[column] for row in rows) for column in USAGE_COLUMNS}
+    return {"start": start, "end": end, "bucket": bucket, "group_by": list(columns), "rows": rows, "totals": totals}
 
 
 @app.put("/admin/api/password")
 async def admin_update_password(req: PasswordUpdateRequest, request: Request):
     await require_admin(request)
     try:
-        runtime_config.update_admin_password(req.old_password, req.new_password)
+        await apply_config_change(lambda: runtime_config.update_admin_password(req.old_password, req.new_password))
     except ValueError as exc:
         raise HTTPException(status_code=400, detail=str(exc))
     return {"message": "密码已更新"}
@@ -1633,35 +5120,317 @@ async def admin_update_password(req: PasswordUpdateRequest, request: Request):
 @app.post("/admin/api/reload")
 async def admin_reload(request: Request):
     await require_admin(request)
-    runtime_config.load()
-    return {"message": "配置已从 .env 重载", "config": build_admin_config()}
+    await asyncio.to_thread(runtime_config.load)
+    message = "配置已从配置库重载" if isinstance(runtime_config.store, ConfigStore) else "配置已从 .env 重载"
+    return {"message": message, "config": build_admin_config()}
+
+
+@app.get("/admin/api/config/export")
+async def admin_export_config(request: Request):
+    await require_admin(request)
+    items = await asyncio.to_thread(runtime_config.store.read)
+    content = render_env_text({key: items[key] for key in CONFIG_KEYS if key in items})
+    return Response(
+        content=content,
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="codex-proxy.env"'},
+    )
+
+
+@app.post("/admin/api/config/import")
+async def admin_import_config(req: ConfigImportRequest, request: Request):
+    await require_admin(request)
+    items = parse_env_text(req.content) if req.content is not None else await asyncio.to_thread(env_file_items, env_file)
+    items = {key: items[key] for key in CONFIG_KEYS if key in items}
+    if not items:
+        raise HTTPException(status_code=400, detail="没有可导入的配置项")
+    await apply_config_change(lambda: runtime_config.import_settings(items))
+    return {"message": f"已导入 {len(items)} 个配置项", "config": build_admin_config()}
+
+
+@app.get("/admin/api/config/history")
+async def admin_get_config_history(request: Request):
+    await require_admin(request)
+    if not isinstance(runtime_config.store, ConfigStore):
+        raise HTTPException(status_code=400, detail="配置库未启用（CONFIG_DB_PATH 为空）")
+    return {"version": runtime_config.store.version, "history": await asyncio.to_thread(runtime_config.store.history)}
+
+
+@app.post("/admin/api/config/history/{version}/restore")
+async def admin_restore_config(version: int, request: Request):
+    await require_admin(request)
+    try:
+        await apply_config_change(lambda: runtime_config.restore(version))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return {"message": f"配置已回滚到版本 {version}", "config": build_admin_config()}
+
+
+async def serve_cached_get(request: Request, config: ConfigSnapshot, upstream_path: str) -> Response:
+    """Answer a whitelisted GET from upstream_cache, fetching or revalidating upstream as needed."""
+    proxy_key = getattr(request.state, "proxy_key", None)
+    if config.api_keys:
+        scope = f"pool:{proxy_key.pool if proxy_key else ''}"
+    else:
+        presented = ",".join(extract_presented_api_keys(request))
+        scope = f"client:{hashlib.sha256(presented.encode('utf-8')).hexdigest()[:16]}"
+    upstream_url = build_upstream_url(config.upstream_base_url, upstream_path, request.url.query)
+
+    async def fetch(validators: dict[str, str]) -> httpx.Response:
+        lease = await resolve_upstream_api_key(request, config)
+        try:
+            headers = {
+                key: value
+                for key, value in build_upstream_headers(request, lease.key, False).items()
+                if key.lower() not in ("if-none-match", "if-modified-since")
+            }
+            headers.update(validators)
+            logger.info("GET /v1/%s -> %s (cache fill)", upstream_path, upstream_url)
+            try:
+                response = await get_client().get(upstream_url, headers=headers)
+            except httpx.HTTPError as exc:
+                lease.record(None, str(exc))
+                raise
+            lease.record(response.status_code, headers=response.headers)
+            return response
+        finally:
+            lease.release()
+
+    try:
+        entry, response, status = await upstream_cache.get((upstream_path.strip("/"), request.url.query, scope), fetch)
+    except HTTPException as exc:
+        return create_error_response(exc.detail, exc.status_code)
+    except httpx.TimeoutException:
+        return create_error_response(
+            {"message": "上游请求超时", "type": "timeout_error", "code": "upstream_timeout"},
+            504,
+        )
+    except httpx.HTTPError as exc:
+        return create_error_response({"message": str(exc), "type": "upstream_error"}, 502)
+    if entry is None:
+        return Response(
+            content=response.content,
+            status_code=response.status_code,
+            headers=filter_response_headers(response.headers),
+            media_type=response.headers.get("content-type"),
+        )
+
+    headers = {
+        "ETag": entry.etag,
+        "Cache-Control": "no-cache",
+        "Age": str(int(entry.age(time.monotonic()))),
+        "X-Cache": status,
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type=entry.media_type, headers=headers)
+
+
+async def forward_idempotent(
+    upstream_path: str,
+    request: Request,
+    config: ConfigSnapshot,
+    proxy_key: ProxyKeyInfo | None,
+    idempotency_key: str,
+) -> Response:
+    """Run a POST at most once per Idempotency-Key; retries follow or replay the recorded response."""
+    if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        return create_error_response(
+            {"message": f"Idempotency-Key 长度不能超过 {IDEMPOTENCY_KEY_MAX_LENGTH}", "type": "invalid_request_error"},
+            400,
+        )
+    if proxy_key is not None:
+        scope = proxy_key.key_id
+    else:
+        # Without proxy keys, callers are still told apart by the credential they present.
+        presented = ",".join(extract_presented_api_keys(request))
+        scope = f"client:{hashlib.sha256(presented.encode('utf-8')).hexdigest()[:16]}"
+    digest = hashlib.sha256(f"{request.method.upper()} {upstream_path.strip('/')}?{request.url.query}\n".encode("utf-8"))
+    # The body is hashed while it is buffered (spilling to disk past MAX_IN_MEMORY_BODY_BYTES),
+    # and forward_v1 sends that buffer instead of reading the request a second time.
+    body = await BufferedRequestBody().read_from(request, digest)
+    try:
+        return await forward_idempotent_buffered(
+            upstream_path, request, config, proxy_key, (scope, idempotency_key), digest.hexdigest(), body
+        )
+    finally:
+        body.close()
+
+
+async def forward_idempotent_buffered(
+    upstream_path: str,
+    request: Request,
+    config: ConfigSnapshot,
+    proxy_key: ProxyKeyInfo | None,
+    key: tuple[str, str],
+    body_hash: str,
+    body: BufferedRequestBody,
+) -> Response:
+    idempotency_key = key[1]
+    try:
+        entry, execute = idempotency_store.claim(key, body_hash)
+    except IdempotencyConflict:
+        return create_error_response(
+            {
+                "message": "Idempotency-Key 已用于另一个不同的请求，请更换新的 Key",
+                "type": "invalid_request_error",
+                "code": "idempotency_key_reused",
+            },
+            422,
+        )
+    if execute:
+        try:
+            response = await forward_v1(upstream_path, request, config, proxy_key, body)
+        except BaseException:
+            idempotency_store.abandon(key, entry)
+            raise
+        idempotency_store.record(key, entry, response)
+    else:
+        logger.info("POST /v1/%s replaying Idempotency-Key %s", upstream_path, idempotency_key)
+        await entry.wait_started()
+        if not entry.status_code:
+            return create_error_response(
+                {"message": "相同 Idempotency-Key 的原请求执行失败，请重试", "type": "upstream_error"},
+                502,
+            )
+        if entry.overflowed:
+            response = create_error_response(
+                {
+                    "message": "相同 Idempotency-Key 的原请求响应过大，无法回放，请在其完成后重试",
+                    "type": "invalid_request_error",
+                    "code": "idempotency_key_in_use",
+                },
+                409,
+            )
+            response.headers["Retry-After"] = "1"
+            return response
+
+    headers = dict(entry.headers)
+    if not execute:
+        headers["Idempotent-Replayed"] = "true"
+    if entry.done:
+        return Response(content=b"".join(entry.chunks), status_code=entry.status_code, headers=headers)
+    return StreamingResponse(entry.follow(), status_code=entry.status_code, headers=headers)
 
 
 @app.api_route("/v1/{upstream_path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
 async def proxy_v1(upstream_path: str, request: Request):
     config = runtime_config.snapshot()
     try:
-        await validate_proxy_access(request)
-        api_key = await resolve_upstream_api_key(request)
+        proxy_key = await validate_proxy_access(request, config)
     except HTTPException as exc:
         return create_error_response(exc.detail, exc.status_code)
-    original_body = await request.body()
+    idempotency_key = request.headers.get("idempotency-key", "").strip()
+    if idempotency_key and idempotency_store.enabled and request.method.upper() == "POST":
+        return await forward_idempotent(upstream_path, request, config, proxy_key, idempotency_key)
+    return await forward_v1(upstream_path, request, config, proxy_key)
+
 
-    if upstream_path.strip("/") == "chat/completions":
-        bridged_response = await handle_chat_completions_via_responses(request, original_body, config, api_key)
+async def forward_v1(
+    upstream_path: str,
+    request: Request,
+    config: ConfigSnapshot,
+    proxy_key: ProxyKeyInfo | None,
+    body: BufferedRequestBody | None = None,
+) -> Response:
+    """Relay one /v1 request; body is the already-buffered request body, if the caller read it."""
+    rate_limit = rate_limiter.admit(config, proxy_key) if proxy_key is not None else None
+    if rate_limit is not None and not rate_limit.allowed:
+        return create_rate_limit_response(rate_limit)
+    if upstream_cache.cacheable(request.method, upstream_path):
+        # Cached reads skip admission: a hit never reaches the upstream and misses are single-flight.
+        cached_response = await serve_cached_get(request, config, upstream_path)
+        if rate_limit is not None:
+            cached_response.headers.update(rate_limit.headers)
+        return cached_response
+    try:
+        ticket = await admission.acquire(
+            proxy_key.tenant if proxy_key else "",
+            proxy_key.weight if proxy_key else 1.0,
+        )
+    except AdmissionRejected as exc:
+        return create_admission_rejected_response(exc.reason)
+    try:
+        lease = await resolve_upstream_api_key(request, config)
+    except HTTPException as exc:
+        if ticket is not None:
+            ticket.release()
+        return create_error_response(exc.detail, exc.status_code)
+    lease.admission = ticket
+    # Only create endpoints (model rewrite) and the chat bridge need the body buffered;
+    # everything else, including file uploads, is streamed straight through.
+    apply_model = should_apply_model(upstream_path, request.method)
+    is_chat_completions = upstream_path.strip("/") == "chat/completions"
+    buffered: BufferedRequestBody | None = None
+    if body is not None:
+        # Owned by the caller, which closes it; closing it here as well is harmless.
+        buffered = body if request_has_body(request) else None
+    elif (apply_model or is_chat_completions) and request_has_body(request):
+        try:
+            buffered = await BufferedRequestBody().read_from(request)
+        except BaseException:
+            lease.release()
+            raise
+
+    if is_chat_completions and buffered is not None:
+        bridged_response = await handle_chat_completions_via_responses(request, bytes(buffered.view()), config, lease)
         if bridged_response is not None:
+            buffered.close()
+            if rate_limit is not None:
+                bridged_response.headers.update(rate_limit.headers)
             return bridged_response
 
-    body, body_is_json = maybe_rewrite_json_body(
-        upstream_path,
-        request.method,
-        original_body,
-        config["model"],
-        config["force_model"],
+    store_scope = ""
+    record_input: bytes | None = None
+    parent_response_id: str | None = None
+    if (
+        response_store.enabled
+        and buffered is not None
+        and upstream_path.strip("/") == "responses"
+        and request.method.upper() == "POST"
+    ):
+        store_scope = response_store_scope(request, config, lease)
+        try:
+            buffered, record_input, parent_response_id = await prepare_stored_response_body(
+                buffered,
+                store_scope,
+                config.model,
+                config.force_model,
+            )
+        except BaseException:
+            buffered.close()
+            lease.release()
+            raise
+
+    content_length: int | None = None
+    body_is_json = False
+    if buffered is not None and apply_model:
+        content, content_length, body_is_json = prepare_rewritten_body(
+            upstream_path,
+            request.method,
+            buffered,
+            config.model,
+            config.force_model,
+        )
+    elif buffered is not None:
+        content, content_length = buffered.content()
+    elif request_has_body(request):
+        content = request.stream()
+        raw_length = request.headers.get("content-length", "")
+        content_length = int(raw_length) if raw_length.isdigit() else None
+    else:
+        content = None
+
+    upstream_url = build_upstream_url(config.upstream_base_url, upstream_path, request.url.query)
+    # Observers read the body through StreamDecoder, so when one may attach only the codings it can
+    # decode are forwarded (br / zstd are dropped); otherwise the client's codings go as-is.
+    observed = record_input is not None or usage_metering_enabled(request)
+    headers = build_upstream_headers(
+        request, lease.key, body_is_json, UPSTREAM_COMPRESSION_PASSTHROUGH, decodable_only=observed
     )
-
-    upstream_url = build_upstream_url(config["upstream_base_url"], upstream_path, request.url.query)
-    headers = build_upstream_headers(request, api_key, body_is_json)
+    if content_length is not None:
+        headers["Content-Length"] = str(content_length)
 
     logger.info("%s /v1/%s -> %s", request.method, upstream_path, upstream_url)
 
@@ -1670,30 +5439,261 @@ async def proxy_v1(upstream_path: str, request: Request):
         request.method,
         upstream_url,
         headers=headers,
-        content=body if body else None,
+        content=content,
     )
 
     try:
         upstream_response = await stream_context.__aenter__()
     except httpx.TimeoutException:
+        lease.record(None, "upstream timeout")
+        lease.release()
         return create_error_response(
             {"message": "上游请求超时", "type": "timeout_error", "code": "upstream_timeout"},
             504,
         )
     except httpx.HTTPError as exc:
+        lease.record(None, str(exc))
+        lease.release()
         return create_error_response({"message": str(exc), "type": "upstream_error"}, 502)
-
-    response_headers = filter_response_headers(upstream_response.headers)
+    finally:
+        # The request body has been fully sent once response headers arrive (or the send failed).
+        if buffered is not None:
+            buffered.close()
+
+    lease.record(upstream_response.status_code, headers=upstream_response.headers)
+    observers: list[Any] = []
+    content_type = upstream_response.headers.get("content-type", "")
+    streaming = "text/event-stream" in content_type
+    # Binary bodies (audio, files) carry no usage and would only be buffered for nothing.
+    if upstream_response.status_code == 200 and (streaming or is_json_media_type(content_type)):
+        if record_input is not None:
+            observers.append(ResponseRecorder(response_store, store_scope, record_input, parent_response_id, streaming))
+        meter = create_usage_meter(request, lease, streaming)
+        if meter is not None:
+            observers.append(meter)
+    content_encoding = upstream_response.headers.get("content-encoding", "")
+    raw_passthrough = (
+        UPSTREAM_COMPRESSION_PASSTHROUGH
+        and content_encoding.strip().lower() not in ("", "identity")
+        and client_accepts_encoding(request.headers.get("accept-encoding", ""), content_encoding)
+        and (not observers or StreamDecoder.supports(content_encoding))
+    )
+    response_headers = filter_response_headers(upstream_response.headers, keep_encoding=raw_passthrough)
+    if rate_limit is not None:
+        response_headers.update(rate_limit.headers)
     media_type = upstream_response.headers.get("content-type")
 
     return StreamingResponse(
-        iter_upstream_response(upstream_response, stream_context),
+        iter_upstream_response(upstream_response, stream_context, lease, raw=raw_passthrough, observers=tuple(observers)),
         status_code=upstream_response.status_code,
         headers=response_headers,
         media_type=media_type,
     )
 
 
+responses_websocket_stats = {"active": 0, "connections": 0, "turns": 0}
+
+
+async def send_websocket_error(websocket: WebSocket, response: Response) -> None:
+    """Relay an error response as a Responses-style error event; the connection stays open."""
+    payload = json.loads(response.body)
+    await websocket.send_text(
+        json.dumps({"type": "error", "status": response.status_code, **payload}, ensure_ascii=False)
+    )
+
+
+def parse_responses_websocket_message(message: str) -> bytes:
+    """Turn a response.create message into a streaming Responses request body."""
+    try:
+        payload = json.loads(message)
+    except json.JSONDecodeError as exc:
+        raise ValueError("消息不是合法的 JSON") from exc
+    if not isinstance(payload, dict) or payload.get("type") != "response.create":
+        raise ValueError("仅支持 type 为 response.create 的消息")
+    body = payload.get("response")
+    if not isinstance(body, dict):
+        body = {key: value for key, value in payload.items() if key != "type"}
+    body["stream"] = True
+    return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+async def run_responses_websocket_turn(
+    websocket: WebSocket,
+    config: ConfigSnapshot,
+    proxy_key: ProxyKeyInfo | None,
+    upstream_url: str,
+    base_headers: dict[str, str],
+    body: bytes,
+) -> None:
+    """One Responses turn: same limits, key lease, store expansion and metering as POST /v1/responses."""
+    rate_limit = rate_limiter.admit(config, proxy_key) if proxy_key is not None else None
+    if rate_limit is not None and not rate_limit.allowed:
+        await send_websocket_error(websocket, create_rate_limit_response(rate_limit))
+        return
+    try:
+        ticket = await admission.acquire(
+            proxy_key.tenant if proxy_key else "",
+            proxy_key.weight if proxy_key else 1.0,
+        )
+    except AdmissionRejected as exc:
+        await send_websocket_error(websocket, create_admission_rejected_response(exc.reason))
+        return
+    try:
+        lease = await resolve_upstream_api_key(websocket, config)
+    except HTTPException as exc:
+        if ticket is not None:
+            ticket.release()
+        await send_websocket_error(websocket, create_error_response(exc.detail, exc.status_code))
+        return
+    lease.admission = ticket
+
+    buffered = BufferedRequestBody()
+    buffered.write(body)
+    store_scope = ""
+    record_input: bytes | None = None
+    parent_response_id: str | None = None
+    try:
+        if response_store.enabled:
+            store_scope = response_store_scope(websocket, config, lease)
+            buffered, record_input, parent_response_id = await prepare_stored_response_body(
+                buffered,
+                store_scope,
+                config.model,
+                config.force_model,
+            )
+        content, content_length, _ = prepare_rewritten_body(
+            "responses",
+            "POST",
+            buffered,
+            config.model,
+            config.force_model,
+        )
+    except BaseException:
+        buffered.close()
+        lease.release()
+        raise
+
+    headers = dict(base_headers)
+    headers["Authorization"] = f"Bearer {lease.key}"
+    headers["Content-Length"] = str(content_length)
+    stream_context = get_client().stream("POST", upstream_url, headers=headers, content=content)
+    try:
+        upstream_response = await stream_context.__aenter__()
+    except httpx.TimeoutException:
+        lease.record(None, "upstream timeout")
+        lease.release()
+        await send_websocket_error(
+            websocket,
+            create_error_response({"message": "上游请求超时", "type": "timeout_error", "code": "upstream_timeout"}, 504),
+        )
+        return
+    except httpx.HTTPError as exc:
+        lease.record(None, str(exc))
+        lease.release()
+        await send_websocket_error(websocket, create_error_response({"message": str(exc), "type": "upstream_error"}, 502))
+        return
+    finally:
+        buffered.close()
+
+    lease.record(upstream_response.status_code, headers=upstream_response.headers)
+    if upstream_response.status_code != 200:
+        try:
+            raw = await upstream_response.aread()
+        finally:
+            lease.release()
+            await stream_context.__aexit__(None, None, None)
+        try:
+            error = json.loads(raw)
+        except json.JSONDecodeError:
+            error = raw.decode("utf-8", "replace")[:500] or f"HTTP {upstream_response.status_code}"
+        if isinstance(error, dict) and "error" in error:
+            error = error["error"]
+        await send_websocket_error(websocket, create_error_response(error, upstream_response.status_code))
+        return
+
+    content_type = upstream_response.headers.get("content-type", "")
+    streaming = "text/event-stream" in content_type
+    observers: list[Any] = []
+    if streaming or is_json_media_type(content_type):
+        if record_input is not None:
+            observers.append(ResponseRecorder(response_store, store_scope, record_input, parent_response_id, streaming))
+        meter = create_usage_meter(websocket, lease, streaming)
+        if meter is not None:
+            observers.append(meter)
+    events = SSEEventBuffer()
+    unframed = bytearray()
+    # aclosing: a client that disconnects mid-turn must release the lease and upstream stream right away.
+    async with aclosing(
+        iter_upstream_response(upstream_response, stream_context, lease, observers=tuple(observers))
+    ) as chunks:
+        async for chunk in chunks:
+            if not streaming:
+                unframed += chunk
+                continue
+            for event in events.feed(chunk):
+                data = sse_event_data(event)
+                if data and data != b"[DONE]":
+                    await websocket.send_text(data.decode("utf-8", "replace"))
+    if unframed:
+        await websocket.send_text(unframed.decode("utf-8", "replace"))
+
+
+@app.websocket("/v1/responses")
+async def responses_websocket(websocket: WebSocket):
+    """Many Responses turns over one connection.
+
+    The proxy key is checked and the config snapshot and upstream headers are
+    built once at the handshake; each response.create message then runs one
+    streaming turn whose SSE events are sent back as text messages. Config
+    changes apply to new connections.
+    """
+    config = runtime_config.snapshot()
+    try:
+        proxy_key = await validate_proxy_access(websocket, config)
+    except HTTPException:
+        # Closing before accept rejects the handshake with HTTP 403.
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    upstream_url = build_upstream_url(config.upstream_base_url, "responses", "")
+    base_headers = {
+        key: value
+        for key, value in build_upstream_headers(websocket, "", True).items()
+        if not key.lower().startswith("sec-websocket-") and key.lower() not in ("authorization", "origin")
+    }
+    base_headers["Accept"] = "text/event-stream"
+    responses_websocket_stats["active"] += 1
+    responses_websocket_stats["connections"] += 1
+    logger.info("WebSocket /v1/responses connected -> %s", upstream_url)
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive(), RESPONSES_WEBSOCKET_IDLE_SECONDS or None)
+            except asyncio.TimeoutError:
+                await websocket.close(code=1000)
+                return
+            if message["type"] == "websocket.disconnect":
+                return
+            text = message.get("text")
+            if text is None:
+                text = (message.get("bytes") or b"").decode("utf-8", "replace")
+            try:
+                body = parse_responses_websocket_message(text)
+            except ValueError as exc:
+                await send_websocket_error(
+                    websocket,
+                    create_error_response({"message": str(exc), "type": "invalid_request_error"}, 400),
+                )
+                continue
+            responses_websocket_stats["turns"] += 1
+            await run_responses_websocket_turn(websocket, config, proxy_key, upstream_url, base_headers, body)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        responses_websocket_stats["active"] -= 1
+        logger.info("WebSocket /v1/responses disconnected")
+
+
 @app.options("/v1/{upstream_path:path}")
 async def options_v1(upstream_path: str):
     return Response(status_code=204)
@@ -1705,16 +5705,36 @@ async def health():
     return {
         "status": "ok",
         "service": "codex-anyrouter-proxy",
-        "upstream": config["upstream_base_url"],
-        "default_model": config["model"],
-        "force_model": config["force_model"],
-        "configured_api_keys": len(config["api_keys"]),
-        "proxy_api_key_enabled": bool(config["proxy_api_keys"]),
-        "api_key_source": "admin/env" if config["api_keys"] else "request",
+        "upstream": config.upstream_base_url,
+        "default_model": config.model,
+        "force_model": config.force_model,
+        "configured_api_keys": len(config.api_keys),
+        "proxy_api_key_enabled": bool(config.proxy_api_keys),
+        "api_key_source": "admin/env" if config.api_keys else "request",
+        "config_version": config.version,
+        "upstream_keys": key_scheduler.snapshot(config),
+        "chat_sessions": len(chat_sessions),
+        "response_store": response_store.stats(),
         "admin_url": "/admin",
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    config = runtime_config.snapshot()
+    return {
+        "admission": admission.snapshot(),
+        "upstream_keys": key_scheduler.snapshot(config),
+        "upstream_key_pools": key_scheduler.pool_stats(config),
+        "upstream_cache": upstream_cache.stats(),
+        "upstream_connections": upstream_connections.stats(),
+        "response_store": response_store.stats(),
+        "idempotency": idempotency_store.stats(),
+        "responses_websocket": dict(responses_websocket_stats),
+        "chat_sessions": len(chat_sessions),
+    }
+
+
 @app.get("/")
 async def root():
     config = runtime_config.snapshot()
@@ -1722,10 +5742,11 @@ async def root():
         {
             "service": "Codex AnyRouter Proxy",
             "mode": "openai-responses-passthrough",
-            "upstream": config["upstream_base_url"],
+            "upstream": config.upstream_base_url,
             "admin_url": "/admin",
             "endpoints": [
                 "POST /v1/responses",
+                "WS /v1/responses",
                 "GET /v1/models",
                 "POST /v1/chat/completions",
                 "GET|POST|PUT|PATCH|DELETE /v1/{path}",
@@ -1739,7 +5760,7 @@ if __name__ == "__main__":
 
     port = int(os.getenv("CODEX_PROXY_PORT", "9996"))
     host = os.getenv("HOST", "0.0.0.0")
-    config = runtime_config.snapshot()
+    config = runtime_config.open()
 
     print(f"""
 ============================================================
@@ -1747,8 +5768,8 @@ if __name__ == "__main__":
 ============================================================
   Proxy:    http://{host}:{port}
   Admin:    http://127.0.0.1:{port}/admin
-  Upstream: {config["upstream_base_url"]}
-  Model:    {config["model"]}
+  Upstream: {config.upstream_base_url}
+  Model:    {config.model}
 ------------------------------------------------------------
   Codex config base_url: http://127.0.0.1:{port}/v1
 ============================================================
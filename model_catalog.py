@@ -0,0 +1,259 @@
+"""
+ModelCatalog - 模型目录（anyrouter2openai.py / anyrouter2anthropic.py 共用）
+
+/v1/models 直接由内存返回，不再每次请求都转发到 Node.js 代理。
+后台任务按 MODEL_CATALOG_SOURCE 定时刷新模型列表：
+  static   - 使用内置列表（或 MODEL_CATALOG_MODELS 指定的模型），不刷新
+  upstream - 直接请求 anyrouter.top/v1/models
+  node     - 通过 Node.js 代理的 /v1/models（走官方 TLS 指纹）
+
+刷新失败时保留上一次成功的列表。每种输出格式的响应体预先编码并附带 ETag，
+客户端携带 If-None-Match 命中时返回 304。
+
+目录同时充当模型能力表（上下文窗口大小），供 OpenAI 代理做上下文长度预检；
+可用 MODEL_CONTEXT_WINDOWS=model=tokens,... 覆盖。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+from fastapi import Request, Response
+
+logger = logging.getLogger(__name__)
+
+CATALOG_SOURCES = ("static", "upstream", "node")
+DEFAULT_CONTEXT_WINDOW = 200_000
+
+
+@dataclass(frozen=True)
+class ModelInfo:
+    """模型目录条目"""
+    id: str
+    name: str = ""
+    created: int = 0
+    owned_by: str = "anthropic"
+    context_window: int = DEFAULT_CONTEXT_WINDOW
+
+    @property
+    def display_name(self) -> str:
+        return self.name or self.id
+
+
+DEFAULT_MODELS: tuple[ModelInfo, ...] = (
+    ModelInfo("claude-opus-4-6", "Claude Opus 4.6"),
+    ModelInfo("claude-sonnet-4-6", "Claude Sonnet 4.6"),
+    ModelInfo("claude-opus-4-5-20251101", "Claude Opus 4.5"),
+    ModelInfo("claude-sonnet-4-5-20250929", "Claude Sonnet 4.5"),
+    ModelInfo("claude-sonnet-4-20250514", "Claude Sonnet 4"),
+    ModelInfo("claude-haiku-4-5-20251001", "Claude Haiku 4.5"),
+    ModelInfo("claude-3-7-sonnet-20250219", "Claude 3.7 Sonnet"),
+    ModelInfo("claude-3-5-sonnet-20241022", "Claude 3.5 Sonnet"),
+    ModelInfo("claude-3-5-haiku-20241022", "Claude 3.5 Haiku"),
+)
+
+
+def parse_static_models(raw_value: str) -> tuple[ModelInfo, ...]:
+    """解析 MODEL_CATALOG_MODELS（逗号分隔的模型 id），为空时使用内置列表"""
+    ids = [item.strip() for item in raw_value.split(",") if item.strip()]
+    if not ids:
+        return DEFAULT_MODELS
+    known = {model.id: model for model in DEFAULT_MODELS}
+    return tuple(known.get(model_id, ModelInfo(model_id)) for model_id in ids)
+
+
+def parse_context_windows(raw_value: str) -> dict[str, int]:
+    """解析 MODEL_CONTEXT_WINDOWS（model=tokens,model=tokens）"""
+    result: dict[str, int] = {}
+    for item in raw_value.split(","):
+        model_id, _, tokens = item.partition("=")
+        if model_id.strip() and tokens.strip().isdigit():
+            result[model_id.strip()] = int(tokens.strip())
+    return result
+
+
+def parse_models_payload(payload: Any) -> tuple[ModelInfo, ...]:
+    """解析 OpenAI / Anthropic 两种 /v1/models 响应"""
+    items = payload.get("data", []) if isinstance(payload, dict) else []
+    models: list[ModelInfo] = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get("id"):
+            continue
+        created = item.get("created")
+        context_window = item.get("context_window") or item.get("context_length")
+        models.append(ModelInfo(
+            id=str(item["id"]),
+            name=str(item.get("display_name") or item.get("name") or ""),
+            created=created if isinstance(created, int) else 0,
+            owned_by=str(item.get("owned_by") or "anthropic"),
+            context_window=context_window if isinstance(context_window, int) else DEFAULT_CONTEXT_WINDOW,
+        ))
+    return tuple(models)
+
+
+def render_models(models: tuple[ModelInfo, ...], fmt: str) -> dict[str, Any]:
+    if fmt == "openai":
+        return {
+            "object": "list",
+            "data": [
+                {"id": m.id, "object": "model", "created": m.created, "owned_by": m.owned_by}
+                for m in models
+            ],
+        }
+    return {
+        "data": [
+            {"id": m.id, "name": m.display_name, "type": "model", "display_name": m.display_name}
+            for m in models
+        ],
+    }
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+
+class ModelCatalog:
+    """常驻内存的模型目录，后台定时刷新"""
+
+    def __init__(
+        self,
+        source: str = "static",
+        static_models: tuple[ModelInfo, ...] = DEFAULT_MODELS,
+        refresh_seconds: float = 600,
+        node_proxy_url: str = "",
+        upstream_url: str = "",
+        api_key: str = "",
+        context_windows: dict[str, int] | None = None,
+    ):
+        if source not in CATALOG_SOURCES:
+            logger.warning("Unknown MODEL_CATALOG_SOURCE=%s, falling back to static", source)
+            source = "static"
+        if source != "static" and not api_key:
+            logger.warning("MODEL_CATALOG_SOURCE=%s requires MODEL_CATALOG_API_KEY, falling back to static", source)
+            source = "static"
+        self.source = source
+        self.refresh_seconds = max(refresh_seconds, 10.0)
+        self.node_proxy_url = node_proxy_url.rstrip("/")
+        self.upstream_url = upstream_url.rstrip("/")
+        self.api_key = api_key
+        self.context_overrides = context_windows or {}
+        self.models = static_models
+        self.updated_at = time.time()
+        self.last_error = ""
+        self._rendered: dict[str, tuple[bytes, str]] = {}
+        self._task: asyncio.Task | None = None
+
+    @classmethod
+    def from_env(cls, node_proxy_url: str) -> "ModelCatalog":
+        """按 MODEL_CATALOG_* 环境变量创建（调用方需先 load_dotenv）"""
+        return cls(
+            source=os.getenv("MODEL_CATALOG_SOURCE", "static").strip().lower(),
+            static_models=parse_static_models(os.getenv("MODEL_CATALOG_MODELS", "")),
+            refresh_seconds=float(os.getenv("MODEL_CATALOG_REFRESH_SECONDS", "600")),
+            node_proxy_url=node_proxy_url,
+            upstream_url=os.getenv(
+                "MODEL_CATALOG_UPSTREAM_URL", os.getenv("ANYROUTER_BASE_URL", "https://anyrouter.top")
+            ),
+            api_key=os.getenv("MODEL_CATALOG_API_KEY", ""),
+            context_windows=parse_context_windows(os.getenv("MODEL_CONTEXT_WINDOWS", "")),
+        )
+
+    def set_models(self, models: tuple[ModelInfo, ...]) -> None:
+        if models == self.models:
+            return
+        # 先替换再清空缓存；读者最多拿到一次旧的预编码结果
+        self.models = models
+        self.updated_at = time.time()
+        self._rendered = {}
+
+    def context_window(self, model_id: str) -> int:
+        """模型上下文窗口（token）；未知模型使用默认值"""
+        override = self.context_overrides.get(model_id)
+        if override:
+            return override
+        for model in self.models:
+            if model.id == model_id:
+                return model.context_window
+        return DEFAULT_CONTEXT_WINDOW
+
+    def render(self, fmt: str) -> tuple[bytes, str]:
+        """返回 (预编码响应体, ETag)，同一版本列表只编码一次"""
+        cached = self._rendered.get(fmt)
+        if cached is None:
+            body = json.dumps(render_models(self.models, fmt), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            cached = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+            self._rendered[fmt] = cached
+        return cached
+
+    def response(self, request: Request, fmt: str) -> Response:
+        body, etag = self.render(fmt)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def models_url(self) -> str:
+        base_url = self.node_proxy_url if self.source == "node" else self.upstream_url
+        return f"{base_url}/v1/models"
+
+    async def refresh(self, client: httpx.AsyncClient) -> bool:
+        if self.source == "static":
+            return True
+        try:
+            resp = await client.get(
+                self.models_url(),
+                headers={"x-api-key": self.api_key, "anthropic-version": "2023-06-01"},
+                timeout=30,
+            )
+            if resp.status_code != 200:
+                raise ValueError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+            models = parse_models_payload(resp.json())
+            if not models:
+                raise ValueError("empty model list")
+        except (httpx.HTTPError, ValueError) as exc:
+            self.last_error = str(exc)
+            logger.warning("Model catalog refresh from %s failed: %s", self.source, exc)
+            return False
+        self.last_error = ""
+        self.set_models(models)
+        logger.info("Model catalog refreshed from %s: %d models", self.source, len(models))
+        return True
+
+    async def _run(self, client: httpx.AsyncClient) -> None:
+        while True:
+            await self.refresh(client)
+            await asyncio.sleep(self.refresh_seconds)
+
+    def start(self, client: httpx.AsyncClient) -> None:
+        if self.source != "static" and self._task is None:
+            self._task = asyncio.create_task(self._run(client))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "source": self.source,
+            "models": len(self.models),
+            "updated_at": int(self.updated_at),
+            "last_error": self.last_error,
+        }
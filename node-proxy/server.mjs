@@ -551,6 +551,37 @@ async function handleMessages(req, res, body) {
   }
 }
 
+/**
+ * 处理 /v1/models 请求（供 Python 端模型目录后台刷新使用）
+ */
+async function handleModels(req, res) {
+  const apiKey = extractApiKey(req.headers);
+  if (!apiKey) {
+    res.writeHead(401, { 'Content-Type': 'application/json' });
+    res.end(JSON.stringify({ error: { type: 'authentication_error', message: 'API key required' } }));
+    return;
+  }
+
+  const response = await fetchWithWafHandling(`${ANTHROPIC_BASE_URL}/v1/models`, {
+    method: 'GET',
+    headers: {
+      'x-api-key': apiKey,
+      'anthropic-version': req.headers['anthropic-version'] || '2023-06-01',
+      'User-Agent': 'claude-cli/2.1.39 (external, cli)',
+      'Accept': 'application/json',
+    },
+  });
+
+  if (isWafChallenge(response.text)) {
+    res.writeHead(503, { 'Content-Type': 'application/json' });
+    res.end(JSON.stringify({ type: 'error', error: { type: 'waf_error', message: 'Failed to bypass WAF protection.' } }));
+    return;
+  }
+
+  res.writeHead(response.status, { 'Content-Type': 'application/json' });
+  res.end(response.text);
+}
+
 /**
  * 处理健康检查
  */
@@ -585,6 +616,8 @@ const server = http.createServer(async (req, res) => {
     if (url.pathname === '/v1/messages' && req.method === 'POST') {
       const body = await parseBody(req);
       await handleMessages(req, res, body);
+    } else if (url.pathname === '/v1/models' && req.method === 'GET') {
+      await handleModels(req, res);
     } else if (url.pathname === '/health' && req.method === 'GET') {
       handleHealth(req, res);
     } else if (url.pathname === '/' && req.method === 'GET') {
@@ -620,6 +653,7 @@ server.listen(PORT, () => {
 ╠══════════════════════════════════════════════════════════╣
 ║  端点:                                                    ║
 ║    POST /v1/messages - Anthropic Messages API            ║
+║    GET  /v1/models   - 模型列表                           ║
 ║    GET  /health      - 健康检查                           ║
 ╚══════════════════════════════════════════════════════════╝
 `);
@@ -0,0 +1,166 @@
+"""
+RequestOffload - 大请求体卸载（anyrouter2openai.py / anyrouter2anthropic.py 共用）
+
+大请求（如带多张 base64 图片）的 JSON 解析、协议转换和序列化都是纯 CPU 操作，
+直接在事件循环上执行会阻塞同进程内其它所有流的 token 输出。
+超过 OFFLOAD_THRESHOLD_BYTES 的请求体交给有界线程池处理，小请求仍在事件循环内直接执行
+（线程切换本身也有开销）。
+
+同时提供两类指标用于调节阈值：
+  - 按请求体大小分桶统计内联 / 线程池处理耗时
+  - 事件循环延迟监控（定时 sleep 的实际超时量即事件循环被阻塞的时间）
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 请求体大小分桶上界（字节），用于耗时统计
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+
+
+def encode_json(data: Any) -> bytes:
+    """与 httpx json= 相同的紧凑序列化，提前编码后以 content= 发送"""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), allow_nan=False).encode("utf-8")
+
+
+def bucket_label(size: int) -> str:
+    for upper in SIZE_BUCKETS:
+        if size < upper:
+            return f"<{upper // 1024}KB"
+    return f">={SIZE_BUCKETS[-1] // 1024}KB"
+
+
+class TimingStats:
+    """简单的计数 / 总耗时 / 最大耗时统计"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, elapsed_ms: float) -> None:
+        self.count += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
+class RequestOffloader:
+    """按请求体大小决定在事件循环内执行还是卸载到线程池"""
+
+    def __init__(self, threshold_bytes: int, max_workers: int):
+        self.threshold_bytes = threshold_bytes
+        self.max_workers = max(max_workers, 1)
+        self._executor: ThreadPoolExecutor | None = None
+        self._inline: dict[str, TimingStats] = {}
+        self._offloaded: dict[str, TimingStats] = {}
+
+    @classmethod
+    def from_env(cls) -> "RequestOffloader":
+        """按 OFFLOAD_* 环境变量创建（调用方需先 load_dotenv）"""
+        return cls(
+            threshold_bytes=int(os.getenv("OFFLOAD_THRESHOLD_BYTES", str(256 * 1024))),
+            max_workers=int(os.getenv("OFFLOAD_MAX_WORKERS", "4")),
+        )
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="offload")
+        return self._executor
+
+    async def run(self, size: int, func: Callable[..., T], *args: Any) -> T:
+        """size 为原始请求体字节数；func 抛出的异常原样向上传递"""
+        label = bucket_label(size)
+        start = time.perf_counter()
+        if size < self.threshold_bytes:
+            try:
+                return func(*args)
+            finally:
+                self._inline.setdefault(label, TimingStats()).add((time.perf_counter() - start) * 1000)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._offloaded.setdefault(label, TimingStats()).add((time.perf_counter() - start) * 1000)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "threshold_bytes": self.threshold_bytes,
+            "max_workers": self.max_workers,
+            "inline": {label: stats.to_dict() for label, stats in self._inline.items()},
+            "offloaded": {label: stats.to_dict() for label, stats in self._offloaded.items()},
+        }
+
+
+class LoopLagMonitor:
+    """事件循环阻塞监控：每 interval 秒 sleep 一次，实际耗时超出的部分即阻塞时间"""
+
+    def __init__(self, interval: float = 0.05, slow_threshold_ms: float = 20.0, window: int = 1200):
+        self.interval = interval
+        self.slow_threshold_ms = slow_threshold_ms
+        self.samples: deque[float] = deque(maxlen=window)
+        self.total_blocked_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.slow_ticks = 0
+        self._task: asyncio.Task | None = None
+
+    async def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag_ms = max((time.perf_counter() - start - self.interval) * 1000, 0.0)
+            self.samples.append(lag_ms)
+            self.total_blocked_ms += lag_ms
+            if lag_ms > self.max_lag_ms:
+                self.max_lag_ms = lag_ms
+            if lag_ms >= self.slow_threshold_ms:
+                self.slow_ticks += 1
+                logger.debug("Event loop blocked for %.1f ms", lag_ms)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict[str, Any]:
+        recent = sorted(self.samples)
+        return {
+            "interval_ms": self.interval * 1000,
+            "recent_p50_ms": round(recent[len(recent) // 2], 3) if recent else 0.0,
+            "recent_p99_ms": round(recent[min(int(len(recent) * 0.99), len(recent) - 1)], 3) if recent else 0.0,
+            "recent_max_ms": round(recent[-1], 3) if recent else 0.0,
+            "max_lag_ms": round(self.max_lag_ms, 3),
+            "total_blocked_ms": round(self.total_blocked_ms, 3),
+            f"ticks_over_{int(self.slow_threshold_ms)}ms": self.slow_ticks,
+        }
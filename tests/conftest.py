@@ -0,0 +1,58 @@
+"""Shared fixtures: an isolated environment for codex_anyrouter_proxy and a scriptable upstream."""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import httpx
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# codex_anyrouter_proxy reads its settings at import time, so configure them before any test imports it.
+_ENV_DIR = tempfile.mkdtemp(prefix="codex-proxy-tests-")
+Path(_ENV_DIR, ".env").write_text("ANYROUTER_API_KEY=up-test-key-000000\nPROXY_API_KEYS=pk-test\n", encoding="utf-8")
+os.environ.update(
+    ENV_FILE_PATH=str(Path(_ENV_DIR, ".env")),
+    CONFIG_DB_PATH="",
+    USAGE_DB_PATH="",
+    KEY_PROBE_INTERVAL_SECONDS="0",
+    UPSTREAM_PREWARM_CONNECTIONS="0",
+    UPSTREAM_KEEPALIVE_INTERVAL_SECONDS="0",
+)
+
+PROXY_HEADERS = {"Authorization": "Bearer pk-test"}
+
+
+class MockUpstream:
+    """httpx MockTransport handler; tests set .handler and inspect .requests."""
+
+    def __init__(self):
+        self.requests: list[httpx.Request] = []
+        self.handler = lambda request: httpx.Response(200, json={})
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        response = self.handler(request)
+        if hasattr(response, "__await__"):
+            response = await response
+        return response
+
+
+@pytest.fixture
+def upstream() -> MockUpstream:
+    return MockUpstream()
+
+
+@pytest.fixture
+def codex_client(upstream):
+    from fastapi.testclient import TestClient
+
+    import codex_anyrouter_proxy as codex
+
+    with TestClient(codex.app) as client:
+        client.portal.call(codex.http_client.aclose)
+        codex.http_client = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+        yield client
@@ -0,0 +1,120 @@
+"""Weighted fair admission: ordering across tenants, refunds and slot release."""
+
+import asyncio
+
+import pytest
+
+
+def test_burst_from_one_tenant_does_not_starve_another():
+    import codex_anyrouter_proxy as codex
+
+    async def scenario():
+        scheduler = codex.AdmissionScheduler(1, 5, 10)
+        holder = await scheduler.acquire("a")
+        order = []
+
+        async def request(name, label, weight=1.0):
+            ticket = await scheduler.acquire(name, weight)
+            order.append(label)
+            await asyncio.sleep(0)
+            ticket.release()
+
+        tasks = [asyncio.create_task(request("a", f"a{index}")) for index in range(1, 4)]
+        tasks.append(asyncio.create_task(request("b", "b1")))
+        tasks += [asyncio.create_task(request("c", f"c{index}", 2.0)) for index in range(1, 3)]
+        await asyncio.sleep(0)
+        assert scheduler.waiting == 6
+        holder.release()
+        await asyncio.gather(*tasks)
+        return order, scheduler
+
+    order, scheduler = asyncio.run(scenario())
+
+    # Finish tags: a 1, 2, 3; b 1; c (weight 2) 0.5, 1. Ties go to the earlier arrival.
+    assert order == ["c1", "a1", "b1", "c2", "a2", "a3"]
+    assert scheduler.in_flight == 0
+    assert scheduler.waiting == 0
+
+
+@pytest.mark.parametrize("outcome", ["timeout", "cancel"])
+def test_unserved_request_refunds_its_share(outcome):
+    import codex_anyrouter_proxy as codex
+
+    async def scenario():
+        scheduler = codex.AdmissionScheduler(1, 0.05 if outcome == "timeout" else 5, 10)
+        holder = await scheduler.acquire("other")
+        waiter = asyncio.create_task(scheduler.acquire("a"))
+        await asyncio.sleep(0)
+        assert scheduler._tenants["a"].last_finish == 1.0
+        if outcome == "cancel":
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+        else:
+            with pytest.raises(codex.AdmissionRejected) as rejected:
+                await waiter
+            assert rejected.value.reason == "queue_timeout"
+        tenant = scheduler._tenants["a"]
+        assert tenant.last_finish == 0.0
+        assert tenant.queued == 0
+        assert scheduler.waiting == 0
+
+        # The freed slot is not handed to the abandoned waiter.
+        holder.release()
+        assert scheduler.in_flight == 0
+        ticket = await scheduler.acquire("a")
+        assert tenant.in_flight == 1
+        ticket.release()
+        return tenant
+
+    tenant = asyncio.run(scenario())
+    assert tenant.timeouts == (1 if outcome == "timeout" else 0)
+
+
+def test_key_lease_release_frees_the_admission_slot_once():
+    import codex_anyrouter_proxy as codex
+
+    async def scenario():
+        scheduler = codex.AdmissionScheduler(1, 5, 10)
+        state = codex.KeyState("up-test-key-000010", 1.0)
+        lease = codex.KeyLease(state.key, state)
+        lease.admission = await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        lease.release()
+        lease.release()
+        ticket = await asyncio.wait_for(waiter, 1)
+        assert scheduler.in_flight == 1
+        assert scheduler._tenants["a"].in_flight == 0
+        assert scheduler._tenants["b"].in_flight == 1
+        assert state.in_flight == 0
+        ticket.release()
+        return scheduler
+
+    assert asyncio.run(scenario()).in_flight == 0
+
+
+def test_full_tenant_queue_is_rejected():
+    import codex_anyrouter_proxy as codex
+
+    async def scenario():
+        scheduler = codex.AdmissionScheduler(1, 5, 1)
+        holder = await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("a"))
+        await asyncio.sleep(0)
+        with pytest.raises(codex.AdmissionRejected) as rejected:
+            await scheduler.acquire("a")
+        assert rejected.value.reason == "queue_full"
+        # Another tenant still gets its own queue.
+        other = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        holder.release()
+        (await waiter).release()
+        (await other).release()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler._tenants["a"].rejected_full == 1
+    assert scheduler.in_flight == 0
@@ -0,0 +1,83 @@
+"""Accept-Encoding handling between the client, the upstream and body observers."""
+
+import gzip
+import json
+
+import httpx
+
+from conftest import PROXY_HEADERS
+
+BROTLI_BYTES = b"\x1b\x0b\x00\xf8\x25\x82\x82\x44\x00"
+
+
+def test_passthrough_forwards_client_codings_and_relays_raw_body(codex_client, upstream):
+    upstream.handler = lambda request: httpx.Response(
+        200,
+        headers={"content-type": "application/json", "content-encoding": "br"},
+        stream=httpx.ByteStream(BROTLI_BYTES),
+    )
+    with codex_client.stream(
+        "POST",
+        "/v1/embeddings",
+        json={"model": "text-embedding-3-small", "input": "hi"},
+        headers={**PROXY_HEADERS, "Accept-Encoding": "br"},
+    ) as response:
+        body = b"".join(response.iter_raw())
+
+    assert upstream.requests[-1].headers["accept-encoding"] == "br"
+    assert response.headers["content-encoding"] == "br"
+    assert body == BROTLI_BYTES
+
+
+def test_observed_body_only_requests_codings_httpx_can_decode(codex_client, upstream):
+    payload = {"id": "resp_1", "object": "response", "output": [], "status": "completed"}
+    upstream.handler = lambda request: httpx.Response(
+        200,
+        headers={"content-type": "application/json", "content-encoding": "gzip"},
+        content=gzip.compress(json.dumps(payload).encode()),
+    )
+    # A stored /v1/responses turn is recorded into the local response store, so the proxy must see decoded bytes.
+    response = codex_client.post(
+        "/v1/responses",
+        json={"model": "gpt-5.5", "input": "hi", "store": True},
+        headers={**PROXY_HEADERS, "Accept-Encoding": "br, zstd"},
+    )
+
+    sent = {coding.strip() for coding in upstream.requests[-1].headers.get("accept-encoding", "").split(",")}
+    decodable = {coding.strip() for coding in httpx.Client().headers["accept-encoding"].split(",")}
+    assert sent <= decodable
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert response.json() == payload
+
+
+
+def test_metered_body_is_relayed_compressed_and_still_observed(codex_client, upstream, monkeypatch):
+    import codex_anyrouter_proxy as codex
+
+    seen = []
+
+    def create_usage_meter(request, lease, streaming=True, model=""):
+        return codex.UsageMeter(lambda usage, usage_model: seen.append(usage), streaming, model)
+
+    monkeypatch.setattr(codex, "usage_metering_enabled", lambda request: True)
+    monkeypatch.setattr(codex, "create_usage_meter", create_usage_meter)
+    usage = {"prompt_tokens": 4, "total_tokens": 4}
+    compressed = gzip.compress(json.dumps({"object": "list", "data": [], "usage": usage}).encode())
+    upstream.handler = lambda request: httpx.Response(
+        200,
+        headers={"content-type": "application/json", "content-encoding": "gzip"},
+        stream=httpx.ByteStream(compressed),
+    )
+    with codex_client.stream(
+        "POST",
+        "/v1/embeddings",
+        json={"model": "text-embedding-3-small", "input": "hi"},
+        headers={**PROXY_HEADERS, "Accept-Encoding": "br, gzip"},
+    ) as response:
+        body = b"".join(response.iter_raw())
+
+    assert upstream.requests[-1].headers["accept-encoding"] == "gzip"
+    assert response.headers["content-encoding"] == "gzip"
+    assert body == compressed
+    assert seen == [usage]
@@ -0,0 +1,136 @@
+"""Idempotency-Key replay, conflicts, scoping and the per-response byte limit."""
+
+import asyncio
+from dataclasses import replace
+
+import httpx
+from fastapi.responses import StreamingResponse
+
+from conftest import PROXY_HEADERS
+
+BODY = {"model": "gpt-5.5", "input": "hi"}
+
+
+def completed(request):
+    return httpx.Response(200, json={"id": "resp_1", "object": "response", "output": []})
+
+
+def test_retry_replays_the_recorded_response(codex_client, upstream):
+    upstream.handler = completed
+    headers = {**PROXY_HEADERS, "Idempotency-Key": "replay-1"}
+    first = codex_client.post("/v1/embeddings", json=BODY, headers=headers)
+    second = codex_client.post("/v1/embeddings", json=BODY, headers=headers)
+
+    assert len(upstream.requests) == 1
+    assert second.status_code == 200
+    assert second.headers["idempotent-replayed"] == "true"
+    assert second.content == first.content
+
+
+def test_same_key_with_a_different_body_is_rejected(codex_client, upstream):
+    upstream.handler = completed
+    headers = {**PROXY_HEADERS, "Idempotency-Key": "conflict-1"}
+    codex_client.post("/v1/embeddings", json=BODY, headers=headers)
+    response = codex_client.post("/v1/embeddings", json={**BODY, "input": "other"}, headers=headers)
+
+    assert response.status_code == 422
+    assert response.json()["error"]["code"] == "idempotency_key_reused"
+    assert len(upstream.requests) == 1
+
+
+def test_callers_without_proxy_keys_are_scoped_by_their_credential(codex_client, upstream, monkeypatch):
+    import codex_anyrouter_proxy as codex
+
+    config = codex.runtime_config.current
+    assert config.api_keys
+    monkeypatch.setattr(
+        codex.runtime_config,
+        "current",
+        replace(config, proxy_api_keys=(), proxy_key_index=codex.ProxyKeyIndex()),
+    )
+    upstream.handler = completed
+    for credential in ("client-a", "client-b"):
+        response = codex_client.post(
+            "/v1/embeddings",
+            json=BODY,
+            headers={"Authorization": f"Bearer {credential}", "Idempotency-Key": "shared-1"},
+        )
+        assert "idempotent-replayed" not in response.headers
+
+    assert len(upstream.requests) == 2
+
+
+def test_oversized_response_is_streamed_without_buffering_and_not_replayed():
+    import codex_anyrouter_proxy as codex
+
+    async def scenario():
+        store = codex.IdempotencyStore(60, 10, 16)
+        key = ("scope", "large-1")
+        chunks = [bytes([index]) * 8 for index in range(10)]
+        held = []
+
+        async def body():
+            for chunk in chunks:
+                yield chunk
+                held.append(len(entry.chunks))
+
+        entry, execute = store.claim(key, "hash")
+        assert execute
+        store.record(key, entry, StreamingResponse(body()))
+        received = [chunk async for chunk in entry.follow()]
+        await asyncio.sleep(0)
+
+        assert b"".join(received) == b"".join(chunks)
+        assert entry.overflowed
+        # Past the limit the pump waits for the reader, so at most one unread chunk is held.
+        assert max(held[3:]) <= 1
+        assert key not in store.entries
+        assert store.claim(key, "hash")[1]
+
+    asyncio.run(scenario())
+
+
+def test_retry_of_an_oversized_in_flight_response_gets_409(codex_client, upstream, monkeypatch):
+    import codex_anyrouter_proxy as codex
+
+    entry = codex.IdempotentResponse("hash")
+    entry.start(200, {"content-type": "application/json"})
+    entry.overflow()
+    monkeypatch.setattr(codex.idempotency_store, "claim", lambda key, body_hash: (entry, False))
+    response = codex_client.post("/v1/embeddings", json=BODY, headers={**PROXY_HEADERS, "Idempotency-Key": "big-1"})
+
+    assert response.status_code == 409
+    assert response.headers["retry-after"] == "1"
+    assert upstream.requests == []
+
+
+def test_upload_is_hashed_while_buffered_once_and_forwarded(codex_client, upstream, monkeypatch):
+    import codex_anyrouter_proxy as codex
+    from starlette.requests import Request
+
+    async def body(self):
+        raise AssertionError("the request body must not be loaded whole")
+
+    spilled = []
+    close = codex.BufferedRequestBody.close
+
+    def record_close(self):
+        spilled.append(self.spilled)
+        close(self)
+
+    monkeypatch.setattr(Request, "body", body)
+    monkeypatch.setattr(codex.BufferedRequestBody.__init__, "__defaults__", (64,))
+    monkeypatch.setattr(codex.BufferedRequestBody, "close", record_close)
+    upstream.handler = lambda request: httpx.Response(200, json={"id": "file-1", "object": "file"})
+    upload = bytes(range(256)) * 64
+    headers = {**PROXY_HEADERS, "Idempotency-Key": "upload-1", "Content-Type": "application/octet-stream"}
+    first = codex_client.post("/v1/files", content=upload, headers=headers)
+    second = codex_client.post("/v1/files", content=upload, headers=headers)
+    conflict = codex_client.post("/v1/files", content=upload[:-1], headers=headers)
+
+    assert first.status_code == 200
+    assert second.headers["idempotent-replayed"] == "true"
+    assert conflict.status_code == 422
+    assert len(upstream.requests) == 1
+    assert upstream.requests[0].content == upload
+    assert spilled[0]
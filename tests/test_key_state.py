@@ -0,0 +1,37 @@
+"""Upstream key health: live-traffic cooldowns versus background probe results."""
+
+import time
+
+
+def test_probe_429_keeps_a_live_cooldown_and_lifts_quarantine():
+    import codex_anyrouter_proxy as codex
+
+    state = codex.KeyState("up-test-key-000001", 1.0)
+    state.observe(429, 0.1, retry_after=120)
+    cooldown = state.cooldown_until
+    state.quarantine("HTTP 401")
+
+    state.observe_probe(429, "HTTP 429", retry_after=5)
+
+    assert not state.quarantined
+    assert state.cooldown_until == cooldown
+    assert not state.available(time.monotonic())
+
+
+def test_probe_429_applies_its_own_retry_after():
+    import codex_anyrouter_proxy as codex
+
+    state = codex.KeyState("up-test-key-000002", 1.0)
+    state.observe_probe(429, "HTTP 429", retry_after=30)
+
+    assert state.cooldown_until - time.monotonic() > 25
+
+
+def test_probe_success_clears_the_cooldown():
+    import codex_anyrouter_proxy as codex
+
+    state = codex.KeyState("up-test-key-000003", 1.0)
+    state.observe(429, 0.1, retry_after=120)
+    state.observe_probe(200)
+
+    assert state.available(time.monotonic())
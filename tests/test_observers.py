@@ -0,0 +1,77 @@
+"""Usage metering and response recording only look at bodies they can parse."""
+
+import asyncio
+
+import httpx
+
+from conftest import PROXY_HEADERS
+
+MP3_BYTES = b"ID3\x04\x00\x00\x00\x00\x00\x00\xff\xfb\x90\x64" + bytes(range(256)) * 16
+
+
+def test_binary_body_is_relayed_untouched_with_metering_enabled(codex_client, upstream, monkeypatch):
+    import codex_anyrouter_proxy as codex
+
+    created = []
+    original = codex.create_usage_meter
+
+    def create_usage_meter(*args, **kwargs):
+        meter = original(*args, **kwargs)
+        created.append(meter)
+        return meter
+
+    monkeypatch.setattr(codex, "usage_metering_enabled", lambda request: True)
+    monkeypatch.setattr(codex, "create_usage_meter", create_usage_meter)
+    upstream.handler = lambda request: httpx.Response(
+        200,
+        headers={"content-type": "audio/mpeg"},
+        content=MP3_BYTES,
+    )
+    response = codex_client.post(
+        "/v1/audio/speech",
+        json={"model": "gpt-4o-mini-tts", "input": "hi", "voice": "alloy"},
+        headers=PROXY_HEADERS,
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "audio/mpeg"
+    assert response.content == MP3_BYTES
+    assert created == []
+
+
+def test_json_body_usage_is_metered(codex_client, upstream, monkeypatch):
+    import codex_anyrouter_proxy as codex
+
+    seen = []
+
+    def create_usage_meter(request, lease, streaming=True, model=""):
+        return codex.UsageMeter(lambda usage, usage_model: seen.append((usage, usage_model)), streaming, model)
+
+    monkeypatch.setattr(codex, "create_usage_meter", create_usage_meter)
+    usage = {"prompt_tokens": 3, "total_tokens": 3}
+    upstream.handler = lambda request: httpx.Response(
+        200,
+        headers={"content-type": "application/json; charset=utf-8"},
+        json={"object": "list", "data": [], "model": "text-embedding-3-small", "usage": usage},
+    )
+    response = codex_client.post(
+        "/v1/embeddings",
+        json={"model": "text-embedding-3-small", "input": "hi"},
+        headers=PROXY_HEADERS,
+    )
+
+    assert response.status_code == 200
+    assert seen == [(usage, "text-embedding-3-small")]
+
+
+def test_observers_ignore_undecodable_json_bodies():
+    import codex_anyrouter_proxy as codex
+
+    seen = []
+    meter = codex.UsageMeter(lambda usage, model: seen.append(usage), streaming=False)
+    recorder = codex.ResponseRecorder(codex.response_store, "", b"[]", None, streaming=False)
+    for observer in (meter, recorder):
+        observer.feed(b'{"usage": "\xff\xfe"}')
+        asyncio.run(observer.finish())
+
+    assert seen == []
@@ -0,0 +1,49 @@
+"""Per-proxy-key RPM / TPM token buckets."""
+
+import time
+
+
+def test_rpm_bucket_rejects_past_the_limit_with_a_retry_hint():
+    import codex_anyrouter_proxy as codex
+
+    limiter = codex.ProxyKeyRateLimiter()
+    config = codex.runtime_config.current
+    info = codex.ProxyKeyInfo("pk-rpm", "tenant", rpm_limit=2)
+
+    decisions = [limiter.admit(config, info) for _ in range(3)]
+
+    assert [decision.allowed for decision in decisions] == [True, True, False]
+    assert 29 < decisions[-1].retry_after <= 30
+    assert decisions[-1].headers["x-ratelimit-limit-requests"] == "2"
+    assert decisions[-1].headers["x-ratelimit-remaining-requests"] == "0"
+
+
+def test_tpm_usage_is_charged_after_the_fact_and_refills():
+    import codex_anyrouter_proxy as codex
+
+    limiter = codex.ProxyKeyRateLimiter()
+    config = codex.runtime_config.current
+    info = codex.ProxyKeyInfo("pk-tpm", "tenant", tpm_limit=600)
+
+    assert limiter.admit(config, info).allowed
+    limiter.charge(info, 660)
+    denied = limiter.admit(config, info)
+    assert not denied.allowed
+    # 61 tokens short at 10 tokens per second.
+    assert 6.0 < denied.retry_after <= 6.1
+
+    bucket = limiter._buckets[("pk-tpm", "tokens")]
+    bucket.updated_at = time.monotonic() - 7
+    assert limiter.admit(config, info).allowed
+
+
+def test_changed_limit_starts_from_a_full_bucket():
+    import codex_anyrouter_proxy as codex
+
+    limiter = codex.ProxyKeyRateLimiter()
+    config = codex.runtime_config.current
+    info = codex.ProxyKeyInfo("pk-change", "tenant", rpm_limit=1)
+
+    assert limiter.admit(config, info).allowed
+    assert not limiter.admit(config, info).allowed
+    assert limiter.admit(config, codex.ProxyKeyInfo("pk-change", "tenant", rpm_limit=5)).allowed
@@ -0,0 +1,47 @@
+"""Local Responses store: only turns sent with store: true are recorded."""
+
+import json
+
+import httpx
+
+from conftest import PROXY_HEADERS
+
+
+def respond(response_id):
+    def handler(request):
+        return httpx.Response(
+            200,
+            json={
+                "id": response_id,
+                "object": "response",
+                "output": [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": "ok"}]}],
+            },
+        )
+
+    return handler
+
+
+def test_turns_without_store_true_are_not_recorded(codex_client, upstream):
+    import codex_anyrouter_proxy as codex
+
+    scope = codex.runtime_config.current.proxy_key_index.lookup("pk-test").key_id
+    for response_id, store in (("resp_store_false", {"store": False}), ("resp_store_omitted", {})):
+        upstream.handler = respond(response_id)
+        codex_client.post("/v1/responses", json={"model": "gpt-5.5", "input": "hi", **store}, headers=PROXY_HEADERS)
+
+        assert codex_client.portal.call(codex.response_store.get, scope, response_id) is None
+
+
+def test_stored_turn_expands_previous_response_id(codex_client, upstream):
+    upstream.handler = respond("resp_stored")
+    codex_client.post("/v1/responses", json={"model": "gpt-5.5", "input": "first", "store": True}, headers=PROXY_HEADERS)
+    upstream.handler = respond("resp_next")
+    codex_client.post(
+        "/v1/responses",
+        json={"model": "gpt-5.5", "input": "second", "previous_response_id": "resp_stored"},
+        headers=PROXY_HEADERS,
+    )
+
+    sent = json.loads(upstream.requests[-1].content)
+    assert "previous_response_id" not in sent
+    assert [item.get("role") for item in sent["input"]] == ["user", "assistant", "user"]
@@ -0,0 +1,104 @@
+"""DNS caching and address fallback in the upstream transport."""
+
+import asyncio
+import socket
+
+import httpx
+import pytest
+
+
+def addrinfo(*addresses):
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, 443)) for address in addresses]
+
+
+def run_with_getaddrinfo(getaddrinfo, scenario):
+    async def main():
+        asyncio.get_running_loop().getaddrinfo = getaddrinfo
+        return await scenario()
+
+    return asyncio.run(main())
+
+
+def test_cancelled_lookup_does_not_strand_concurrent_callers():
+    import codex_anyrouter_proxy as codex
+
+    resolver = codex.CachingResolver(60)
+    calls = 0
+
+    async def getaddrinfo(host, port, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(3600)
+        return addrinfo("192.0.2.10")
+
+    async def scenario():
+        leader = asyncio.create_task(resolver.resolve("upstream.test", 443, 5))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(resolver.resolve("upstream.test", 443, 5))
+        await asyncio.sleep(0)
+        leader.cancel()
+        addresses = await asyncio.wait_for(follower, 1)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return addresses
+
+    assert run_with_getaddrinfo(getaddrinfo, scenario) == ("192.0.2.10",)
+    assert resolver._pending == {}
+
+
+def test_lookup_is_bounded_by_the_connect_timeout():
+    import codex_anyrouter_proxy as codex
+
+    resolver = codex.CachingResolver(60)
+
+    async def getaddrinfo(host, port, **kwargs):
+        await asyncio.sleep(3600)
+
+    async def scenario():
+        with pytest.raises(httpx.ConnectTimeout):
+            await resolver.resolve("upstream.test", 443, 0.05)
+
+    run_with_getaddrinfo(getaddrinfo, scenario)
+    assert resolver._pending == {}
+
+
+def test_transport_falls_back_to_the_next_address_and_keeps_the_host_name():
+    import codex_anyrouter_proxy as codex
+
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        if request.url.host == "192.0.2.10":
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200)
+
+    transport = codex.InstrumentedTransport(httpx.MockTransport(handler), codex.CachingResolver(60))
+
+    async def getaddrinfo(host, port, **kwargs):
+        return addrinfo("192.0.2.10", "192.0.2.10", "192.0.2.11")
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await client.get("https://upstream.test/v1/models")
+
+    response = run_with_getaddrinfo(getaddrinfo, scenario)
+
+    assert response.status_code == 200
+    assert [request.url.host for request in seen] == ["192.0.2.10", "192.0.2.11"]
+    assert seen[-1].headers["host"] == "upstream.test"
+    assert seen[-1].extensions["sni_hostname"] == "upstream.test"
+    assert transport.requests == 1
+
+
+def test_environment_proxy_keeps_the_default_client(monkeypatch):
+    import codex_anyrouter_proxy as codex
+
+    monkeypatch.setenv("HTTPS_PROXY", "http://proxy.internal:3128")
+    connections = codex.UpstreamConnections(False, httpx.Limits(), 0, 0, 60)
+    client = connections.create_client()
+
+    assert connections.transport is None
+    assert any(transport is not None for transport in client._mounts.values())
+    asyncio.run(client.aclose())
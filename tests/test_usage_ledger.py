@@ -0,0 +1,67 @@
+"""Usage ledger flushing when the database cannot be written."""
+
+import asyncio
+
+import pytest
+
+
+def usage(tokens):
+    return {"input_tokens": tokens, "output_tokens": 0, "total_tokens": tokens}
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    import codex_anyrouter_proxy as codex
+
+    return codex.UsageLedger(str(tmp_path / "usage.sqlite3"), 1, 0, max_pending=2)
+
+
+def test_unwritable_database_keeps_rows_for_retry(ledger, monkeypatch):
+    def unwritable(rows, prune_before):
+        raise PermissionError("data dir is not writable")
+
+    monkeypatch.setattr(ledger, "_write", unwritable)
+    ledger.record(None, "up-key", "gpt-5.5", usage(5))
+
+    assert asyncio.run(ledger.flush()) == 0
+    assert [totals[-1] for totals in ledger._pending.values()] == [5]
+
+    monkeypatch.undo()
+    assert asyncio.run(ledger.flush()) == 1
+    assert ledger._pending == {}
+
+
+def test_pending_aggregates_are_capped_while_unwritable(ledger, monkeypatch):
+    def unwritable(rows, prune_before):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(ledger, "_write", unwritable)
+    for model in ("a", "b", "c", "d"):
+        ledger.record(None, "up-key", model, usage(1))
+        asyncio.run(ledger.flush())
+    # Existing aggregates still accumulate.
+    ledger.record(None, "up-key", "a", usage(1))
+
+    assert len(ledger._pending) == 2
+    assert ledger.dropped == 2
+    assert sum(totals[-1] for totals in ledger._pending.values()) == 3
+
+
+def test_flush_loop_survives_errors(ledger, monkeypatch):
+    calls = 0
+
+    async def failing_flush():
+        nonlocal calls
+        calls += 1
+        raise RuntimeError("boom")
+
+    async def scenario():
+        ledger.flush_seconds = 0.01
+        monkeypatch.setattr(ledger, "flush", failing_flush)
+        task = asyncio.create_task(ledger._run())
+        await asyncio.sleep(0.1)
+        assert not task.done()
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert calls > 1